@@ -0,0 +1,167 @@
+"""
+Network-free stand-ins for the Telegram and MongoDB objects the forwarding pipeline touches.
+They implement only the attributes and calls that the handlers actually use.
+"""
+import asyncio
+import copy
+import itertools
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from pyrogram import enums
+
+BOT_ID = 5000000000
+
+_message_ids = itertools.count(1)
+_file_ids = itertools.count(1)
+
+
+class FakeCursor:
+    def __init__(self, documents: List[Dict[str, Any]]):
+        self._documents = documents
+
+    async def to_list(self, length=None):
+        return [copy.copy(document) for document in self._documents]
+
+
+class FakeCollection:
+    """An in-memory replacement for the `forwarding_rules` collection."""
+
+    def __init__(self, documents: Optional[List[Dict[str, Any]]] = None):
+        self.documents = list(documents or [])
+        self.calls = 0
+
+    def find(self, query: Dict[str, Any]) -> FakeCursor:
+        self.calls += 1
+        return FakeCursor([
+            document for document in self.documents
+            if all(document.get(field) == value for field, value in query.items())
+        ])
+
+
+
+class FakeOutboxCollection:
+    """An in-memory replacement for the `outbox` collection; counts the group commits."""
+
+    def __init__(self):
+        self.documents: Dict[str, Dict[str, Any]] = {}
+        self.inserts = 0
+
+    async def insert_many(self, documents: List[Dict[str, Any]], ordered: bool = True):
+        self.inserts += 1
+        for document in documents:
+            self.documents.setdefault(document['_id'], document)
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        pass
+
+    async def delete_many(self, query: Dict[str, Any]):
+        for key in query['_id']['$in']:
+            self.documents.pop(key, None)
+
+class FakeUser:
+    def __init__(self, user_id: int, first_name: str):
+        self.id = user_id
+        self.first_name = first_name
+        self.mention = f'<a href="tg://user?id={user_id}">{first_name}</a>'
+
+
+class FakeChat:
+    def __init__(self, chat_id: int, chat_type: enums.ChatType, title: Optional[str] = None):
+        self.id = chat_id
+        self.type = chat_type
+        self.title = title
+
+
+class FakeFile:
+    def __init__(self):
+        number = next(_file_ids)
+        self.file_id = f"file-{number}"
+        self.file_unique_id = f"unique-{number}"
+        self.file_name = None
+
+
+class FakeMessage:
+    """A message as seen by a user client. Every attribute the handlers read defaults to None."""
+
+    text = caption = caption_entities = media = media_group_id = link = None
+    photo = video_note = video = document = audio = voice = sticker = animation = None
+    contact = location = venue = None
+    mentioned = has_protected_content = False
+    empty = False
+
+    def __init__(self, chat: FakeChat, from_user: FakeUser, **kwargs):
+        self.id = next(_message_ids)
+        self.chat = chat
+        self.from_user = from_user
+        self.date = datetime.now()
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def text_message(cls, chat: FakeChat, from_user: FakeUser) -> "FakeMessage":
+        return cls(chat, from_user, text="Benchmark message with a little bit of text in it.")
+
+    @classmethod
+    def photo_message(cls, chat: FakeChat, from_user: FakeUser) -> "FakeMessage":
+        return cls(chat, from_user, photo=FakeFile(), media=enums.MessageMediaType.PHOTO, caption="A photo")
+
+    @classmethod
+    def mention_message(cls, chat: FakeChat, from_user: FakeUser) -> "FakeMessage":
+        return cls(
+            chat, from_user, text="@someone have a look at this", mentioned=True,
+            link=f"https://t.me/c/{abs(chat.id)}/1",
+        )
+
+
+class FakeBot:
+    """The bot client. Counts every Bot API call by method instead of sending anything."""
+
+    def __init__(self):
+        self.me = FakeUser(BOT_ID, "Benchmark Bot")
+        self.bot_token = f"{BOT_ID}:benchmark"
+        self.calls = Counter()
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.calls["send_message"] += 1
+
+    async def send_cached_media(self, chat_id: int, file_id: str, **kwargs):
+        self.calls["send_cached_media"] += 1
+
+    async def send_media_group(self, chat_id: int, media: list, **kwargs):
+        self.calls["send_media_group"] += 1
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+class FakeUserClient:
+    """
+    A managed user's client. Forwarding media to the bot hands a bot-side copy of each
+    message to the relay on the next loop iteration, like the bot's capture handler would.
+    """
+
+    def __init__(self, user_id: int, relay, bot: FakeBot):
+        self.me = FakeUser(user_id, f"User {user_id}")
+        self.relay = relay
+        self.bot = bot
+        self._messages: Dict[int, FakeMessage] = {}
+        self.calls = Counter()
+
+    def remember(self, message: FakeMessage):
+        self._messages[message.id] = message
+
+    async def forward_messages(self, chat_id: int, from_chat_id: int, message_ids: List[int], **kwargs):
+        self.calls["forward_messages"] += 1
+        loop = asyncio.get_running_loop()
+        for message_id in message_ids:
+            source = self._messages[message_id]
+            bot_copy = FakeMessage(
+                FakeChat(self.me.id, enums.ChatType.BOT), self.me,
+                photo=source.photo, media=source.media, caption=source.caption,
+            )
+            loop.call_soon(self.relay.capture, self.bot, bot_copy)
+
+    async def get_messages(self, chat_id: int, message_ids: List[int]):
+        self.calls["get_messages"] += 1
+        return [self._messages.get(message_id) for message_id in message_ids]
@@ -0,0 +1,286 @@
+"""
+Offline benchmark of the forwarding pipeline.
+
+Drives `forwarding_handler` with fake user clients, a fake bot and an in-memory rules
+collection, sweeping users x rules x destinations x message mix. Nothing touches the network.
+
+    python -m benchmarks.run                      # full sweep, print a table
+    python -m benchmarks.run --quick              # small sweep
+    python -m benchmarks.run --save               # also merge the results into benchmarks/baseline.json
+    python -m benchmarks.run --compare            # compare against benchmarks/baseline.json
+"""
+import os
+
+# The pipeline reads its settings at import time. Outbound rate limits are lifted so the
+# benchmark measures the code instead of the token buckets, and nothing is exposed or persisted.
+os.environ.setdefault("API_ID", "1")
+os.environ.setdefault("API_HASH", "benchmark")
+os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+os.environ.setdefault("OWNER_ID", "1")
+for name in ("OUTBOUND_GLOBAL_RATE", "OUTBOUND_CHAT_RATE", "OUTBOUND_GROUP_RATE"):
+    os.environ[name] = "1e9"
+# The group commit window only adds a fixed wait before each delivery; the in-memory outbox
+# collection makes the commit itself free, so the benchmark still measures its code path
+os.environ["OUTBOX_COMMIT_WINDOW"] = "0"
+os.environ["RUN_MODE"] = "all"
+os.environ["DEDUP_BACKEND"] = "memory"
+os.environ["METRICS_PORT"] = "0"
+
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+from pyrogram import enums
+
+import database.manager as db_manager
+from config import LOG_HOT_PATH, LOG_HOT_PATH_RATE, LOG_HOT_PATH_LOGGERS, LOG_SUMMARY_INTERVAL
+from log_pipeline import log_pipeline, HotPathFilter
+from bot.outbound import outbound, _Bot
+from user_clients import handlers
+from user_clients.relay import media_relay
+from benchmarks.fakes import (
+    FakeBot, FakeChat, FakeCollection, FakeMessage, FakeOutboxCollection, FakeUser, FakeUserClient,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Fraction of each message kind per mix
+MIXES = {
+    "text": {"text": 1.0},
+    "media": {"media": 1.0},
+    "mention": {"mention": 1.0},
+    "mixed": {"text": 0.6, "media": 0.25, "mention": 0.15},
+}
+
+FULL_SWEEP = {"users": [1, 10], "rules": [1, 50], "destinations": [1, 10], "mix": list(MIXES)}
+QUICK_SWEEP = {"users": [1, 5], "rules": [10], "destinations": [1, 5], "mix": ["text", "mixed"]}
+
+
+def scenario_name(users: int, rules: int, destinations: int, mix: str) -> str:
+    return f"u{users}-r{rules}-d{destinations}-{mix}"
+
+
+def build_rules(user_id: int, rules: int, destinations: int) -> List[Dict[str, Any]]:
+    """Rule i routes the user's source i (a private chat and a supergroup) to `destinations` chats."""
+    documents = []
+    for index in range(rules):
+        documents.append({
+            '_id': f"{user_id}-{index}",
+            'user_id': user_id,
+            'source_chats': [private_source(user_id, index), group_source(user_id, index)],
+            'destination_chats': [-(10 ** 12) - user_id * 1000 - dest for dest in range(destinations)],
+        })
+    return documents
+
+
+def private_source(user_id: int, index: int) -> int:
+    return 10 ** 9 + user_id * 10000 + index
+
+
+def group_source(user_id: int, index: int) -> int:
+    return -(10 ** 13) - user_id * 10000 - index
+
+
+def build_messages(client: FakeUserClient, rules: int, mix: str, count: int) -> List[FakeMessage]:
+    """Builds `count` messages spread over the user's rule sources in the proportions of `mix`."""
+    kinds = []
+    for kind, share in MIXES[mix].items():
+        kinds.extend([kind] * round(share * 20))
+    messages = []
+    user_id = client.me.id
+    for number, kind in zip(range(count), itertools.cycle(kinds)):
+        index = number % rules
+        sender = FakeUser(private_source(user_id, index), f"Sender {index}")
+        if kind == "mention":
+            chat = FakeChat(group_source(user_id, index), enums.ChatType.SUPERGROUP, f"Group {index}")
+            message = FakeMessage.mention_message(chat, sender)
+        else:
+            chat = FakeChat(sender.id, enums.ChatType.PRIVATE)
+            factory = FakeMessage.photo_message if kind == "media" else FakeMessage.text_message
+            message = factory(chat, sender)
+        client.remember(message)
+        messages.append(message)
+    return messages
+
+
+async def run_scenario(users: int, rules: int, destinations: int, mix: str, messages_per_user: int,
+                       trace_memory: bool) -> Dict[str, Any]:
+    bot = FakeBot()
+    outbound.bots = [_Bot(bot)]
+    for chat in outbound._chats.values():
+        # Destination chats of an earlier scenario would keep sending with its bot
+        chat.bots = outbound.bots
+    media_relay.primary = bot
+
+    user_ids = [100 + number for number in range(users)]
+    db_manager.forwarding_rules = FakeCollection([
+        rule for user_id in user_ids for rule in build_rules(user_id, rules, destinations)
+    ])
+    db_manager.outbox = FakeOutboxCollection()
+    clients = [FakeUserClient(user_id, media_relay, bot) for user_id in user_ids]
+    for client in clients:
+        await db_manager.load_rule_index(client.me.id)
+    workload = [(client, build_messages(client, rules, mix, messages_per_user)) for client in clients]
+
+    latencies: List[float] = []
+
+    async def drive(client: FakeUserClient, messages: List[FakeMessage]):
+        # Each client handles its own updates one after another; clients run concurrently
+        for message in messages:
+            started = time.perf_counter()
+            await handlers.forwarding_handler(client, message)
+            latencies.append(time.perf_counter() - started)
+
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(drive(client, messages) for client, messages in workload))
+    elapsed = time.perf_counter() - started
+    peak_memory = 0
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    total = users * messages_per_user
+    latencies.sort()
+    return {
+        "name": scenario_name(users, rules, destinations, mix),
+        "users": users,
+        "rules": rules,
+        "destinations": destinations,
+        "mix": mix,
+        "messages": total,
+        "throughput": total / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "bot_calls_per_message": bot.total_calls() / total,
+        "upstream_forwards_per_message": sum(client.calls["forward_messages"] for client in clients) / total,
+        "peak_memory_kib": peak_memory / 1024,
+    }
+
+
+async def run_sweep(sweep: Dict[str, list], messages_per_user: int) -> List[Dict[str, Any]]:
+    results = []
+    for users, rules, destinations, mix in itertools.product(
+        sweep["users"], sweep["rules"], sweep["destinations"], sweep["mix"]
+    ):
+        # Throughput and latency are measured without tracemalloc, which slows allocation down
+        result = await run_scenario(users, rules, destinations, mix, messages_per_user, trace_memory=False)
+        memory = await run_scenario(users, rules, destinations, mix, messages_per_user, trace_memory=True)
+        result["peak_memory_kib"] = memory["peak_memory_kib"]
+        results.append(result)
+        print(format_row(result), flush=True)
+    return results
+
+
+HEADER = (
+    f"{'scenario':<24} {'msg/s':>10} {'p50 ms':>8} {'p99 ms':>8} "
+    f"{'bot/msg':>8} {'fwd/msg':>8} {'peak KiB':>10}"
+)
+
+
+def format_row(result: Dict[str, Any]) -> str:
+    return (
+        f"{result['name']:<24} {result['throughput']:>10.0f} {result['p50_ms']:>8.3f} {result['p99_ms']:>8.3f} "
+        f"{result['bot_calls_per_message']:>8.2f} {result['upstream_forwards_per_message']:>8.2f} "
+        f"{result['peak_memory_kib']:>10.0f}"
+    )
+
+
+def compare(results: List[Dict[str, Any]], baseline: Dict[str, Any], tolerance: float) -> bool:
+    """
+    Prints throughput and p99 changes against the baseline. Returns False on a regression, or when
+    no scenario of the sweep is in the baseline at all.
+    """
+    previous = {result["name"]: result for result in baseline["results"]}
+    ok = True
+    matched = 0
+    print(f"\nCompared with baseline from {baseline['created']} (tolerance {tolerance:.0%}):")
+    for result in results:
+        old = previous.get(result["name"])
+        if old is None:
+            print(f"  {result['name']:<24} (not in baseline)")
+            continue
+        matched += 1
+        throughput_change = result["throughput"] / old["throughput"] - 1
+        p99_change = result["p99_ms"] / old["p99_ms"] - 1 if old["p99_ms"] else 0
+        regressed = throughput_change < -tolerance or result["bot_calls_per_message"] > old["bot_calls_per_message"]
+        ok = ok and not regressed
+        print(
+            f"  {result['name']:<24} throughput {throughput_change:+7.1%}  p99 {p99_change:+7.1%}  "
+            f"bot/msg {old['bot_calls_per_message']:.2f} -> {result['bot_calls_per_message']:.2f}"
+            f"{'  REGRESSION' if regressed else ''}"
+        )
+    if not matched:
+        print("  No scenario of this sweep is in the baseline; re-create it with --save.")
+        return False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the forwarding pipeline.")
+    parser.add_argument("--quick", action="store_true", help="Run a small sweep.")
+    parser.add_argument("--messages", type=int, default=500, help="Messages per user and scenario.")
+    parser.add_argument("--save", action="store_true", help=f"Write the results to {BASELINE_PATH}.")
+    parser.add_argument("--compare", action="store_true", help="Compare the results with the saved baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Allowed relative throughput drop before --compare reports a regression.")
+    parser.add_argument("--log-file", help="Log the pipeline at INFO level to this file to include logging cost "
+                                           "(honours LOG_HOT_PATH and the other logging settings).")
+    args = parser.parse_args()
+
+    if args.log_file:
+        file_handler = logging.FileHandler(args.log_file)
+        file_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+        log_pipeline.start(
+            [file_handler],
+            logging.INFO,
+            HotPathFilter(LOG_HOT_PATH_LOGGERS, LOG_HOT_PATH, LOG_HOT_PATH_RATE, LOG_SUMMARY_INTERVAL),
+        )
+    else:
+        logging.disable(logging.WARNING)
+
+    print(HEADER)
+    try:
+        results = asyncio.run(run_sweep(QUICK_SWEEP if args.quick else FULL_SWEEP, args.messages))
+    finally:
+        log_pipeline.stop()
+
+    if args.save:
+        # Results are merged by scenario name, so the full and the quick sweep share one baseline
+        saved = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as f:
+                previous = json.load(f)
+            if previous.get("messages_per_user") == args.messages:
+                saved = {result["name"]: result for result in previous["results"]}
+        saved.update((result["name"], result) for result in results)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "messages_per_user": args.messages,
+                "results": list(saved.values()),
+            }, f, indent=2)
+        print(f"\nBaseline written to {BASELINE_PATH}.")
+
+    if args.compare:
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 from pyrogram import Client
 import uvloop
 
-from config import API_ID, API_HASH, BOT_TOKEN, PROXY
+from config import API_ID, API_HASH, BOT_TOKEN, BOT_POOL_TOKENS, PROXY, RUN_MODE
 
 client_params = {
     "name": "TeleFwdBot",
@@ -12,8 +12,24 @@ client_params = {
         "root": "bot.handlers"
     }
 }
+if RUN_MODE == "worker":
+    # Workers only send on behalf of their user clients; admin commands are served by the bot process
+    client_params["plugins"]["include"] = ["relay"]
 if PROXY:
     client_params["proxy"] = PROXY
 
 
-bot_client = Client(**client_params) 
\ No newline at end of file
+bot_client = Client(**client_params)
+
+# Extra bots sharing the outbound sends. They only serve the media relay, never admin commands,
+# and are not needed in "bot" mode, where no user client sends anything.
+pool_clients = []
+if RUN_MODE != "bot":
+    for token in BOT_POOL_TOKENS:
+        pool_params = dict(
+            client_params,
+            name=f"TeleFwdBot_{token.split(':')[0]}",
+            bot_token=token,
+            plugins={"root": "bot.handlers", "include": ["relay"]},
+        )
+        pool_clients.append(Client(**pool_params))
@@ -8,7 +8,7 @@ from pyrogram.errors import (
     SessionPasswordNeeded,
     PasswordHashInvalid,
 )
-from config import API_ID, API_HASH, OWNER_ID, PROXY
+from config import API_ID, API_HASH, OWNER_ID, PROXY, RUN_MODE, LEASE_HEARTBEAT
 from database.manager import add_managed_user
 from user_clients.manager import user_client_manager
 from ..app import bot_client
@@ -161,6 +161,12 @@ async def finalize_session(message: Message, session_data: dict):
     await message.reply(f"✅ 用户 `{new_user_me.id}`（{new_user_me.first_name}）已保存到数据库。")
 
     # 2. Start the user client instance immediately
+    if RUN_MODE == "bot":
+        # In sharded mode a worker claims the new user on its next heartbeat
+        await message.reply(f"🚀 `{new_user_me.id}` 的客户端将在 {LEASE_HEARTBEAT} 秒内由工作进程启动。")
+        user_auth_sessions.pop(message.from_user.id, None)
+        return
+
     await message.reply(f"🚀 正在启动 `{new_user_me.id}` 的客户端...")
     success = await user_client_manager.start_client(new_user_me.id, session_string)
 
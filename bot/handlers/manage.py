@@ -1,13 +1,53 @@
+import asyncio
+import time
+from typing import Optional
 from pyrogram import Client, filters
 from pyrogram.handlers import MessageHandler
-from pyrogram.types import Message
-from config import OWNER_ID
-from database.manager import get_all_active_users, deactivate_user
+from pyrogram.types import CallbackQuery, Message
+from config import OWNER_ID, RUN_MODE, LEASE_HEARTBEAT, LIST_PAGE_SIZE
+from database.manager import (
+    deactivate_user,
+    get_active_client_leases,
+    get_managed_users_page,
+    count_managed_users,
+    count_rules_per_user,
+)
+from bot.pagination import parse_cursor, render_page
 from user_clients.manager import user_client_manager
 
 # Command Filters
 owner_only = filters.private & filters.user(OWNER_ID)
 
+# Supervisor states (user_clients.supervisor) as shown by /listusers
+STATE_LABELS = {
+    "running": "✅ 运行中",
+    "backoff": "🔁 等待重启",
+    "revoked": "🔒 会话已失效",
+    "stopped": "❌ 已停止",
+}
+
+
+def _format_age(timestamp) -> str:
+    if not timestamp:
+        return "无"
+    seconds = max(int(time.time() - timestamp), 0)
+    if seconds < 60:
+        return f"{seconds}秒前"
+    if seconds < 3600:
+        return f"{seconds // 60}分钟前"
+    return f"{seconds // 3600}小时前"
+
+
+def _format_health(health, location: str = "") -> str:
+    """One /listusers status line from a supervisor snapshot."""
+    status = STATE_LABELS.get(health['state'], health['state'])
+    if location:
+        status += f"（{location}）"
+    line = f"{status} | **最后更新:** {_format_age(health.get('last_update_at'))} | **重启:** {health.get('restarts', 0)}次"
+    if health['state'] != "running" and health.get('last_error'):
+        line += f"\n  **错误:** `{health['last_error']}`"
+    return line
+
 @Client.on_message(filters.command("deluser") & owner_only,group=1)
 async def deluser_command(client: Client, message: Message):
     """
@@ -22,11 +62,15 @@ async def deluser_command(client: Client, message: Message):
         user_id_to_del = int(message.command[1])
         
         # 1. 如果客户端正在运行，则停止它
-        stopped = await user_client_manager.stop_client(user_id_to_del)
-        if stopped:
-            await message.reply(f"✔️ 用户 `{user_id_to_del}` 的客户端已成功停止。")
+        if RUN_MODE == "bot":
+            # 分片模式下客户端运行在工作进程中，由其在下一次心跳时停止
+            await message.reply(f"✔️ 用户 `{user_id_to_del}` 的客户端将在 {LEASE_HEARTBEAT} 秒内由工作进程停止。")
         else:
-            await message.reply(f"⚠️ 用户 `{user_id_to_del}` 的客户端未运行。")
+            stopped = await user_client_manager.stop_client(user_id_to_del)
+            if stopped:
+                await message.reply(f"✔️ 用户 `{user_id_to_del}` 的客户端已成功停止。")
+            else:
+                await message.reply(f"⚠️ 用户 `{user_id_to_del}` 的客户端未运行。")
 
         # 2. 在数据库中停用用户
         if await deactivate_user(user_id_to_del):
@@ -39,22 +83,71 @@ async def deluser_command(client: Client, message: Message):
     except Exception as e:
         await message.reply(f"发生错误：{e}")
 
+def _user_status(user, leases) -> str:
+    user_id = user['user_id']
+    if user.get('session_revoked'):
+        return STATE_LABELS["revoked"] + "（请重新 /adduser）"
+    if RUN_MODE != "all":
+        lease = leases.get(user_id)
+        if lease is None:
+            return STATE_LABELS["stopped"]
+        if lease.get('health'):
+            return _format_health(lease['health'], lease['worker_id'])
+        return f"{STATE_LABELS['running']}（{lease['worker_id']}）"
+    health = user_client_manager.supervisor.snapshot(user_id)
+    return _format_health(health) if health else STATE_LABELS["stopped"]
+
+
+async def _users_page(after: Optional[int] = None, before: Optional[int] = None):
+    """Renders one /listusers page, or returns None if there are no users in that direction."""
+    users, more = await get_managed_users_page(LIST_PAGE_SIZE, after, before)
+    if not users:
+        return None
+    user_ids = [user['user_id'] for user in users]
+    counts, rule_counts = await asyncio.gather(count_managed_users(), count_rules_per_user(user_ids))
+    # 分片模式下，客户端分布在各个工作进程中，以租约为准
+    leases = await get_active_client_leases(user_ids) if RUN_MODE != "all" else {}
+
+    header = (
+        f"已管理用户（在DB中活动）：**{counts['active']}** 个"
+        f"（会话已失效 {counts['revoked']} 个，已停用 {counts['inactive']} 个），共 {counts['rules']} 条规则\n\n"
+    )
+    entries = [
+        (
+            str(user['user_id']),
+            f"- **用户ID:** `{user['user_id']}` | **规则:** {rule_counts[user['user_id']]}条"
+            f" | **状态:** {_user_status(user, leases)}\n",
+        )
+        for user in users
+    ]
+    has_previous = more if before is not None else after is not None
+    has_next = before is not None or more
+    return render_page(header, entries, "lu", has_previous, has_next)
+
 @Client.on_message(filters.command("listusers") & owner_only,1)
 async def listusers_command(client: Client, message: Message):
-    """列出所有活动的已管理用户及其客户端状态。"""
+    """列出所有活动的已管理用户及其客户端状态，每页 LIST_PAGE_SIZE 个，可通过按钮翻页。"""
     try:
-        users = await get_all_active_users()
-        if not users:
+        page = await _users_page()
+        if page is None:
             await message.reply("数据库中未配置任何活动用户。")
             return
-
-        response = "已管理用户（在DB中活动）：\n\n"
-        for user in users:
-            user_id = user['user_id']
-            status = "✅ 运行中" if user_id in user_client_manager.running_clients else "❌ 已停止"
-            response += f"- **用户ID:** `{user_id}` | **状态:** {status}\n"
-        
-        await message.reply(response)
+        text, reply_markup = page
+        await message.reply(text, reply_markup=reply_markup)
     except Exception as e:
         await message.reply(f"发生错误：{e}")
 
+@Client.on_callback_query(filters.regex(r"^lu:[np]:") & filters.user(OWNER_ID))
+async def listusers_page_callback(client: Client, callback_query: CallbackQuery):
+    """/listusers 的翻页按钮。"""
+    try:
+        _, after, before = parse_cursor(callback_query.data)
+        page = await _users_page(int(after) if after else None, int(before) if before else None)
+        if page is None:
+            await callback_query.answer("没有更多用户了。")
+            return
+        text, reply_markup = page
+        await callback_query.edit_message_text(text, reply_markup=reply_markup)
+        await callback_query.answer()
+    except Exception as e:
+        await callback_query.answer(f"发生错误：{e}", show_alert=True)
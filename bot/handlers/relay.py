@@ -0,0 +1,12 @@
+from pyrogram import Client, filters
+from pyrogram.types import Message
+from user_clients.relay import media_relay
+
+# Matches the bot-side copies of media that a user client is currently relaying
+relay_expected = filters.create(lambda _, client, message: media_relay.is_expecting(client, message))
+
+@Client.on_message(filters.private & filters.media & relay_expected, group=-1)
+async def relay_capture_handler(client: Client, message: Message):
+    """Hands the bot-side copy of relayed media back to the waiting user client."""
+    media_relay.capture(client, message)
+    message.stop_propagation()
@@ -1,17 +1,33 @@
+import html
+import io
 import json
 import logging
+from typing import Any, Dict, List, Optional, Tuple
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from pyrogram import Client, filters
-from pyrogram.types import Message
-from config import OWNER_ID
+from pyrogram.types import CallbackQuery, Message
+from config import OWNER_ID, LIST_PAGE_SIZE
 from database.manager import (
     add_forwarding_rule,
-    get_forwarding_rules_for_user,
+    validate_rule_config,
+    import_forwarding_rules,
+    export_forwarding_rules,
+    get_forwarding_rules_page,
+    summarize_forwarding_rules,
     delete_forwarding_rule,
     get_user_by_id,
 )
+from bot.pagination import parse_cursor, render_page
 
 logger = logging.getLogger(__name__)
 
+# Longer filter objects are cut off in /listrules, so every rule fits on a page
+MAX_FILTERS_LENGTH = 500
+# Largest file /importrules accepts, and how many validation errors it reports
+MAX_IMPORT_SIZE = 5 * 1024 * 1024
+MAX_IMPORT_ERRORS = 20
+
 # Command Filters
 owner_only = filters.private & filters.user(OWNER_ID)
 
@@ -46,7 +62,11 @@ async def addrule_command(client: Client, message: Message):
             await message.reply(f"未找到ID为 `{user_id}` 的托管用户。")
             return
 
-        rule = await add_forwarding_rule(user_id, rule_config)
+        try:
+            rule = await add_forwarding_rule(user_id, rule_config)
+        except ValueError as e:
+            await message.reply(f"无效的规则配置: {e}")
+            return
         await message.reply(
             f"✅ 用户 `{user_id}` 的转发规则已成功添加。\n"
             f"<b>规则ID:</b> <code>{rule['_id']}</code>"
@@ -60,10 +80,42 @@ async def addrule_command(client: Client, message: Message):
         logger.error(f"Error in addrule_command: {e}", exc_info=True)
         await message.reply(f"发生错误: {e}")
 
+def _format_rule(rule) -> str:
+    sources = ", ".join(map(str, rule.get('source_chats', [])))
+    dests = ", ".join(map(str, rule.get('destination_chats', [])))
+    text = (
+        f"<b>规则ID:</b> <code>{rule['_id']}</code>\n"
+        f"  <b>来源:</b> <code>{sources if sources else 'Any Chat'}</code>\n"
+        f"  <b>目标:</b> <code>{dests}</code>\n"
+    )
+    if rule.get('filters'):
+        rule_filters = json.dumps(rule['filters'], ensure_ascii=False)
+        if len(rule_filters) > MAX_FILTERS_LENGTH:
+            rule_filters = rule_filters[:MAX_FILTERS_LENGTH] + "…"
+        text += f"  <b>过滤:</b> <code>{html.escape(rule_filters)}</code>\n"
+    return text + "\n"
+
+
+async def _rules_page(user_id: int, after: Optional[str] = None, before: Optional[str] = None):
+    """Renders one /listrules page, or returns None if the user has no rules in that direction."""
+    rules, more = await get_forwarding_rules_page(user_id, LIST_PAGE_SIZE, after, before)
+    if not rules:
+        return None
+    summary = await summarize_forwarding_rules(user_id)
+    header = (
+        f"<b>用户 <code>{user_id}</code> 的转发规则:</b> 共 {summary['rules']} 条"
+        f"（带过滤 {summary['filtered']} 条，摘要 {summary['digest']} 条），"
+        f"来源聊天 {summary['sources']} 个，目标聊天 {summary['destinations']} 个\n\n"
+    )
+    entries = [(str(rule['_id']), _format_rule(rule)) for rule in rules]
+    has_previous = more if before is not None else after is not None
+    has_next = before is not None or more
+    return render_page(header, entries, f"lr:{user_id}", has_previous, has_next)
+
 @Client.on_message(filters.command("listrules") & owner_only)
 async def listrules_command(client: Client, message: Message):
     """
-    列出特定托管用户的所有转发规则。
+    分页列出特定托管用户的所有转发规则。
     用法: /listrules <托管用户ID>
     """
     if len(message.command) < 2:
@@ -75,29 +127,35 @@ async def listrules_command(client: Client, message: Message):
         if not await get_user_by_id(user_id):
             await message.reply(f"未找到ID为 `{user_id}` 的托管用户。")
             return
-            
-        rules = await get_forwarding_rules_for_user(user_id)
-        if not rules:
+
+        page = await _rules_page(user_id)
+        if page is None:
             await message.reply(f"未找到用户 `{user_id}` 的转发规则。")
             return
-
-        response = f"<b>用户 `{user_id}` 的转发规则:</b>\n\n" 
-        for rule in rules:
-            sources = ", ".join(map(str, rule.get('source_chats', [])))
-            dests = ", ".join(map(str, rule.get('destination_chats', [])))
-            response += (
-                f"<b>规则ID:</b> <code>{rule['_id']}</code>\n"
-                f"  <b>来源:</b> <code>{sources if sources else 'Any Chat'}</code>\n"
-                f"  <b>目标:</b> <code>{dests}</code>\n\n"
-            )
-        
-        await message.reply(response)
+        text, reply_markup = page
+        await message.reply(text, reply_markup=reply_markup)
     except ValueError:
         await message.reply("无效的用户ID。它必须是整数。")
     except Exception as e:
         logger.error(f"Error in listrules_command: {e}", exc_info=True)
         await message.reply(f"发生错误: {e}")
 
+@Client.on_callback_query(filters.regex(r"^lr:-?\d+:[np]:") & filters.user(OWNER_ID))
+async def listrules_page_callback(client: Client, callback_query: CallbackQuery):
+    """/listrules 的翻页按钮。"""
+    try:
+        prefix, after, before = parse_cursor(callback_query.data)
+        page = await _rules_page(int(prefix.split(":")[1]), after, before)
+        if page is None:
+            await callback_query.answer("没有更多规则了。")
+            return
+        text, reply_markup = page
+        await callback_query.edit_message_text(text, reply_markup=reply_markup)
+        await callback_query.answer()
+    except Exception as e:
+        logger.error(f"Error in listrules_page_callback: {e}", exc_info=True)
+        await callback_query.answer(f"发生错误: {e}", show_alert=True)
+
 @Client.on_message(filters.command("delrule") & owner_only)
 async def delrule_command(client: Client, message: Message):
     """
@@ -117,3 +175,152 @@ async def delrule_command(client: Client, message: Message):
     except Exception as e:
         logger.error(f"Error in delrule_command: {e}", exc_info=True)
         await message.reply(f"发生错误: {e}")
+
+
+def _parse_rules_file(data: bytes) -> List[Tuple[int, Any]]:
+    """
+    Reads an uploaded rules file: a JSON array of rule objects, or JSON Lines (one rule per line).
+    Returns [(line or position, rule)]; raises ValueError if the file is not valid JSON.
+    """
+    text = data.decode("utf-8-sig")
+    if text.lstrip().startswith("["):
+        try:
+            rules = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"无效的JSON: {e}")
+        return list(enumerate(rules, 1))
+    rules = []
+    for line_number, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            rules.append((line_number, json.loads(line)))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"第 {line_number} 行不是有效的JSON: {e}")
+    return rules
+
+
+async def _prepare_rules(entries: List[Tuple[int, Any]], user_id: Optional[int],
+                         upsert: bool) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Validates all rules of an import at once. Returns the rule documents to write and the errors found."""
+    rules, errors = [], []
+    known_users: Dict[int, bool] = {}
+    seen_ids = set()
+    for position, rule in entries:
+        try:
+            if not isinstance(rule, dict):
+                raise ValueError("规则必须是JSON对象。")
+            rule = dict(rule)
+            rule_id = rule.pop('_id', None)
+            if user_id is not None:
+                rule['user_id'] = user_id
+            if not isinstance(rule.get('user_id'), int):
+                raise ValueError("缺少 user_id（或在命令中指定托管用户ID）。")
+            if rule['user_id'] not in known_users:
+                known_users[rule['user_id']] = await get_user_by_id(rule['user_id']) is not None
+            if not known_users[rule['user_id']]:
+                raise ValueError(f"未找到ID为 {rule['user_id']} 的托管用户。")
+            validate_rule_config(rule)
+            if upsert and rule_id is not None:
+                try:
+                    rule['_id'] = ObjectId(str(rule_id))
+                except InvalidId:
+                    raise ValueError(f"无效的规则ID {rule_id}。")
+                if rule['_id'] in seen_ids:
+                    raise ValueError(f"规则ID {rule_id} 重复。")
+                seen_ids.add(rule['_id'])
+            rules.append(rule)
+        except ValueError as e:
+            errors.append(f"#{position}: {e}")
+    return rules, errors
+
+@Client.on_message(filters.command("importrules") & owner_only)
+async def importrules_command(client: Client, message: Message):
+    """
+    从JSON或JSONL文件批量导入转发规则，一次写入数据库。
+    用法: 发送规则文件并以 /importrules [托管用户ID] [dry-run] [upsert] 作为说明，或以此命令回复该文件。
+    指定托管用户ID时，所有规则都导入给该用户，否则使用每条规则中的 user_id。
+    dry-run: 只校验并报告结果，不写入。
+    upsert: 带有 _id 的规则（如 /exportrules 导出的）会替换相同ID的规则，而不是作为新规则插入。
+    """
+    document_message = message if message.document else message.reply_to_message
+    if document_message is None or not document_message.document:
+        await message.reply(
+            "用法: 发送规则文件（JSON数组或JSONL）并以 /importrules [托管用户ID] [dry-run] [upsert] 作为说明，"
+            "或以此命令回复该文件。"
+        )
+        return
+
+    user_id, dry_run, upsert = None, False, False
+    for option in message.command[1:]:
+        if option.lower() in ("dry-run", "dryrun", "--dry-run"):
+            dry_run = True
+        elif option.lower() in ("upsert", "--upsert"):
+            upsert = True
+        else:
+            try:
+                user_id = int(option)
+            except ValueError:
+                await message.reply(f"未知选项 <code>{html.escape(option)}</code>。")
+                return
+
+    if (document_message.document.file_size or 0) > MAX_IMPORT_SIZE:
+        await message.reply(f"文件过大，最大 {MAX_IMPORT_SIZE // (1024 * 1024)} MB。")
+        return
+
+    try:
+        data = await client.download_media(document_message, in_memory=True)
+        entries = _parse_rules_file(bytes(data.getbuffer()))
+        if not entries:
+            await message.reply("文件中没有规则。")
+            return
+
+        rules, errors = await _prepare_rules(entries, user_id, upsert)
+        if errors:
+            shown = "\n".join(html.escape(error) for error in errors[:MAX_IMPORT_ERRORS])
+            more = f"\n……以及另外 {len(errors) - MAX_IMPORT_ERRORS} 个错误" if len(errors) > MAX_IMPORT_ERRORS else ""
+            await message.reply(f"❌ {len(errors)} 条规则无效，未导入任何规则:\n<code>{shown}</code>{more}")
+            return
+
+        counts = await import_forwarding_rules(rules, dry_run=dry_run)
+        if dry_run:
+            await message.reply(
+                f"✔️ 校验通过（dry-run，未写入）: 将插入 {counts['inserted']} 条、替换 {counts['replaced']} 条规则。"
+            )
+        else:
+            await message.reply(f"✅ 已导入: 插入 {counts['inserted']} 条、替换 {counts['replaced']} 条规则。")
+    except ValueError as e:
+        await message.reply(f"无法读取规则文件: {html.escape(str(e))}")
+    except Exception as e:
+        logger.error(f"Error in importrules_command: {e}", exc_info=True)
+        await message.reply(f"发生错误: {e}")
+
+@Client.on_message(filters.command("exportrules") & owner_only)
+async def exportrules_command(client: Client, message: Message):
+    """
+    将转发规则导出为JSONL文件（每行一条规则），可再通过 /importrules 导入。
+    用法: /exportrules [托管用户ID]，省略ID时导出所有用户的规则。
+    """
+    try:
+        user_id = int(message.command[1]) if len(message.command) > 1 else None
+    except ValueError:
+        await message.reply("无效的用户ID。它必须是整数。")
+        return
+
+    try:
+        buffer = io.BytesIO()
+        count = 0
+        async for rule in export_forwarding_rules(user_id):
+            rule['_id'] = str(rule['_id'])
+            buffer.write(json.dumps(rule, ensure_ascii=False, default=str).encode("utf-8") + b"\n")
+            count += 1
+        if not count:
+            await message.reply("没有可导出的转发规则。")
+            return
+
+        buffer.seek(0)
+        file_name = f"rules_{user_id}.jsonl" if user_id is not None else "rules_all.jsonl"
+        await message.reply_document(buffer, file_name=file_name, caption=f"共 {count} 条转发规则。")
+    except Exception as e:
+        logger.error(f"Error in exportrules_command: {e}", exc_info=True)
+        await message.reply(f"发生错误: {e}")
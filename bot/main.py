@@ -1,5 +1,7 @@
 import logging
-from .app import bot_client
+import asyncio
+from .app import bot_client, pool_clients
+from .outbound import outbound
 
 # 导入handlers模块以确保装饰器被执行
 from . import handlers
@@ -28,8 +30,24 @@ class BotService:
             handler_count_in_group = len(group)
             LOGGER.info(f"Group {group_id}: {handler_count_in_group} handlers")
 
+        if pool_clients:
+            await asyncio.gather(*(self._start_pool_bot(client) for client in pool_clients))
+            LOGGER.info(f"Sending with a pool of {len(outbound.bots)} bots.")
+
+    async def _start_pool_bot(self, client):
+        """Starts an extra bot of the sending pool. A bot that fails to start is left out of the pool."""
+        try:
+            await client.start()
+            LOGGER.info(f"Pool bot '{client.me.first_name}' ({client.me.id}) started.")
+        except Exception as e:
+            LOGGER.error(f"Could not start pool bot {client.name}. Sending without it. Error: {e}")
+            outbound.remove_bot(client)
+
     async def stop(self):
-        """Stops the main bot client."""
+        """Stops the main bot client and the pool bots."""
+        for client in pool_clients:
+            if client.is_initialized:
+                await client.stop()
         if self.bot.is_initialized:
             LOGGER.info("Stopping main bot client...")
             await self.bot.stop()
@@ -0,0 +1,292 @@
+import asyncio
+import hashlib
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from pyrogram import Client
+from pyrogram.errors import ChannelInvalid, ChannelPrivate, FloodWait, Forbidden, PeerIdInvalid
+from config import (
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_GROUP_RATE,
+    OUTBOUND_MAX_RETRIES,
+    OUTBOUND_QUEUE_WARN_DEPTH,
+)
+from metrics import registry as metrics
+from .app import bot_client, pool_clients
+
+logger = logging.getLogger(__name__)
+
+# A per-chat worker exits after this many idle seconds and is recreated on demand
+WORKER_IDLE_TIMEOUT = 60
+# A pool bot that may not post in a chat is not assigned to it again for this many seconds
+BOT_EXCLUSION_TTL = 60 * 60
+
+# Errors meaning a bot cannot post in a chat at all, e.g. because it is not a member
+BOT_ACCESS_ERRORS = (Forbidden, PeerIdInvalid, ChannelInvalid, ChannelPrivate)
+
+
+class TokenBucket:
+    """
+    A token bucket that hands out reservations instead of rejecting callers.
+    Each `acquire` takes one token, sleeping until it is available, so concurrent
+    callers are served in the order they arrived.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Takes a token and returns how many seconds to wait before it may be used."""
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        self._tokens -= 1
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.rate
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def _rendezvous_weight(bot_id: str, chat_id: int) -> int:
+    return int.from_bytes(hashlib.blake2b(f"{bot_id}:{chat_id}".encode(), digest_size=8).digest(), "big")
+
+
+class _Bot:
+    """One bot of the sending pool and its global rate limit."""
+
+    __slots__ = ("client", "bot_id", "bucket", "sent")
+
+    def __init__(self, client: Client):
+        self.client = client
+        # Known from the token without starting the client; used as the metrics label
+        self.bot_id = client.bot_token.split(":")[0]
+        self.bucket = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self.sent = 0
+
+
+class _ChatQueue:
+    """Pending sends, rate limiters and worker task of a single destination chat."""
+
+    __slots__ = ("queue", "buckets", "worker", "paused_until", "bots")
+
+    def __init__(self, bots: List[_Bot]):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.buckets: Dict[str, TokenBucket] = {}  # {bot_id: per-chat limit of that bot}
+        self.worker: Optional[asyncio.Task] = None
+        self.paused_until: Dict[str, float] = {}  # {bot_id: end of its FloodWait in this chat}
+        self.bots = bots  # Bots that may send to the chat, preferred first
+
+
+class OutboundScheduler:
+    """
+    Shapes all bot-side sends to stay within Telegram's bot limits.
+    Every destination chat gets its own FIFO queue and worker, so sends to one chat
+    keep their order while a FloodWait on that chat only pauses that chat's worker.
+    With a pool of bots, every group and channel is assigned to one bot by rendezvous hashing,
+    so it keeps getting its messages from the same bot, and a send is taken over by the next
+    bot while the assigned one is held by a FloodWait. Each bot has its own token bucket
+    capping its total send rate across all chats.
+    """
+
+    def __init__(self, clients: List[Client]):
+        self.bots = [_Bot(client) for client in clients]
+        self._chats: Dict[int, _ChatQueue] = {}
+        self._excluded: Dict[Tuple[str, int], float] = {}  # {(bot_id, chat_id): until} for bots without access
+        self.sent = 0
+        self.failed = 0
+
+    @property
+    def primary(self) -> _Bot:
+        return self.bots[0]
+
+    def remove_bot(self, client: Client):
+        """Takes a pool bot out of rotation, e.g. because it failed to start."""
+        self.bots = [self.primary] + [bot for bot in self.bots[1:] if bot.client is not client]
+        for chat in self._chats.values():
+            chat.bots = [bot for bot in chat.bots if bot.client is not client] or [self.primary]
+
+    def _assign(self, chat_id: int) -> List[_Bot]:
+        """The bots that may send to a chat, preferred first."""
+        # Users only receive messages from bots they started, which is the primary bot
+        if chat_id > 0 or len(self.bots) == 1:
+            return [self.primary]
+        now = time.monotonic()
+        bots = [
+            bot for bot in self.bots
+            if bot is self.primary or self._excluded.get((bot.bot_id, chat_id), 0) <= now
+        ]
+        # A stable hash, so every process and restart assigns a chat to the same bot
+        return sorted(bots, key=lambda bot: _rendezvous_weight(bot.bot_id, chat_id), reverse=True)
+
+    def _get_chat(self, chat_id: int) -> _ChatQueue:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = _ChatQueue(self._assign(chat_id))
+            self._chats[chat_id] = chat
+        if chat.worker is None or chat.worker.done():
+            chat.worker = asyncio.create_task(self._run_worker(chat_id, chat))
+        return chat
+
+    def _chat_bucket(self, chat_id: int, chat: _ChatQueue, bot: _Bot) -> TokenBucket:
+        bucket = chat.buckets.get(bot.bot_id)
+        if bucket is None:
+            # Negative IDs are groups and channels, which have a much lower per-chat limit
+            rate = OUTBOUND_GROUP_RATE if chat_id < 0 else OUTBOUND_CHAT_RATE
+            bucket = chat.buckets[bot.bot_id] = TokenBucket(rate, 1)
+        return bucket
+
+    def bot_for(self, chat_id: int) -> Client:
+        """
+        The client that would send to `chat_id` right now: its assigned bot, unless that one is
+        held by a FloodWait. For sends that only one bot can make, such as cached media.
+        """
+        chat = self._chats.get(chat_id)
+        bots = chat.bots if chat is not None else self._assign(chat_id)
+        now = time.monotonic()
+        for bot in bots:
+            if chat is None or chat.paused_until.get(bot.bot_id, 0) <= now:
+                return bot.client
+        return bots[0].client
+
+    async def submit(self, chat_id: int, call: Callable[[Client], Awaitable[Any]],
+                     client: Optional[Client] = None) -> Any:
+        """
+        Queues `call(bot client)` as a send to `chat_id` and waits for its result.
+        The scheduler picks the bot, unless `client` pins the send to one of the pool.
+        `call` may be invoked more than once, possibly with another bot, when a FloodWait forces a retry.
+        Exceptions raised by the send are propagated to the caller.
+        """
+        chat = self._get_chat(chat_id)
+        future = asyncio.get_running_loop().create_future()
+        chat.queue.put_nowait((future, call, client))
+
+        depth = chat.queue.qsize()
+        if depth == OUTBOUND_QUEUE_WARN_DEPTH:
+            logger.warning(f"Outbound queue for chat {chat_id} reached {depth} pending sends.")
+        return await future
+
+    async def send_message(self, chat_id: int, **kwargs) -> Any:
+        """Rate-limited equivalent of `bot_client.send_message`, sent by any bot of the pool."""
+        return await self.submit(chat_id, lambda client: client.send_message(chat_id=chat_id, **kwargs))
+
+    async def _run_worker(self, chat_id: int, chat: _ChatQueue):
+        while True:
+            try:
+                item = await asyncio.wait_for(chat.queue.get(), timeout=WORKER_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if chat.queue.empty():
+                    self._chats.pop(chat_id, None)
+                    return
+                continue
+
+            future, call, client = item
+            if future.cancelled():
+                continue
+            try:
+                result = await self._send_with_backoff(chat_id, chat, call, client)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+
+    def _pick_bot(self, chat: _ChatQueue, client: Optional[Client]) -> Tuple[_Bot, float]:
+        """Returns the bot to send with and how long it is still held by a FloodWait in this chat."""
+        if client is not None:
+            candidates = [bot for bot in self.bots if bot.client is client] or [self.primary]
+        else:
+            candidates = chat.bots
+        now = time.monotonic()
+        for bot in candidates:
+            if chat.paused_until.get(bot.bot_id, 0) <= now:
+                return bot, 0.0
+        bot = min(candidates, key=lambda bot: chat.paused_until.get(bot.bot_id, 0))
+        return bot, chat.paused_until[bot.bot_id] - now
+
+    async def _send_with_backoff(self, chat_id: int, chat: _ChatQueue, call: Callable[[Client], Awaitable[Any]],
+                                 client: Optional[Client]) -> Any:
+        attempt = 0
+        assigned = chat.bots[0]
+        failed_over = False
+        while True:
+            bot, pause = self._pick_bot(chat, client)
+            if pause > 0:
+                await asyncio.sleep(pause)
+            # Counted once per send, however many retries it takes
+            if client is None and bot is not assigned and not failed_over:
+                failed_over = True
+                metrics.bot_failovers.inc(bot.bot_id)
+            await self._chat_bucket(chat_id, chat, bot).acquire()
+            await bot.bucket.acquire()
+            try:
+                result = await call(bot.client)
+            except FloodWait as e:
+                metrics.bot_flood_waits.inc(bot.bot_id)
+                attempt += 1
+                if attempt > OUTBOUND_MAX_RETRIES:
+                    raise
+                wait = float(e.value or 1)
+                chat.paused_until[bot.bot_id] = time.monotonic() + wait
+                logger.warning(
+                    f"FloodWait of {wait}s for bot {bot.bot_id} while sending to chat {chat_id}. "
+                    f"Pausing it in this chat (attempt {attempt}/{OUTBOUND_MAX_RETRIES})."
+                )
+                continue
+            except BOT_ACCESS_ERRORS as e:
+                if bot is self.primary:
+                    raise
+                # The pool bot is probably not a member; the chat goes to the next bot
+                self._excluded[(bot.bot_id, chat_id)] = time.monotonic() + BOT_EXCLUSION_TTL
+                chat.bots = [other for other in chat.bots if other is not bot] or [self.primary]
+                logger.warning(
+                    f"Bot {bot.bot_id} cannot send to chat {chat_id} ({type(e).__name__}). "
+                    f"Not using it for this chat for {BOT_EXCLUSION_TTL}s."
+                )
+                if client is not None:
+                    raise
+                continue
+            bot.sent += 1
+            metrics.bot_sends.inc(bot.bot_id)
+            return result
+
+    def queue_depths(self) -> Dict[int, int]:
+        """Returns the number of pending sends per destination chat."""
+        return {chat_id: chat.queue.qsize() for chat_id, chat in self._chats.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns a snapshot of the scheduler's queues for reporting."""
+        now = time.monotonic()
+        return {
+            "chats": len(self._chats),
+            "pending": sum(chat.queue.qsize() for chat in self._chats.values()),
+            "paused_chats": sum(
+                1 for chat in self._chats.values() if any(until > now for until in chat.paused_until.values())
+            ),
+            "sent": self.sent,
+            "failed": self.failed,
+            "bots": {bot.bot_id: bot.sent for bot in self.bots},
+        }
+
+    def assigned_chats(self) -> Dict[tuple, int]:
+        """Active destination chats by the bot they are currently assigned to, for the metrics."""
+        counts = {(bot.bot_id,): 0 for bot in self.bots}
+        for chat in self._chats.values():
+            counts[(chat.bots[0].bot_id,)] = counts.get((chat.bots[0].bot_id,), 0) + 1
+        return counts
+
+
+# A single scheduler for every send made by the bots on behalf of user clients; the primary bot comes first
+outbound = OutboundScheduler([bot_client, *pool_clients])
+metrics.outbound_queue_depth.set_function(lambda: outbound.stats()["pending"])
+metrics.bot_assigned_chats.set_function(outbound.assigned_chats)
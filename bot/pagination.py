@@ -0,0 +1,42 @@
+from typing import List, Optional, Tuple
+from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from utils.telegram_text import MAX_MESSAGE_LENGTH, truncate_html
+
+# Callback data of the navigation buttons: "<prefix>:n:<last key shown>" reads the page after it,
+# "<prefix>:p:<first key shown>" the page before it. Telegram allows at most 64 bytes.
+NEXT = "n"
+PREVIOUS = "p"
+
+
+def parse_cursor(data: str) -> Tuple[str, Optional[str], Optional[str]]:
+    """Splits the callback data of a navigation button into (prefix, after, before)."""
+    prefix, direction, key = data.rsplit(":", 2)
+    if direction == NEXT:
+        return prefix, key, None
+    return prefix, None, key
+
+
+def render_page(header: str, entries: List[Tuple[str, str]], prefix: str,
+                has_previous: bool, has_next: bool) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """
+    Joins the (key, text) entries of one page below `header` and builds the ⬅️/➡️ keyboard.
+    Entries that would push the message past Telegram's limit are left for the next page, and an
+    entry too long for a page of its own is cut with `truncate_html` (Markdown entries, such as
+    those of /listusers, are always far shorter).
+    """
+    text = header
+    shown = []
+    for key, entry in entries:
+        entry = truncate_html(entry, MAX_MESSAGE_LENGTH - len(header))
+        if shown and len(text) + len(entry) > MAX_MESSAGE_LENGTH:
+            has_next = True
+            break
+        text += entry
+        shown.append(key)
+
+    buttons = []
+    if has_previous and shown:
+        buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"{prefix}:{PREVIOUS}:{shown[0]}"))
+    if has_next and shown:
+        buttons.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"{prefix}:{NEXT}:{shown[-1]}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
@@ -1,29 +1,142 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, InsertOne, ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from config import MONGO_URI
 import logging
-from typing import List, Dict, Any
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional, Tuple
+from database.rule_index import rule_index, parse_digest_options
+from database.rule_filters import parse_rule_filter
+from database.user_directory import user_directory
+from metrics import registry as metrics
 
 logger = logging.getLogger(__name__)
 
+
+class _CommandMetrics(monitoring.CommandListener):
+    """Records the duration of every MongoDB command issued by this process, by command name."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.mongo_latency.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        metrics.mongo_latency.observe(event.duration_micros / 1e6, event.command_name)
+        metrics.mongo_failures.inc(event.command_name)
+
+
 # Initialize database client
 # Use a single client instance throughout the application
-db_client = AsyncIOMotorClient(MONGO_URI)
+db_client = AsyncIOMotorClient(MONGO_URI, event_listeners=[_CommandMetrics()])
 db = db_client.get_database("TeleFwdBot")
 
 # Collections
 managed_users = db.get_collection("managed_users")
 forwarding_rules = db.get_collection("forwarding_rules")
+client_leases = db.get_collection("client_leases")
+outbox = db.get_collection("outbox")
+dedup_keys = db.get_collection("dedup_keys")
+client_sessions = db.get_collection("client_sessions")
+client_peers = db.get_collection("client_peers")
+chat_checkpoints = db.get_collection("chat_checkpoints")
+message_cache = db.get_collection("message_cache")
+
+# Projections: session strings are only read where a client is actually started
+USER_FIELDS = {'_id': 0, 'user_id': 1, 'is_active': 1, 'rules_version': 1, 'session_revoked': 1}
+USER_SESSION_FIELDS = {'_id': 0, 'user_id': 1, 'session_string': 1, 'rules_version': 1}
+
+# Indexes for every query this module runs: {collection: [IndexModel]}
+INDEXES = {
+    managed_users: [
+        IndexModel([('user_id', ASCENDING)], unique=True, name='user_id_unique'),
+        IndexModel([('is_active', ASCENDING), ('user_id', ASCENDING)], name='is_active_user_id'),
+    ],
+    forwarding_rules: [
+        IndexModel([('user_id', ASCENDING), ('_id', ASCENDING)], name='user_id_id'),
+    ],
+    client_leases: [
+        IndexModel([('worker_id', ASCENDING)], name='worker_id'),
+        IndexModel([('expires_at', ASCENDING)], name='expires_at'),
+    ],
+    outbox: [
+        IndexModel([('user_id', ASCENDING), ('next_attempt_at', ASCENDING)], name='user_id_next_attempt_at'),
+    ],
+    client_peers: [
+        IndexModel([('owner_id', ASCENDING), ('peer_id', ASCENDING)], unique=True, name='owner_id_peer_id_unique'),
+        IndexModel([('owner_id', ASCENDING), ('usernames', ASCENDING)], name='owner_id_usernames'),
+        IndexModel([('owner_id', ASCENDING), ('phone_number', ASCENDING)], name='owner_id_phone_number'),
+    ],
+    chat_checkpoints: [
+        IndexModel([('user_id', ASCENDING)], name='user_id'),
+    ],
+}
+
+
+async def ensure_indexes(dedup_ttl: int, message_cache_ttl: int):
+    """
+    Creates the indexes all queries rely on. Safe to run on every startup and from several
+    processes at once: existing indexes with the same definition are left alone.
+    """
+    for collection, indexes in INDEXES.items():
+        try:
+            await collection.create_indexes(indexes)
+        except OperationFailure as e:
+            # E.g. duplicate user_ids from before the unique index existed; queries still work, only slower
+            logger.error(f"Could not create indexes on '{collection.name}'. Error: {e}")
+    await _ensure_ttl_index(dedup_keys, 'created_at', dedup_ttl)
+    await _ensure_ttl_index(message_cache, 'created_at', message_cache_ttl)
+    logger.info("Database indexes are in place.")
+
+
+async def _ensure_ttl_index(collection, field: str, ttl: int):
+    """Creates a TTL index, or updates its expiry if it already exists with a different one."""
+    try:
+        await collection.create_index(field, expireAfterSeconds=ttl)
+    except OperationFailure as e:
+        if e.code not in (85, 86):  # IndexOptionsConflict, IndexKeySpecsConflict
+            raise
+        await db.command('collMod', collection.name, index={'keyPattern': {field: 1}, 'expireAfterSeconds': ttl})
+
+
+async def _find_page(collection, query: Dict[str, Any], key: str, limit: int, after: Any = None,
+                     before: Any = None, projection: Optional[Dict[str, Any]] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    Reads one page of at most `limit` documents ordered by `key`, starting after `after` or ending
+    before `before` (keyset pagination, so a page costs the same no matter how deep it is).
+    Returns the page in ascending order and whether more documents follow in the direction read.
+    """
+    query = dict(query)
+    if before is not None:
+        query[key] = {'$lt': before}
+        order = DESCENDING
+    else:
+        if after is not None:
+            query[key] = {'$gt': after}
+        order = ASCENDING
+    documents = await collection.find(query, projection).sort(key, order).limit(limit + 1).to_list(length=limit + 1)
+    more = len(documents) > limit
+    documents = documents[:limit]
+    if before is not None:
+        documents.reverse()
+    return documents, more
+
 
+# --- Managed Users ---
 
 async def add_managed_user(user_id: int, session_string: str):
     """Adds or updates a managed user in the database."""
     update_data = {
         '$set': {
             'session_string': session_string,
-            'is_active': True
-        }
+            'is_active': True,
+            'session_revoked': False,
+        },
+        '$unset': {'revoked_reason': "", 'revoked_at': ""},
     }
     result = await managed_users.update_one({'user_id': user_id}, update_data, upsert=True)
+    user_directory.update(user_id, {'is_active': True, 'session_revoked': False})
     if result.upserted_id:
         logger.info(f"Successfully added user: {user_id}")
     else:
@@ -31,27 +144,100 @@ async def add_managed_user(user_id: int, session_string: str):
     return await get_user_by_id(user_id)
 
 
+async def _refresh_user_directory() -> List[Dict[str, Any]]:
+    users = await managed_users.find({}, USER_FIELDS).to_list(length=None)
+    user_directory.replace(users)
+    return users
+
+
+async def get_managed_users(refresh: bool = False) -> List[Dict[str, Any]]:
+    """
+    Returns the active managed users (user_id, rules_version; no session strings) from the
+    cached directory. `refresh` forces a fresh read, e.g. to notice writes of other processes.
+    """
+    if refresh or not user_directory.is_fresh():
+        await _refresh_user_directory()
+    return user_directory.active_users()
+
+
 async def get_all_active_users():
-    """Retrieves all active managed users from the database."""
-    return await managed_users.find({'is_active': True}).to_list(length=None)
+    """Retrieves all active managed users with a valid session from the database, including their session strings."""
+    return await managed_users.find(
+        {'is_active': True, 'session_revoked': {'$ne': True}}, USER_SESSION_FIELDS
+    ).to_list(length=None)
+
+
+async def get_sessions(user_ids: List[int]) -> List[Dict[str, Any]]:
+    """Retrieves the session strings of the given active users, for starting their clients."""
+    return await managed_users.find(
+        {'user_id': {'$in': list(user_ids)}, 'is_active': True, 'session_revoked': {'$ne': True}},
+        USER_SESSION_FIELDS,
+    ).to_list(length=None)
+
+
+async def mark_session_revoked(user_id: int, reason: str):
+    """Flags a user whose session Telegram no longer accepts; their client is not started until they log in again."""
+    await managed_users.update_one(
+        {'user_id': user_id},
+        {'$set': {'session_revoked': True, 'revoked_reason': reason, 'revoked_at': datetime.utcnow()}},
+    )
+    if user_directory.get(user_id) is not None:
+        user_directory.update(user_id, {'session_revoked': True})
+    logger.warning(f"Marked the session of user {user_id} as revoked: {reason}")
 
 
 async def get_user_by_id(user_id: int):
-    """Retrieves a single managed user by their ID."""
-    return await managed_users.find_one({'user_id': user_id})
+    """Retrieves a single managed user by their ID, without the session string."""
+    if not user_directory.is_fresh():
+        await _refresh_user_directory()
+    user = user_directory.get(user_id)
+    if user is None:
+        # Possibly added by another process since the last refresh
+        user = await managed_users.find_one({'user_id': user_id}, USER_FIELDS)
+        if user is not None:
+            user_directory.update(user_id, user)
+    return user
+
+
+async def get_managed_users_page(limit: int, after: Optional[int] = None,
+                                 before: Optional[int] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """One page of the active managed users ordered by user_id, read from the database; see `_find_page`."""
+    return await _find_page(managed_users, {'is_active': True}, 'user_id', limit, after, before, USER_FIELDS)
+
+
+async def count_managed_users() -> Dict[str, int]:
+    """Counts the managed users and forwarding rules on the server: {'active', 'revoked', 'inactive', 'rules'}."""
+    counts = {'active': 0, 'revoked': 0, 'inactive': 0}
+    async for row in managed_users.aggregate([
+        {'$group': {
+            '_id': None,
+            'active': {'$sum': {'$cond': [{'$eq': ['$is_active', True]}, 1, 0]}},
+            'revoked': {'$sum': {'$cond': [
+                {'$and': [{'$eq': ['$is_active', True]}, {'$eq': ['$session_revoked', True]}]}, 1, 0
+            ]}},
+            'total': {'$sum': 1},
+        }},
+    ]):
+        counts = {'active': row['active'], 'revoked': row['revoked'], 'inactive': row['total'] - row['active']}
+    counts['rules'] = await forwarding_rules.count_documents({})
+    return counts
 
 
 async def deactivate_user(user_id: int):
-    """Deactivates a managed user and deletes all their forwarding rules."""
+    """Deactivates a managed user and deletes all their forwarding rules and stored client state."""
     # First, delete all associated rules
     await forwarding_rules.delete_many({'user_id': user_id})
+    rule_index.drop_user(user_id)
     logger.info(f"Deleted all forwarding rules for user: {user_id}")
+    await delete_client_state(user_id)
 
     # Then, deactivate the user
     result = await managed_users.update_one(
         {'user_id': user_id},
         {'$set': {'is_active': False}}
     )
+    if user_directory.get(user_id) is not None:
+        user_directory.update(user_id, {'is_active': False})
     if result.modified_count > 0:
         logger.info(f"Deactivated user: {user_id}")
         return True
@@ -61,22 +247,72 @@ async def deactivate_user(user_id: int):
 
 # --- Forwarding Rule Management ---
 
+def validate_rule_config(rule_config: Dict[str, Any]):
+    """Raises ValueError if a rule document could not be routed, e.g. for an invalid regex in its filters."""
+    # Ensure sources and destinations are lists
+    if not isinstance(rule_config.get('source_chats'), list) or not isinstance(rule_config.get('destination_chats'), list):
+        raise ValueError("source_chats and destination_chats must be lists of chat IDs.")
+
+    parse_digest_options(rule_config)
+    parse_rule_filter(rule_config)
+
+
 async def add_forwarding_rule(user_id: int, rule_config: Dict[str, Any]) -> Dict[str, Any]:
     """
     Adds a new forwarding rule for a user.
     A rule is defined by sources, destinations, and optional filters.
     """
     rule_config['user_id'] = user_id
-    
-    # Ensure sources and destinations are lists
-    if not isinstance(rule_config.get('source_chats'), list) or not isinstance(rule_config.get('destination_chats'), list):
-        raise ValueError("source_chats and destination_chats must be lists of chat IDs.")
-
-    # Optional: Add validation for other fields here if needed
+    validate_rule_config(rule_config)
 
     result = await forwarding_rules.insert_one(rule_config)
     logger.info(f"Added new forwarding rule with ID {result.inserted_id} for user {user_id}")
-    return await forwarding_rules.find_one({'_id': result.inserted_id})
+    # insert_one stored the generated _id on rule_config; no need to read the rule back
+    rule = rule_config
+    rule_index.add_rule(user_id, rule)
+    await _bump_rules_version(user_id)
+    return rule
+
+
+async def import_forwarding_rules(rules: List[Dict[str, Any]], dry_run: bool = False) -> Dict[str, int]:
+    """
+    Writes validated rule documents (each with its `user_id`) in one unordered bulk write.
+    Rules with an `_id` replace the stored rule with that ID or are inserted under it; the
+    others are inserted with a new ID. Afterwards the routing index and rules_version of every
+    affected user, including the previous owners of replaced rules, are refreshed once.
+    With `dry_run`, nothing is written. Returns {'inserted': n, 'replaced': n}.
+    """
+    rule_ids = [rule['_id'] for rule in rules if '_id' in rule]
+    previous_owners = {}
+    if rule_ids:
+        async for rule in forwarding_rules.find({'_id': {'$in': rule_ids}}, {'user_id': 1}):
+            previous_owners[rule['_id']] = rule['user_id']
+    counts = {'replaced': len(previous_owners), 'inserted': len(rules) - len(previous_owners)}
+    if dry_run or not rules:
+        return counts
+
+    result = await forwarding_rules.bulk_write([
+        ReplaceOne({'_id': rule['_id']}, rule, upsert=True) if '_id' in rule else InsertOne(rule)
+        for rule in rules
+    ], ordered=False)
+    counts = {'replaced': result.matched_count, 'inserted': result.inserted_count + result.upserted_count}
+
+    affected_users = {rule['user_id'] for rule in rules} | set(previous_owners.values())
+    for user_id in affected_users:
+        if rule_index.is_loaded(user_id):
+            await load_rule_index(user_id)
+        await _bump_rules_version(user_id)
+    logger.info(
+        f"Imported {len(rules)} forwarding rules for {len(affected_users)} users "
+        f"({counts['inserted']} inserted, {counts['replaced']} replaced)."
+    )
+    return counts
+
+
+def export_forwarding_rules(user_id: Optional[int] = None):
+    """Returns a cursor over the forwarding rules of one user, or of all users, ordered by user and ID."""
+    query = {'user_id': user_id} if user_id is not None else {}
+    return forwarding_rules.find(query).sort([('user_id', ASCENDING), ('_id', ASCENDING)])
 
 
 async def get_forwarding_rules_for_user(user_id: int) -> List[Dict[str, Any]]:
@@ -84,19 +320,294 @@ async def get_forwarding_rules_for_user(user_id: int) -> List[Dict[str, Any]]:
     return await forwarding_rules.find({'user_id': user_id}).to_list(length=None)
 
 
+async def get_forwarding_rules_page(user_id: int, limit: int, after: Optional[str] = None,
+                                    before: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """One page of a user's forwarding rules ordered by _id; the cursors are rule IDs. See `_find_page`."""
+    from bson.objectid import ObjectId
+    return await _find_page(
+        forwarding_rules, {'user_id': user_id}, '_id', limit,
+        ObjectId(after) if after else None, ObjectId(before) if before else None,
+    )
+
+
+async def count_rules_per_user(user_ids: List[int]) -> Dict[int, int]:
+    """Returns {user_id: number of forwarding rules} for the given users, counted on the server."""
+    counts = {user_id: 0 for user_id in user_ids}
+    async for row in forwarding_rules.aggregate([
+        {'$match': {'user_id': {'$in': list(user_ids)}}},
+        {'$group': {'_id': '$user_id', 'rules': {'$sum': 1}}},
+    ]):
+        counts[row['_id']] = row['rules']
+    return counts
+
+
+def _non_empty_object(field: str) -> Dict[str, Any]:
+    """Aggregation expression: whether `field` holds an object with at least one key."""
+    return {'$and': [{'$eq': [{'$type': field}, 'object']}, {'$ne': [field, {}]}]}
+
+
+async def summarize_forwarding_rules(user_id: int) -> Dict[str, int]:
+    """
+    Summarizes a user's forwarding rules on the server: {'rules', 'filtered', 'digest', 'sources',
+    'destinations'}, the last two being the number of distinct chats over all rules.
+    """
+    summary = {'rules': 0, 'filtered': 0, 'digest': 0, 'sources': 0, 'destinations': 0}
+    async for row in forwarding_rules.aggregate([
+        {'$match': {'user_id': user_id}},
+        {'$group': {
+            '_id': None,
+            'rules': {'$sum': 1},
+            'filtered': {'$sum': {'$cond': [_non_empty_object('$filters'), 1, 0]}},
+            'digest': {'$sum': {'$cond': [{'$or': [{'$eq': ['$digest', True]}, _non_empty_object('$digest')]}, 1, 0]}},
+            'sources': {'$push': {'$ifNull': ['$source_chats', []]}},
+            'destinations': {'$push': {'$ifNull': ['$destination_chats', []]}},
+        }},
+        {'$project': {
+            'rules': 1,
+            'filtered': 1,
+            'digest': 1,
+            'sources': {'$size': {'$reduce': {
+                'input': '$sources', 'initialValue': [], 'in': {'$setUnion': ['$$value', '$$this']}
+            }}},
+            'destinations': {'$size': {'$reduce': {
+                'input': '$destinations', 'initialValue': [], 'in': {'$setUnion': ['$$value', '$$this']}
+            }}},
+        }},
+    ]):
+        summary = {key: row[key] for key in summary}
+    return summary
+
+
+async def load_rule_index(user_id: int):
+    """Loads a user's forwarding rules from the database into the in-memory routing index."""
+    rules = await get_forwarding_rules_for_user(user_id)
+    rule_index.load(user_id, rules)
+
+
 async def delete_forwarding_rule(rule_id: str) -> bool:
     """Deletes a forwarding rule by its unique _id."""
     from bson.objectid import ObjectId
-    result = await forwarding_rules.delete_one({'_id': ObjectId(rule_id)})
+    rule = await forwarding_rules.find_one_and_delete({'_id': ObjectId(rule_id)}, projection={'user_id': 1})
     
-    if result.deleted_count > 0:
+    if rule is not None:
+        rule_index.remove_rule(rule_id)
+        await _bump_rules_version(rule['user_id'])
         logger.info(f"Deleted forwarding rule with ID: {rule_id}")
         return True
     logger.warning(f"Attempted to delete non-existent rule with ID: {rule_id}")
     return False
 
 
+async def _bump_rules_version(user_id: int):
+    """
+    Marks a user's rules as changed so that other processes running the user's
+    client (in sharded mode) reload their routing index.
+    """
+    user = await managed_users.find_one_and_update(
+        {'user_id': user_id}, {'$inc': {'rules_version': 1}}, projection=USER_FIELDS,
+        return_document=ReturnDocument.AFTER,
+    )
+    if user is not None:
+        user_directory.update(user_id, user)
+
+
 async def get_rule_by_id(rule_id: str) -> Dict[str, Any]:
     """Retrieves a single rule by its unique _id."""
     from bson.objectid import ObjectId
     return await forwarding_rules.find_one({'_id': ObjectId(rule_id)})
+
+
+# --- Client Leases (sharded mode) ---
+
+async def claim_client_lease(user_id: int, worker_id: str, ttl: int) -> bool:
+    """
+    Atomically claims the lease on a user's client for a worker.
+    Succeeds if the lease is free, expired, or already held by this worker.
+    """
+    now = datetime.utcnow()
+    try:
+        await client_leases.update_one(
+            {'_id': user_id, '$or': [{'expires_at': {'$lt': now}}, {'worker_id': worker_id}]},
+            {'$set': {'worker_id': worker_id, 'expires_at': now + timedelta(seconds=ttl), 'heartbeat_at': now}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # The lease exists and is held by another live worker
+        return False
+    return True
+
+
+async def renew_client_leases(worker_id: str, ttl: int) -> List[int]:
+    """Extends all leases held by a worker and returns the user IDs it still holds."""
+    now = datetime.utcnow()
+    await client_leases.update_many(
+        {'worker_id': worker_id},
+        {'$set': {'expires_at': now + timedelta(seconds=ttl), 'heartbeat_at': now}},
+    )
+    leases = await client_leases.find({'worker_id': worker_id}, {'_id': 1}).to_list(length=None)
+    return [lease['_id'] for lease in leases]
+
+
+async def release_client_leases(worker_id: str, user_ids: List[int]):
+    """Gives up a worker's leases so another worker can take them over immediately."""
+    if user_ids:
+        await client_leases.delete_many({'_id': {'$in': list(user_ids)}, 'worker_id': worker_id})
+
+
+async def get_active_client_leases(user_ids: Optional[List[int]] = None) -> Dict[int, Dict[str, Any]]:
+    """
+    Returns {user_id: lease} for every unexpired lease in the fleet (or of the given users only),
+    with the client health its worker reported.
+    """
+    query = {'expires_at': {'$gte': datetime.utcnow()}}
+    if user_ids is not None:
+        query['_id'] = {'$in': list(user_ids)}
+    leases = await client_leases.find(query, {'worker_id': 1, 'expires_at': 1, 'health': 1}).to_list(length=None)
+    return {lease['_id']: lease for lease in leases}
+
+
+async def report_client_health(worker_id: str, health: Dict[int, Dict[str, Any]]):
+    """Stores the supervisor's view of a worker's clients on their leases, for /listusers in the bot process."""
+    if health:
+        await client_leases.bulk_write([
+            UpdateOne({'_id': user_id, 'worker_id': worker_id}, {'$set': {'health': snapshot}})
+            for user_id, snapshot in health.items()
+        ], ordered=False)
+
+
+# --- Outbox ---
+
+async def insert_outbox_entries(documents: List[Dict[str, Any]]):
+    """Inserts new outbox entries in one batch. Entries that already exist are left untouched."""
+    try:
+        await outbox.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        # Duplicate keys are expected: the _id is the delivery's idempotency key
+        errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != 11000]
+        if errors:
+            raise
+
+
+async def update_outbox_entries(documents: List[Dict[str, Any]], upsert: bool = False):
+    """Replaces outbox entries (e.g. after a failed attempt) in one batch."""
+    await outbox.bulk_write(
+        [ReplaceOne({'_id': document['_id']}, document, upsert=upsert) for document in documents],
+        ordered=False,
+    )
+
+
+async def delete_outbox_entries(keys: List[str]):
+    """Removes delivered entries from the outbox."""
+    await outbox.delete_many({'_id': {'$in': keys}})
+
+
+async def get_due_outbox_entries(user_ids: List[int], limit: int = 500) -> List[Dict[str, Any]]:
+    """Returns up to `limit` outbox entries of the given users that are due for another attempt, oldest first."""
+    return await outbox.find({
+        'user_id': {'$in': user_ids},
+        'failed': {'$ne': True},
+        'next_attempt_at': {'$lte': datetime.utcnow()},
+    }).sort('next_attempt_at', ASCENDING).limit(limit).to_list(length=None)
+
+
+# --- Cross-Process Deduplication ---
+# Keys expire through the TTL index created by ensure_indexes()
+
+
+async def claim_dedup_keys(keys: List[str]) -> List[str]:
+    """Inserts the given keys in one batch and returns those that did not exist yet."""
+    now = datetime.utcnow()
+    try:
+        await dedup_keys.insert_many([{'_id': key, 'created_at': now} for key in keys], ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != 11000 for error in errors):
+            raise
+        duplicates = {error['index'] for error in errors}
+        return [key for index, key in enumerate(keys) if index not in duplicates]
+    return keys
+
+
+# --- User Client Session Storage ---
+# Peers and session state of the user clients (see user_clients.storage); the auth key itself
+# stays in the managed user's session string
+
+PEER_FIELDS = {'_id': 0, 'peer_id': 1, 'access_hash': 1, 'type': 1, 'username': 1, 'phone_number': 1, 'updated_at': 1}
+
+
+async def get_client_session(user_id: int) -> Optional[Dict[str, Any]]:
+    """Returns the stored session state (auth key ID, date) of a user client."""
+    return await client_sessions.find_one({'_id': user_id})
+
+
+async def find_client_peer(user_id: int, query: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Returns the most recently updated peer of a user client matching `query`."""
+    return await client_peers.find_one({'owner_id': user_id, **query}, PEER_FIELDS, sort=[('updated_at', -1)])
+
+
+async def save_client_state(peers: List[Dict[str, Any]], sessions: List[Dict[str, Any]]):
+    """Upserts the buffered peers and session states of any number of user clients in one batch each."""
+    if peers:
+        await client_peers.bulk_write([
+            UpdateOne({'owner_id': peer['owner_id'], 'peer_id': peer['peer_id']}, {'$set': peer}, upsert=True)
+            for peer in peers
+        ], ordered=False)
+    if sessions:
+        await client_sessions.bulk_write(
+            [ReplaceOne({'_id': session['_id']}, session, upsert=True) for session in sessions],
+            ordered=False,
+        )
+
+
+async def delete_client_state(user_id: int):
+    """Forgets the stored peers, session state and catch-up checkpoints of a user client."""
+    await client_sessions.delete_one({'_id': user_id})
+    await client_peers.delete_many({'owner_id': user_id})
+    await chat_checkpoints.delete_many({'user_id': user_id})
+
+
+# --- Catch-up Checkpoints ---
+
+async def get_chat_checkpoints(user_id: int) -> Dict[int, int]:
+    """Returns {chat_id: ID of the newest handled message} for a user client."""
+    documents = await chat_checkpoints.find(
+        {'user_id': user_id}, {'_id': 0, 'chat_id': 1, 'message_id': 1}
+    ).to_list(length=None)
+    return {document['chat_id']: document['message_id'] for document in documents}
+
+
+async def save_chat_checkpoints(checkpoints: List[Dict[str, Any]]):
+    """Advances the checkpoints of any number of (user, chat) pairs in one batch; they never move back."""
+    now = datetime.utcnow()
+    await chat_checkpoints.bulk_write([
+        UpdateOne(
+            {'_id': f"{checkpoint['user_id']}:{checkpoint['chat_id']}"},
+            {
+                '$max': {'message_id': checkpoint['message_id']},
+                '$set': {'user_id': checkpoint['user_id'], 'chat_id': checkpoint['chat_id'], 'updated_at': now},
+            },
+            upsert=True,
+        )
+        for checkpoint in checkpoints
+    ], ordered=False)
+
+
+# --- Anti-Revoke Message Cache ---
+# Messages spilled from the in-memory cache (see user_clients.revoke_cache); they expire through
+# the TTL index created by ensure_indexes()
+
+
+async def save_cached_messages(documents: List[Dict[str, Any]]):
+    """Writes spilled messages in one batch; a message spilled twice keeps its latest copy."""
+    await message_cache.bulk_write(
+        [ReplaceOne({'_id': document['_id']}, document, upsert=True) for document in documents],
+        ordered=False,
+    )
+
+
+async def take_cached_messages(keys: List[str]) -> List[Dict[str, Any]]:
+    """Returns and removes the spilled messages with the given keys."""
+    documents = await message_cache.find({'_id': {'$in': keys}}).to_list(length=None)
+    if documents:
+        await message_cache.delete_many({'_id': {'$in': [document['_id'] for document in documents]}})
+    return documents
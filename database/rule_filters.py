@@ -0,0 +1,233 @@
+import re
+from collections import deque
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Pattern
+
+# Content type keys a rule may filter on, in the order the message categories are checked
+# by `_get_message_details` in user_clients.handlers (a captioned photo is a "photo", not "text")
+CONTENT_TYPES = (
+    "text", "photo", "video_note", "video", "document", "audio",
+    "voice", "sticker", "animation", "contact", "location", "venue",
+)
+
+
+def message_content_type(message) -> Optional[str]:
+    """Returns the content type key of a message, or None for anything else."""
+    for content_type in CONTENT_TYPES:
+        if getattr(message, content_type, None):
+            return content_type
+    return None
+
+
+class MessageFeatures:
+    """The properties of a message that rule filters look at, extracted once per message."""
+
+    __slots__ = ("text", "content_type", "sender_id", "is_mention", "_hits", "_hits_matcher")
+
+    def __init__(self, text: str, content_type: Optional[str], sender_id: Optional[int], is_mention: bool):
+        self.text = text
+        self.content_type = content_type
+        self.sender_id = sender_id
+        self.is_mention = is_mention
+        self._hits: FrozenSet[int] = frozenset()
+        self._hits_matcher = None
+
+    def keyword_hits(self, matcher: "KeywordMatcher") -> FrozenSet[int]:
+        """Searches the text once per matcher; every rule filter sharing it reuses the result."""
+        if self._hits_matcher is not matcher:
+            self._hits = matcher.search(self.text)
+            self._hits_matcher = matcher
+        return self._hits
+
+    @classmethod
+    def from_message(cls, message, is_mention: bool) -> "MessageFeatures":
+        sender = message.from_user or getattr(message, "sender_chat", None)
+        return cls(
+            message.text or message.caption or "",
+            message_content_type(message),
+            sender.id if sender else None,
+            is_mention,
+        )
+
+
+class KeywordMatcher:
+    """
+    An Aho-Corasick automaton over the keywords of all rules of a user. One pass over a
+    message's text finds every keyword group (e.g. the keywords of one rule) with a match,
+    no matter how many keywords or rules there are. Matching is case-insensitive.
+    """
+
+    __slots__ = ("_goto", "_fail", "_out")
+
+    def __init__(self, groups: Dict[int, Iterable[str]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        outputs: List[set] = [set()]
+        for group, keywords in groups.items():
+            for keyword in keywords:
+                state = 0
+                for char in keyword.lower():
+                    next_state = self._goto[state].get(char)
+                    if next_state is None:
+                        next_state = len(self._goto)
+                        self._goto[state][char] = next_state
+                        self._goto.append({})
+                        outputs.append(set())
+                    state = next_state
+                if state:
+                    outputs[state].add(group)
+
+        # Breadth-first, so a state's failure target is always complete before the state itself
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                outputs[next_state] |= outputs[self._fail[next_state]]
+                queue.append(next_state)
+        self._out: List[FrozenSet[int]] = [frozenset(output) for output in outputs]
+
+    def search(self, text: str) -> FrozenSet[int]:
+        """Returns the groups with at least one keyword occurring in `text`."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found |= out[state]
+        return frozenset(found)
+
+
+class RuleFilter:
+    """
+    The compiled `filters` of one rule. A message matches if it passes every configured check:
+    mentions, content type, sender, excluded keywords, keywords (any) and regexes (any).
+    Keywords are matched by the shared KeywordMatcher of the rule set, which `attach` wires up.
+    """
+
+    __slots__ = (
+        "mentions", "content_types", "senders", "keywords", "exclude_keywords", "regexes",
+        "matcher", "include_group", "exclude_group",
+    )
+
+    def __init__(self, mentions: Optional[bool], content_types: Optional[FrozenSet[str]],
+                 senders: Optional[FrozenSet[int]], keywords: List[str], exclude_keywords: List[str],
+                 regexes: List[Pattern]):
+        self.mentions = mentions
+        self.content_types = content_types
+        self.senders = senders
+        self.keywords = keywords
+        self.exclude_keywords = exclude_keywords
+        self.regexes = regexes
+        self.matcher: Optional[KeywordMatcher] = None
+        self.include_group: Optional[int] = None
+        self.exclude_group: Optional[int] = None
+
+    def attach(self, matcher: Optional[KeywordMatcher], include_group: Optional[int], exclude_group: Optional[int]):
+        self.matcher = matcher
+        self.include_group = include_group
+        self.exclude_group = exclude_group
+
+    def matches(self, features: MessageFeatures) -> bool:
+        # Cheap set lookups first, text searches last
+        if self.mentions is not None and features.is_mention != self.mentions:
+            return False
+        if self.content_types is not None and features.content_type not in self.content_types:
+            return False
+        if self.senders is not None and features.sender_id not in self.senders:
+            return False
+        if self.include_group is not None or self.exclude_group is not None:
+            hits = features.keyword_hits(self.matcher)
+            if self.exclude_group in hits:
+                return False
+            if self.include_group is not None and self.include_group not in hits:
+                return False
+        if self.regexes and not any(regex.search(features.text) for regex in self.regexes):
+            return False
+        return True
+
+
+def compile_keyword_groups(rule_filters: Iterable[RuleFilter]) -> Optional[KeywordMatcher]:
+    """Builds one KeywordMatcher for the keywords of all given filters and attaches it to them."""
+    rule_filters = list(rule_filters)  # Iterated twice
+    groups = {}
+    for index, rule_filter in enumerate(rule_filters):
+        include_group = exclude_group = None
+        if rule_filter.keywords:
+            include_group = 2 * index
+            groups[include_group] = rule_filter.keywords
+        if rule_filter.exclude_keywords:
+            exclude_group = 2 * index + 1
+            groups[exclude_group] = rule_filter.exclude_keywords
+        rule_filter.attach(None, include_group, exclude_group)
+    if not groups:
+        return None
+    matcher = KeywordMatcher(groups)
+    for rule_filter in rule_filters:
+        rule_filter.matcher = matcher
+    return matcher
+
+
+def _string_list(filters: Dict[str, Any], key: str) -> List[str]:
+    value = filters.get(key, [])
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(f"filters.{key} must be a list of strings.")
+    return value
+
+
+def parse_rule_filter(rule: Dict[str, Any]) -> Optional[RuleFilter]:
+    """
+    Compiles the optional `filters` object of a rule document, e.g.
+    {"keywords": ["sale"], "exclude_keywords": ["spam"], "regex": ["\\\\d{6}"],
+     "content_types": ["text", "photo"], "senders": [12345], "mentions": false}.
+    Returns None for rules without filters and raises ValueError for invalid ones.
+    """
+    filters = rule.get('filters')
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object.")
+    unknown = set(filters) - {'keywords', 'exclude_keywords', 'regex', 'content_types', 'senders', 'mentions'}
+    if unknown:
+        raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}.")
+
+    content_types = None
+    if 'content_types' in filters:
+        content_types = frozenset(_string_list(filters, 'content_types'))
+        invalid = content_types - set(CONTENT_TYPES)
+        if invalid:
+            raise ValueError(
+                f"Unknown content types: {', '.join(sorted(invalid))}. Expected any of: {', '.join(CONTENT_TYPES)}."
+            )
+
+    senders = None
+    if 'senders' in filters:
+        if not isinstance(filters['senders'], list) or not all(isinstance(item, int) for item in filters['senders']):
+            raise ValueError("filters.senders must be a list of user IDs.")
+        senders = frozenset(filters['senders'])
+
+    mentions = filters.get('mentions')
+    if mentions is not None and not isinstance(mentions, bool):
+        raise ValueError("filters.mentions must be true or false.")
+
+    regexes = []
+    for pattern in _string_list(filters, 'regex'):
+        try:
+            regexes.append(re.compile(pattern, re.IGNORECASE))
+        except re.error as e:
+            raise ValueError(f"Invalid regex {pattern!r}: {e}")
+
+    return RuleFilter(
+        mentions,
+        content_types,
+        senders,
+        [keyword for keyword in _string_list(filters, 'keywords') if keyword],
+        [keyword for keyword in _string_list(filters, 'exclude_keywords') if keyword],
+        regexes,
+    )
@@ -0,0 +1,305 @@
+import logging
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Tuple
+from config import DIGEST_DEFAULT_WINDOW, DIGEST_DEFAULT_MAX_ITEMS
+from database.rule_filters import MessageFeatures, RuleFilter, compile_keyword_groups, parse_rule_filter
+
+logger = logging.getLogger(__name__)
+
+# (window in seconds, max items per digest)
+DigestOptions = Tuple[float, int]
+# Rules with filters that apply to a source: ((filter, destinations), ...)
+FilteredRoutes = Tuple[Tuple[RuleFilter, FrozenSet[int]], ...]
+
+
+def parse_digest_options(rule: Dict[str, Any]) -> Optional[DigestOptions]:
+    """
+    Reads the optional `digest` setting of a rule document.
+    `"digest": true` uses the defaults; `"digest": {"window": 60, "max_items": 20}` overrides them.
+    Raises ValueError for invalid settings.
+    """
+    digest = rule.get('digest')
+    if not digest:
+        return None
+    if digest is True:
+        return DIGEST_DEFAULT_WINDOW, DIGEST_DEFAULT_MAX_ITEMS
+    if not isinstance(digest, dict):
+        raise ValueError("digest must be true/false or an object with 'window' and 'max_items'.")
+    unknown = set(digest) - {'window', 'max_items'}
+    if unknown:
+        raise ValueError(f"Unknown digest settings: {', '.join(sorted(unknown))}.")
+    window = digest.get('window', DIGEST_DEFAULT_WINDOW)
+    # bool is an int subclass, but `"window": true` is certainly a mistake
+    if isinstance(window, bool) or not isinstance(window, (int, float)) or not window > 0:
+        raise ValueError("digest.window must be a positive number of seconds.")
+    max_items = digest.get('max_items', DIGEST_DEFAULT_MAX_ITEMS)
+    if isinstance(max_items, bool) or not isinstance(max_items, int) or max_items <= 0:
+        raise ValueError("digest.max_items must be a positive integer.")
+    return float(window), max_items
+
+
+def _merge_digest_options(a: Optional[DigestOptions], b: DigestOptions) -> DigestOptions:
+    """When several digest rules share a destination, the tighter limits win."""
+    if a is None:
+        return b
+    return min(a[0], b[0]), min(a[1], b[1])
+
+
+class CompiledRules:
+    """
+    The routing table of a single managed user, compiled from their rule documents.
+    Maps every explicitly listed source chat to the full set of destinations it routes to,
+    with the destinations of match-all rules (empty `source_chats`) already merged in.
+    Rules with `filters` are kept apart, per source, and only evaluated against the messages
+    of the sources they list. Destinations that only digest rules route to are additionally
+    mapped to their digest options. `sources` holds every chat some rule lists, filtered or not.
+    """
+
+    __slots__ = (
+        "rules", "filters", "digests", "sources", "by_source", "match_all", "filtered_by_source", "filtered_match_all",
+        "digests_by_source", "match_all_digests",
+    )
+
+    def __init__(self, rules: Iterable[Dict[str, Any]]):
+        self.rules: Dict[str, Dict[str, Any]] = {}
+        self.filters: Dict[str, RuleFilter] = {}  # {rule_id: compiled filter}, only for rules with filters
+        self.digests: Dict[str, DigestOptions] = {}  # {rule_id: digest options}, only for digest rules
+        for rule in rules:
+            self._store(rule)
+        self.sources: FrozenSet[int] = frozenset()
+        self.by_source: Dict[int, FrozenSet[int]] = {}
+        self.match_all: FrozenSet[int] = frozenset()
+        self.filtered_by_source: Dict[int, FilteredRoutes] = {}
+        self.filtered_match_all: FilteredRoutes = ()
+        self.digests_by_source: Dict[int, Dict[int, DigestOptions]] = {}
+        self.match_all_digests: Dict[int, DigestOptions] = {}
+        self.compile()
+
+    def _store(self, rule: Dict[str, Any]):
+        """Adds a rule document, compiling its filters and digest options once."""
+        rule_id = str(rule['_id'])
+        self.rules[rule_id] = rule
+        try:
+            rule_filter = parse_rule_filter(rule)
+        except ValueError as e:
+            # Stored before validation existed; a broken filter matches nothing rather than everything
+            logger.error(f"Rule {rule_id} has invalid filters and is ignored: {e}")
+            rule_filter = RuleFilter(None, frozenset(), None, [], [], [])
+        if rule_filter is not None:
+            self.filters[rule_id] = rule_filter
+        try:
+            options = parse_digest_options(rule)
+        except ValueError as e:
+            # Delivering immediately loses nothing, unlike a digest that can never be sent
+            logger.error(f"Rule {rule_id} has invalid digest settings and delivers immediately: {e}")
+            options = None
+        if options is not None:
+            self.digests[rule_id] = options
+
+    def compile(self):
+        """Rebuilds the lookup tables from scratch."""
+        by_source = {}
+        match_all = set()
+        filtered = {}  # {source or None: [(RuleFilter, dests)]}
+        listed_sources = set()
+        # A destination is only digested if every rule routing a source to it asks for a digest
+        digests = {}  # {source or None: {dest: DigestOptions}}
+        immediate = {}  # {source or None: {dest}}
+        for rule_id, rule in self.rules.items():
+            dests = rule.get('destination_chats', [])
+            sources = rule.get('source_chats')
+            options = self.digests.get(rule_id)
+            rule_filter = self.filters.get(rule_id)
+            if sources:
+                listed_sources.update(sources)
+            if rule_filter is not None:
+                for source in sources or [None]:
+                    filtered.setdefault(source, []).append((rule_filter, frozenset(dests)))
+            elif not sources:
+                match_all.update(dests)
+            for source in sources or [None]:
+                if sources and rule_filter is None:
+                    by_source.setdefault(source, set()).update(dests)
+                if options is None:
+                    immediate.setdefault(source, set()).update(dests)
+                    continue
+                source_digests = digests.setdefault(source, {})
+                for dest in dests:
+                    source_digests[dest] = _merge_digest_options(source_digests.get(dest), options)
+
+        self.sources = frozenset(listed_sources)
+        self.match_all = frozenset(match_all)
+        self.by_source = {source: frozenset(dests | match_all) for source, dests in by_source.items()}
+        # One automaton for the keywords of all filtered rules, searched at most once per message
+        compile_keyword_groups(list(self.filters.values()))
+        self.filtered_match_all = tuple(filtered.get(None, ()))
+        self.filtered_by_source = {
+            source: tuple(routes) + self.filtered_match_all for source, routes in filtered.items() if source is not None
+        }
+
+        all_immediate = immediate.get(None, set())
+        all_digests = digests.get(None, {})
+        self.match_all_digests = {
+            dest: options for dest, options in all_digests.items() if dest not in all_immediate
+        }
+        self.digests_by_source = {}
+        for source in listed_sources:
+            source_immediate = all_immediate | immediate.get(source, set())
+            merged = dict(all_digests)
+            for dest, options in digests.get(source, {}).items():
+                merged[dest] = _merge_digest_options(merged.get(dest), options)
+            source_digests = {dest: options for dest, options in merged.items() if dest not in source_immediate}
+            if source_digests or self.match_all_digests:
+                # Also stored when empty, so a listed source does not fall back to match_all_digests
+                self.digests_by_source[source] = source_digests
+
+    def add(self, rule: Dict[str, Any]):
+        """Patches the lookup tables with a single new rule without a full rebuild."""
+        self._store(rule)
+        rule_id = str(rule['_id'])
+        if (rule_id in self.filters or rule_id in self.digests
+                or self.match_all_digests or self.digests_by_source):
+            # Filters and digest settings interact across rules, so they always take the full rebuild
+            self.compile()
+            return
+        dests = frozenset(rule.get('destination_chats', []))
+        sources = rule.get('source_chats')
+        if not sources:
+            self.match_all |= dests
+            self.by_source = {source: existing | dests for source, existing in self.by_source.items()}
+            return
+        self.sources |= frozenset(sources)
+        for source in sources:
+            self.by_source[source] = self.by_source.get(source, self.match_all) | dests
+
+    def remove(self, rule_id: str) -> bool:
+        """Removes a rule. Set unions cannot be subtracted, so the tables are rebuilt."""
+        if self.rules.pop(rule_id, None) is None:
+            return False
+        self.filters.pop(rule_id, None)
+        self.digests.pop(rule_id, None)
+        self.compile()
+        return True
+
+    def route(self, source_chat_id: int, features: Optional[MessageFeatures] = None) -> FrozenSet[int]:
+        """
+        Returns the destinations for a message from `source_chat_id`.
+        Rules with filters only contribute if `features` are given and pass their filter.
+        """
+        dests = self.by_source.get(source_chat_id, self.match_all)
+        candidates = self.filtered_by_source.get(source_chat_id, self.filtered_match_all)
+        if not candidates or features is None:
+            return dests
+        matched = None
+        for rule_filter, rule_dests in candidates:
+            # Skip evaluating filters whose destinations are all routed already
+            if rule_dests <= (matched or dests) or not rule_filter.matches(features):
+                continue
+            matched = (matched or set(dests)) | rule_dests
+        return frozenset(matched) if matched is not None else dests
+
+    def covers(self, source_chat_id: int) -> bool:
+        """Whether any rule applies to `source_chat_id`, even if its filters rejected a message."""
+        return bool(
+            source_chat_id in self.by_source or self.match_all
+            or source_chat_id in self.filtered_by_source or self.filtered_match_all
+        )
+
+    def routes_unlisted(self) -> bool:
+        """Whether match-all rules route messages from chats that no rule lists."""
+        return bool(self.match_all or self.filtered_match_all)
+
+    def digest_route(self, source_chat_id: int) -> Dict[int, DigestOptions]:
+        """Returns the destinations that receive messages from `source_chat_id` as digests."""
+        return self.digests_by_source.get(source_chat_id, self.match_all_digests)
+
+
+class RuleIndex:
+    """
+    In-memory routing index of all managed users' forwarding rules.
+    It is loaded once per user when their client starts and kept in sync by the
+    rule write paths in `database.manager`, so routing a message needs no database I/O.
+    """
+
+    def __init__(self):
+        self._users: Dict[int, CompiledRules] = {}  # {user_id: CompiledRules}
+        self._rule_owners: Dict[str, int] = {}  # {rule_id: user_id}
+
+    def load(self, user_id: int, rules: Iterable[Dict[str, Any]]):
+        """Compiles and stores the full rule set of a user, replacing any previous one."""
+        self.drop_user(user_id)
+        compiled = CompiledRules(rules)
+        self._users[user_id] = compiled
+        for rule_id in compiled.rules:
+            self._rule_owners[rule_id] = user_id
+        logger.info(
+            f"Compiled {len(compiled.rules)} forwarding rules for user {user_id} "
+            f"({len(compiled.by_source)} source chats, {len(compiled.match_all)} match-all destinations)."
+        )
+
+    def is_loaded(self, user_id: int) -> bool:
+        return user_id in self._users
+
+    def route(self, user_id: int, source_chat_id: int,
+              features: Optional[MessageFeatures] = None) -> Optional[FrozenSet[int]]:
+        """
+        Returns the destinations for a message, or None if the user's rules are not loaded.
+        An empty set means no rule matched.
+        """
+        compiled = self._users.get(user_id)
+        if compiled is None:
+            return None
+        return compiled.route(source_chat_id, features)
+
+    def covers(self, user_id: int, source_chat_id: int) -> bool:
+        """Whether any of the user's rules applies to the source chat."""
+        compiled = self._users.get(user_id)
+        return compiled is not None and compiled.covers(source_chat_id)
+
+    def is_source(self, user_id: int, chat_id: int) -> bool:
+        """Whether one of the user's rules lists the chat as a source. A single set lookup."""
+        compiled = self._users.get(user_id)
+        return compiled is not None and chat_id in compiled.sources
+
+    def routes_unlisted(self, user_id: int) -> bool:
+        """
+        Whether the user has match-all rules. True while the user's rules are not loaded,
+        as that is not known yet.
+        """
+        compiled = self._users.get(user_id)
+        return compiled is None or compiled.routes_unlisted()
+
+    def digest_route(self, user_id: int, source_chat_id: int) -> Dict[int, DigestOptions]:
+        """Returns {destination: digest options} for destinations that digest this source."""
+        compiled = self._users.get(user_id)
+        if compiled is None:
+            return {}
+        return compiled.digest_route(source_chat_id)
+
+    def add_rule(self, user_id: int, rule: Dict[str, Any]):
+        """Adds a freshly inserted rule. Users whose rules are not loaded are left alone."""
+        compiled = self._users.get(user_id)
+        if compiled is None:
+            return
+        compiled.add(rule)
+        self._rule_owners[str(rule['_id'])] = user_id
+
+    def remove_rule(self, rule_id: str):
+        """Removes a deleted rule from whichever user owns it."""
+        user_id = self._rule_owners.pop(str(rule_id), None)
+        if user_id is None:
+            return
+        compiled = self._users.get(user_id)
+        if compiled is not None:
+            compiled.remove(str(rule_id))
+
+    def drop_user(self, user_id: int):
+        """Forgets a user's compiled rules entirely."""
+        compiled = self._users.pop(user_id, None)
+        if compiled is None:
+            return
+        for rule_id in compiled.rules:
+            self._rule_owners.pop(rule_id, None)
+
+
+# A single index shared by the database layer and all user clients
+rule_index = RuleIndex()
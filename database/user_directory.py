@@ -0,0 +1,46 @@
+import time
+from typing import Any, Dict, Iterable, List, Optional
+from config import USER_DIRECTORY_TTL
+
+
+class UserDirectory:
+    """
+    In-process cache of the managed users, without their session strings.
+    It is refreshed from the database when older than `ttl` seconds (other processes may
+    have written in the meantime) and patched by the user write paths in `database.manager`,
+    so lookups such as "is this a managed user?" need no database round trip.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._users: Dict[int, Dict[str, Any]] = {}  # {user_id: user document}
+        self._loaded_at: Optional[float] = None
+
+    def is_fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def replace(self, users: Iterable[Dict[str, Any]]):
+        """Replaces the whole directory with a fresh listing from the database."""
+        self._users = {user['user_id']: user for user in users}
+        self._loaded_at = time.monotonic()
+
+    def update(self, user_id: int, fields: Dict[str, Any]):
+        """Applies a write to a single user, creating the entry if needed."""
+        user = self._users.setdefault(user_id, {'user_id': user_id})
+        user.update(fields)
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self._users.get(user_id)
+
+    def active_users(self) -> List[Dict[str, Any]]:
+        return sorted(
+            (user for user in self._users.values() if user.get('is_active')),
+            key=lambda user: user['user_id'],
+        )
+
+    def invalidate(self):
+        self._loaded_at = None
+
+
+# Shared by the bot handlers, the user client manager and the shard worker
+user_directory = UserDirectory(USER_DIRECTORY_TTL)
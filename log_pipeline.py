@@ -0,0 +1,152 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Iterable, List, Optional
+from metrics import registry as metrics
+
+# Attributes every LogRecord has; anything else was passed through `extra=` and is a structured field
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Formats records as `key=value` pairs, e.g.
+    time=2024-01-01T12:00:00 level=INFO logger=user_clients.handlers msg="Received message" user_id=1
+    Fields passed with `extra=` are appended after the message.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                fields[key] = value
+        line = " ".join(f"{key}={self._quote(value)}" for key, value in fields.items())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+    @staticmethod
+    def _quote(value) -> str:
+        text = str(value)
+        if not text or any(char in text for char in ' ="\n'):
+            return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        return text
+
+
+class HotPathFilter(logging.Filter):
+    """
+    Throttles the per-message INFO/DEBUG lines of the hot-path loggers; warnings and errors always pass.
+    In "sample" mode at most `rate` records per second and logger are written, in "count" mode
+    none are. Suppressed records are counted by logger and message template and reported in a
+    summary line every `summary_interval` seconds.
+    """
+
+    def __init__(self, loggers: Iterable[str], mode: str, rate: float, summary_interval: float):
+        super().__init__()
+        self.loggers = tuple(loggers)
+        self.mode = mode
+        self.rate = rate
+        self.summary_interval = summary_interval
+        self._lock = threading.Lock()
+        self._allowance: Dict[str, List[float]] = {}  # {logger: [tokens, updated]}
+        self._suppressed: Counter = Counter()  # {(logger, template): count} since the last summary
+        self.suppressed_total: Counter = Counter()  # {logger: count}
+        self._last_summary = time.monotonic()
+
+    def _is_hot_path(self, record: logging.LogRecord) -> bool:
+        return record.levelno < logging.WARNING and record.name.startswith(self.loggers)
+
+    def _take_token(self, name: str, now: float) -> bool:
+        allowance = self._allowance.get(name)
+        if allowance is None:
+            allowance = self._allowance[name] = [self.rate, now]
+        allowance[0] = min(self.rate, allowance[0] + (now - allowance[1]) * self.rate)
+        allowance[1] = now
+        if allowance[0] >= 1:
+            allowance[0] -= 1
+            return True
+        return False
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.mode == "all" or getattr(record, "_summary", False) or not self._is_hot_path(record):
+            return True
+        now = time.monotonic()
+        with self._lock:
+            allowed = self.mode == "sample" and self._take_token(record.name, now)
+            if not allowed:
+                # The unformatted template aggregates all records of one log call
+                self._suppressed[(record.name, str(record.msg))] += 1
+                self.suppressed_total[record.name] += 1
+            summary_due = now - self._last_summary >= self.summary_interval
+        if summary_due:
+            self.emit_summary()
+        return allowed
+
+    def emit_summary(self):
+        """Logs the suppressed-record counts collected since the previous summary."""
+        with self._lock:
+            suppressed, self._suppressed = self._suppressed, Counter()
+            elapsed = time.monotonic() - self._last_summary
+            self._last_summary = time.monotonic()
+        if not suppressed:
+            return
+        lines = [f"Hot-path log summary ({self.mode} mode, last {elapsed:.0f}s, {sum(suppressed.values())} lines not written):"]
+        for (name, template), count in suppressed.most_common():
+            lines.append(f"  {count:>8} x {name}: {template}")
+        logging.getLogger(__name__).info("\n".join(lines), extra={"_summary": True})
+
+
+class LogPipeline:
+    """
+    Moves log I/O off the event loop: every logger writes into an in-memory queue through a
+    single QueueHandler, and a background QueueListener thread formats and writes the records
+    to the real handlers (file, console).
+    """
+
+    def __init__(self):
+        self.queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+        self.listener: Optional[QueueListener] = None
+        self.hot_path_filter: Optional[HotPathFilter] = None
+
+    def start(self, handlers: List[logging.Handler], level: int, hot_path_filter: Optional[HotPathFilter] = None):
+        queue_handler = QueueHandler(self.queue)
+        if hot_path_filter is not None:
+            # Filtering before the queue means dropped records cost no I/O or formatting at all
+            queue_handler.addFilter(hot_path_filter)
+        self.hot_path_filter = hot_path_filter
+
+        root_logger = logging.getLogger()
+        root_logger.setLevel(level)
+        root_logger.addHandler(queue_handler)
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """Writes out the final summary and everything still queued, then stops the writer thread."""
+        if self.listener is None:
+            return
+        if self.hot_path_filter is not None:
+            self.hot_path_filter.emit_summary()
+        self.listener.stop()
+        self.listener = None
+
+    def suppressed_counts(self) -> Dict[str, int]:
+        if self.hot_path_filter is None:
+            return {}
+        return dict(self.hot_path_filter.suppressed_total)
+
+
+log_pipeline = LogPipeline()
+metrics.log_records_suppressed.set_function(
+    lambda: {(name,): count for name, count in log_pipeline.suppressed_counts().items()}
+)
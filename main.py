@@ -6,11 +6,31 @@ import uvloop
 from logging.handlers import TimedRotatingFileHandler
 from bot.main import bot_service
 from user_clients.manager import user_client_manager
-from database.manager import db_client
-from config import LOG_LEVEL
+from user_clients.sharding import shard_worker
+from user_clients.handlers import outbox, catch_up, revoke_cache, drain
+from user_clients.storage import session_writer
+from metrics.server import metrics_server
+from database.manager import db_client, ensure_indexes
+from log_pipeline import log_pipeline, HotPathFilter, KeyValueFormatter
+from config import (
+    LOG_LEVEL,
+    LOG_FORMAT,
+    LOG_HOT_PATH,
+    LOG_HOT_PATH_RATE,
+    LOG_HOT_PATH_LOGGERS,
+    LOG_SUMMARY_INTERVAL,
+    RUN_MODE,
+    WORKER_ID,
+    DEDUP_TTL,
+    ANTI_REVOKE_TTL,
+    SHUTDOWN_DRAIN_TIMEOUT,
+)
 
 # Setup logging with rotation
-log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+if LOG_FORMAT == "kv":
+    log_formatter = KeyValueFormatter()
+else:
+    log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 log_file = "logs/app.log"
 
 # Use TimedRotatingFileHandler to rotate logs daily and keep 3 days of backups
@@ -24,11 +44,13 @@ stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(log_formatter)
 
 log_level = getattr(logging, LOG_LEVEL, logging.INFO)
-# Configure root logger with log level from environment variable
-root_logger = logging.getLogger()
-root_logger.setLevel(log_level)
-root_logger.addHandler(file_handler)
-root_logger.addHandler(stream_handler)
+# Configure root logger with log level from environment variable. Records are handed to a
+# background thread that does the formatting and disk I/O, so the event loop never blocks on it.
+log_pipeline.start(
+    [file_handler, stream_handler],
+    log_level,
+    HotPathFilter(LOG_HOT_PATH_LOGGERS, LOG_HOT_PATH, LOG_HOT_PATH_RATE, LOG_SUMMARY_INTERVAL),
+)
 
 logging.getLogger("pyrogram").setLevel(log_level)  # Reduce pyrogram's verbosity
 LOGGER = logging.getLogger(__name__)
@@ -40,14 +62,34 @@ async def main():
     """
     The main function to initialize and start all services concurrently.
     """
-    LOGGER.info("Starting application and services...")
+    LOGGER.info(f"Starting application and services in '{RUN_MODE}' mode...")
     
     try:
+        await metrics_server.start()
+        await ensure_indexes(DEDUP_TTL, ANTI_REVOKE_TTL)
+        if RUN_MODE != "bot":
+            # Resumes deliveries persisted by a previous run
+            await outbox.start()
+            await session_writer.start()
+            await catch_up.start()
+            await revoke_cache.start()
+            await user_client_manager.supervisor.start()
+
         # Using asyncio.gather to run bot and user clients concurrently
-        await asyncio.gather(
-            bot_service.start(),
-            user_client_manager.start_all_from_db()
-        )
+        if RUN_MODE == "all":
+            await asyncio.gather(
+                bot_service.start(),
+                user_client_manager.start_all_from_db()
+            )
+        elif RUN_MODE == "bot":
+            # User clients are run by worker processes
+            await bot_service.start()
+        else:
+            LOGGER.info(f"Running as shard worker '{WORKER_ID}'.")
+            await asyncio.gather(
+                bot_service.start(),
+                shard_worker.start()
+            )
         LOGGER.info("All services are running. Press Ctrl+C to stop.")
         # Keep the main coroutine alive to handle signals
         await idle()
@@ -63,6 +105,23 @@ async def shutdown(sig):
     """
     LOGGER.info(f"Received exit signal {sig.name}... Shutting down.")
 
+    if RUN_MODE != "bot":
+        # No restarts and no new updates from here on; deliveries in progress get a deadline to finish
+        LOGGER.info(f"Draining in-flight deliveries (at most {SHUTDOWN_DRAIN_TIMEOUT:.0f}s)...")
+        await user_client_manager.supervisor.stop()
+        await drain(SHUTDOWN_DRAIN_TIMEOUT)
+
+        # Persisted before anything is cancelled, so no write is cut off halfway
+        LOGGER.info("Persisting undelivered outbox entries...")
+        try:
+            await outbox.stop()
+            await session_writer.stop()
+            await catch_up.stop()
+            await revoke_cache.stop()
+        except Exception as e:
+            # The clients must still be stopped
+            LOGGER.error(f"Could not persist all state before stopping. Error: {e}", exc_info=True)
+
     current_task = asyncio.current_task()
     tasks = [task for task in asyncio.all_tasks() if task is not current_task]
 
@@ -75,11 +134,24 @@ async def shutdown(sig):
         LOGGER.info("All outstanding tasks have been cancelled.")
 
     LOGGER.info("Stopping user clients...")
-    await user_client_manager.stop_all()
+    if RUN_MODE == "worker":
+        # Hand the leases back so other workers take over without waiting for expiry
+        await shard_worker.stop()
+    else:
+        await user_client_manager.stop_all()
+
+    if RUN_MODE != "bot":
+        # Deliveries that completed after outbox.stop() must not be resumed on the next start
+        try:
+            await outbox.flush()
+        except Exception as e:
+            LOGGER.error(f"Could not record the last completed deliveries. Error: {e}")
 
     LOGGER.info("Stopping bot...")
     await bot_service.stop()
 
+    await metrics_server.stop()
+
     LOGGER.info("Closing database connection...")
     db_client.close()
 
@@ -114,3 +186,5 @@ if __name__ == "__main__":
         if not loop.is_closed():
             loop.close()
         LOGGER.info("Application shut down gracefully.")
+        # Flush the remaining records to disk
+        log_pipeline.stop()
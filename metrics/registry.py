@@ -0,0 +1,223 @@
+import math
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+# Label values of one time series, in the order of the metric's label names
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """Base class of all metric types: a name, a help text and optional label names."""
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Updates may come from pymongo's monitoring threads as well as the event loop
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Tuple) -> LabelValues:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {labels}.")
+        return tuple(str(label) for label in labels)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A monotonically increasing count, e.g. messages received."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(_Metric):
+    """Counts observations (e.g. latencies in seconds) in cumulative buckets."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: Iterable[float] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values: Dict[LabelValues, List[float]] = {}  # {labels: [bucket counts..., sum]}
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 1)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-1] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, list(series)) for key, series in self._values.items())
+        lines = []
+        for key, series in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """
+    A gauge or counter whose value is read from the owning component at scrape time,
+    e.g. the number of running clients. The callback returns a single number, or
+    {label values: number} for labelled metrics.
+    """
+
+    def __init__(self, name: str, documentation: str, type_name: str = "gauge", labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.type_name = type_name
+        self._callback: Callable[[], Union[float, Dict[LabelValues, float]]] = None
+
+    def set_function(self, callback: Callable[[], Union[float, Dict[LabelValues, float]]]):
+        self._callback = callback
+
+    def _samples(self) -> List[str]:
+        if self._callback is None:
+            return []
+        result = self._callback()
+        if not isinstance(result, dict):
+            result = {(): result}
+        return [
+            f"{self.name}{_format_labels(self.labelnames, self._key(key))} {_format_value(value)}"
+            for key, value in sorted(result.items())
+        ]
+
+
+class Registry:
+    """Holds all metrics of the process and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# Bucket bounds in seconds
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900)
+DB_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+# --- Forwarding pipeline, per managed user ---
+messages_received = registry.register(Counter(
+    "forwarder_messages_received_total", "Messages received by the forwarding handler.", ["user_id"]))
+rules_matched = registry.register(Counter(
+    "forwarder_rules_matched_total", "Messages that matched at least one forwarding rule.", ["user_id"]))
+notifications_sent = registry.register(Counter(
+    "forwarder_notifications_sent_total", "Notifications (including digests) sent to destinations.", ["user_id"]))
+forwards_done = registry.register(Counter(
+    "forwarder_forwards_total", "Media messages and albums forwarded to destinations.", ["user_id"]))
+delivery_failures = registry.register(Counter(
+    "forwarder_delivery_failures_total", "Failed delivery attempts by exception type.", ["user_id", "exception"]))
+revoked_messages = registry.register(Counter(
+    "forwarder_revoked_messages_total", "Deleted messages whose cached content was sent to destinations.", ["user_id"]))
+delivery_latency = registry.register(Histogram(
+    "forwarder_delivery_latency_seconds", "Time from the source message's date until its delivery completed.",
+    buckets=LATENCY_BUCKETS))
+
+# --- Process state, read at scrape time ---
+running_clients = registry.register(CallbackMetric(
+    "forwarder_running_clients", "User clients currently running in this process."))
+client_states = registry.register(CallbackMetric(
+    "forwarder_client_states", "User clients known to this process's supervisor, by state.", labelnames=["state"]))
+client_restarts = registry.register(Counter(
+    "forwarder_client_restarts_total", "Restarts of failed user clients by the supervisor.", ["user_id"]))
+outbound_queue_depth = registry.register(CallbackMetric(
+    "forwarder_outbound_queue_depth", "Bot API calls waiting in the outbound scheduler."))
+bot_assigned_chats = registry.register(CallbackMetric(
+    "forwarder_bot_assigned_chats", "Active destination chats by the pool bot they are assigned to.",
+    labelnames=["bot"]))
+outbox_pending = registry.register(CallbackMetric(
+    "forwarder_outbox_pending", "Undelivered outbox entries known to this process."))
+revoke_cache_bytes = registry.register(CallbackMetric(
+    "forwarder_revoke_cache_bytes", "Estimated memory held by the anti-revoke message cache."))
+dedup_lookups = registry.register(CallbackMetric(
+    "forwarder_dedup_lookups_total", "Cross-account dedup lookups by result.", "counter", ["result"]))
+
+# --- Bot pool ---
+bot_sends = registry.register(Counter(
+    "forwarder_bot_sends_total", "Successful Bot API sends by bot.", ["bot"]))
+bot_flood_waits = registry.register(Counter(
+    "forwarder_bot_flood_waits_total", "FloodWaits received by bot.", ["bot"]))
+bot_failovers = registry.register(Counter(
+    "forwarder_bot_failovers_total", "Sends handed to a bot other than the chat's assigned one.", ["bot"]))
+
+# --- Logging ---
+log_records_suppressed = registry.register(CallbackMetric(
+    "forwarder_log_records_suppressed_total", "Hot-path log records sampled out or aggregated into counters.",
+    "counter", ["logger"]))
+
+# --- MongoDB ---
+mongo_latency = registry.register(Histogram(
+    "forwarder_mongo_command_seconds", "Duration of MongoDB commands.", ["command"], buckets=DB_LATENCY_BUCKETS))
+mongo_failures = registry.register(Counter(
+    "forwarder_mongo_command_failures_total", "Failed MongoDB commands.", ["command"]))
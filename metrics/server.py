@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from typing import Optional
+from config import METRICS_HOST, METRICS_PORT
+from metrics.registry import registry
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsServer:
+    """
+    A minimal HTTP server exposing the registry on GET /metrics for Prometheus to scrape.
+    It runs on the application's event loop and needs no extra dependencies.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        if not self.port:
+            logger.info("Metrics endpoint disabled (METRICS_PORT=0).")
+            return
+        try:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        except OSError as e:
+            # E.g. another process on this host already uses the port; forwarding matters more than metrics
+            logger.warning(
+                f"Could not serve metrics on {self.host}:{self.port} ({e}). Running without the metrics endpoint; "
+                f"give each process on this host its own METRICS_PORT."
+            )
+            return
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Headers are not needed, but must be consumed before answering
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Failed to serve a metrics request: {e}")
+        finally:
+            writer.close()
+
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
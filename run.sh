@@ -75,9 +75,9 @@ stop() {
     # 发送SIGTERM信号
     kill "$pid" 2>/dev/null
     
-    # 等待进程结束
+    # 等待进程结束 (进行中的转发最多有 SHUTDOWN_DRAIN_TIMEOUT 秒完成，之后并发停止所有用户客户端)
     local count=0
-    while kill -0 "$pid" 2>/dev/null && [ $count -lt 10 ]; do
+    while kill -0 "$pid" 2>/dev/null && [ $count -lt 30 ]; do
         sleep 1
         count=$((count + 1))
     done
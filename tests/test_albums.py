@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from user_clients import albums
+from user_clients.albums import AlbumAggregator
+
+CLIENT = SimpleNamespace(me=SimpleNamespace(id=1))
+
+
+def part(message_id, group="g1", chat_id=-100):
+    return SimpleNamespace(id=message_id, chat=SimpleNamespace(id=chat_id), media_group_id=group)
+
+
+@pytest.fixture(autouse=True)
+def short_windows(monkeypatch):
+    monkeypatch.setattr(albums, "ALBUM_WINDOW", 0.05)
+    monkeypatch.setattr(albums, "ALBUM_MAX_DELAY", 0.2)
+
+
+def collect():
+    delivered = []
+
+    async def on_album(client, messages):
+        delivered.append([message.id for message in messages])
+
+    return AlbumAggregator(on_album), delivered
+
+
+def test_parts_are_delivered_once_in_message_order():
+    async def scenario():
+        aggregator, delivered = collect()
+        for message_id in (3, 1, 2):
+            aggregator.add(CLIENT, part(message_id))
+        await asyncio.sleep(0.02)
+        assert delivered == []
+        await asyncio.sleep(0.1)
+        return aggregator, delivered
+
+    aggregator, delivered = asyncio.run(scenario())
+    assert delivered == [[1, 2, 3]]
+    assert aggregator.pending_count() == 0
+
+
+def test_window_restarts_with_each_part_up_to_the_max_delay():
+    async def scenario():
+        aggregator, delivered = collect()
+        started = asyncio.get_running_loop().time()
+        message_id = 0
+        # A part every 30 ms keeps the 50 ms window open, but not past the 200 ms cap
+        while not delivered:
+            message_id += 1
+            aggregator.add(CLIENT, part(message_id))
+            await asyncio.sleep(0.03)
+        return asyncio.get_running_loop().time() - started, delivered
+
+    elapsed, delivered = asyncio.run(scenario())
+    assert 0.15 <= elapsed < 0.4
+    assert len(delivered) == 1 and len(delivered[0]) >= 5
+
+
+def test_full_album_is_delivered_immediately():
+    async def scenario():
+        aggregator, delivered = collect()
+        for message_id in range(albums.ALBUM_MAX_PARTS):
+            aggregator.add(CLIENT, part(message_id))
+        await asyncio.sleep(0)
+        return delivered
+
+    assert asyncio.run(scenario()) == [list(range(albums.ALBUM_MAX_PARTS))]
+
+
+def test_oldest_album_is_flushed_when_too_many_are_pending(monkeypatch):
+    monkeypatch.setattr(albums, "ALBUM_MAX_PENDING", 2)
+
+    async def scenario():
+        aggregator, delivered = collect()
+        aggregator.add(CLIENT, part(1, "a"))
+        aggregator.add(CLIENT, part(2, "b"))
+        aggregator.add(CLIENT, part(3, "c"))
+        await asyncio.sleep(0)
+        assert delivered == [[1]]
+        aggregator.flush_all()
+        await asyncio.sleep(0)
+        return aggregator, delivered
+
+    aggregator, delivered = asyncio.run(scenario())
+    assert delivered == [[1], [2], [3]]
+    assert aggregator.pending_count() == 0 and aggregator.in_flight_count() == 0
+
+
+def test_albums_of_different_chats_are_kept_apart():
+    async def scenario():
+        aggregator, delivered = collect()
+        aggregator.add(CLIENT, part(1, chat_id=-100))
+        aggregator.add(CLIENT, part(2, chat_id=-200))
+        aggregator.flush_all()
+        await asyncio.sleep(0)
+        return delivered
+
+    assert sorted(asyncio.run(scenario())) == [[1], [2]]
@@ -0,0 +1,28 @@
+from benchmarks.run import compare
+
+
+def result(name, throughput=1000.0, bot_calls=1.0, p99_ms=2.0):
+    return {"name": name, "throughput": throughput, "p99_ms": p99_ms, "bot_calls_per_message": bot_calls}
+
+
+BASELINE = {"created": "2026-01-01 00:00:00", "results": [result("a"), result("b")]}
+
+
+def test_compare_accepts_changes_within_the_tolerance(capsys):
+    assert compare([result("a", throughput=900), result("b", throughput=1200)], BASELINE, 0.15)
+    assert "REGRESSION" not in capsys.readouterr().out
+
+
+def test_compare_fails_on_a_throughput_drop(capsys):
+    assert not compare([result("a", throughput=800), result("b")], BASELINE, 0.15)
+    assert capsys.readouterr().out.count("REGRESSION") == 1
+
+
+def test_compare_fails_on_more_bot_calls():
+    assert not compare([result("a", throughput=2000, bot_calls=1.5)], BASELINE, 0.15)
+
+
+def test_compare_skips_new_scenarios_but_needs_one_match(capsys):
+    assert compare([result("a"), result("new")], BASELINE, 0.15)
+    assert "new" in capsys.readouterr().out
+    assert not compare([result("new")], BASELINE, 0.15)
@@ -0,0 +1,80 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+import pytest
+from bot.outbound import TokenBucket
+from user_clients import catchup as catchup_module
+from user_clients.catchup import CatchUp
+
+USER_ID = 1
+CHAT_ID = -100
+
+
+def message(message_id):
+    return SimpleNamespace(id=message_id, chat=SimpleNamespace(id=CHAT_ID), date=datetime.now())
+
+
+class FakeClient:
+    """Has CHAT_ID's messages up to `newest`; `on_scan` runs while the dialogs are read."""
+
+    def __init__(self, newest, on_scan=None):
+        self.me = SimpleNamespace(id=USER_ID)
+        self.newest = newest
+        self.on_scan = on_scan
+
+    async def get_dialogs(self):
+        if self.on_scan is not None:
+            await self.on_scan()
+        yield SimpleNamespace(chat=SimpleNamespace(id=CHAT_ID), top_message=message(self.newest), is_pinned=False)
+
+    async def get_chat_history(self, chat_id, limit, min_id, max_id):
+        for message_id in range(max_id - 1, min_id, -1):
+            yield message(message_id)
+
+
+@pytest.fixture
+def catch_up(monkeypatch):
+    async def get_chat_checkpoints(user_id):
+        return {CHAT_ID: 5}
+
+    monkeypatch.setattr(catchup_module, "get_chat_checkpoints", get_chat_checkpoints)
+    handled = []
+
+    async def handler(client, update):
+        # Like forwarding_handler, every handled message advances the checkpoint
+        catch_up.record(client.me.id, update)
+        handled.append(update.id)
+
+    async def admit(client, update):
+        return True
+
+    catch_up = CatchUp(handler, admit)
+    catch_up._history_bucket = catch_up._replay_bucket = TokenBucket(1e9, 1e9)
+    catch_up.handled = handled
+    return catch_up
+
+
+def run_catch_up(catch_up, client):
+    async def scenario():
+        catch_up.schedule(client)
+        await asyncio.gather(*catch_up._tasks.values())
+
+    asyncio.run(scenario())
+
+
+def test_missed_messages_are_replayed_oldest_first(catch_up):
+    run_catch_up(catch_up, FakeClient(newest=9))
+    assert catch_up.handled == [6, 7, 8, 9]
+    assert catch_up._checkpoints[(USER_ID, CHAT_ID)] == 9
+
+
+def test_messages_handled_live_before_the_replay_are_skipped(catch_up):
+    async def live_updates():
+        # The newest messages arrive after the client started, before its dialogs are scanned
+        for message_id in (8, 9):
+            await catch_up.handler(client, message(message_id))
+
+    client = FakeClient(newest=9, on_scan=live_updates)
+    run_catch_up(catch_up, client)
+    assert catch_up.handled == [8, 9, 6, 7]
+    assert catch_up._live_floors == {}
@@ -0,0 +1,63 @@
+import asyncio
+from user_clients import dedup as dedup_module
+from user_clients.dedup import DedupCache
+
+
+def test_each_key_is_claimed_once():
+    async def scenario():
+        cache = DedupCache(ttl=60, max_size=100, backend="memory")
+        first = await cache.claim([(-100, 1, 5), (-100, 1, 6)])
+        # A second account sees the same message, with one more destination
+        second = await cache.claim([(-100, 1, 5), (-100, 1, 6), (-100, 1, 7)])
+        return cache, first, second
+
+    cache, first, second = asyncio.run(scenario())
+    assert first == [(-100, 1, 5), (-100, 1, 6)]
+    assert second == [(-100, 1, 7)]
+    assert cache.stats() == {"size": 3, "hits": 2, "misses": 3}
+
+
+def test_keys_expire_and_the_cache_stays_bounded(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dedup_module.time, "monotonic", lambda: now[0])
+
+    async def scenario():
+        cache = DedupCache(ttl=10, max_size=2, backend="memory")
+        await cache.claim([("a",)])
+        now[0] += 11
+        expired = await cache.claim([("a",)])
+        await cache.claim([("b",), ("c",)])
+        # "a" was pushed out by the newer keys
+        evicted = await cache.claim([("a",)])
+        return cache, expired, evicted
+
+    cache, expired, evicted = asyncio.run(scenario())
+    assert expired == [("a",)] and evicted == [("a",)]
+    assert cache.stats()["size"] == 2
+
+
+def test_mongo_backend_lets_other_processes_win(monkeypatch):
+    async def claim_dedup_keys(keys):
+        # Another worker already delivered message 1 to chat 5
+        return [key for key in keys if key != "-100:1:5"]
+
+    monkeypatch.setattr(dedup_module, "claim_dedup_keys", claim_dedup_keys)
+
+    async def scenario():
+        cache = DedupCache(ttl=60, max_size=100, backend="mongo")
+        return await cache.claim([(-100, 1, 5), (-100, 1, 6)])
+
+    assert asyncio.run(scenario()) == [(-100, 1, 6)]
+
+
+def test_mongo_backend_fails_open(monkeypatch):
+    async def claim_dedup_keys(keys):
+        raise ConnectionError("database unavailable")
+
+    monkeypatch.setattr(dedup_module, "claim_dedup_keys", claim_dedup_keys)
+
+    async def scenario():
+        cache = DedupCache(ttl=60, max_size=100, backend="mongo")
+        return await cache.claim([(-100, 1, 5)])
+
+    assert asyncio.run(scenario()) == [(-100, 1, 5)]
@@ -0,0 +1,125 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+from user_clients.handlers import _digest_entry
+from user_clients.digest import DigestBuffer, split_digest
+
+
+def collect():
+    sent = []
+
+    async def send(user_id, source_chat_id, dest_chat, digest_id, text):
+        sent.append((dest_chat, text))
+
+    return DigestBuffer(send), sent
+
+
+def test_split_digest_only_splits_between_entries():
+    chunks = split_digest("H\n\n", ["a" * 40, "b" * 40, "c" * 40], limit=100)
+    assert chunks == ["H (1/2)\n\n" + "a" * 40 + "\n\n" + "b" * 40, "H (2/2)\n\n" + "c" * 40]
+    assert all(len(chunk) <= 100 for chunk in chunks)
+
+
+def test_split_digest_keeps_room_for_the_part_labels():
+    # Without the " (i/n)" labels, the first two entries would share a message
+    chunks = split_digest("H\n\n", ["a" * 48, "b" * 46, "c" * 46], limit=100)
+    assert chunks == ["H (1/3)\n\n" + "a" * 48, "H (2/3)\n\n" + "b" * 46, "H (3/3)\n\n" + "c" * 46]
+    assert all(len(chunk) <= 100 for chunk in chunks)
+
+
+def test_split_digest_does_not_label_a_single_message():
+    assert split_digest("H\n\n", ["a", "b"]) == ["H\n\na\n\nb"]
+
+
+def test_split_digest_truncates_oversized_entries():
+    chunks = split_digest("H\n\n", ["x" * 500], limit=100)
+    assert len(chunks) == 1 and len(chunks[0]) <= 100
+
+
+def test_split_digest_never_cuts_a_tag_of_an_oversized_entry():
+    entry = '<b>12:00</b> <a href="tg://user?id=1">Name</a>\n<b>文本:</b> ' + "x" * 5000
+    chunks = split_digest("H\n\n", [entry])
+    assert len(chunks) == 1 and len(chunks[0]) <= 4096
+    assert chunks[0].endswith("x…")
+    assert chunks[0].count("<b>") == chunks[0].count("</b>") == 2
+    assert chunks[0].count("<a ") == chunks[0].count("</a>") == 1
+
+
+def test_digest_is_sent_when_the_window_elapses():
+    async def scenario():
+        buffer, sent = collect()
+        buffer.add(1, -100, "Chat", 5, 1, "one", (0.05, 10))
+        await asyncio.sleep(0.02)
+        buffer.add(1, -100, "Chat", 5, 2, "two", (0.05, 10))
+        assert sent == [] and buffer.pending_count() == 2
+        # The window runs from the first entry; later entries do not extend it
+        await asyncio.sleep(0.05)
+        return buffer, sent
+
+    buffer, sent = asyncio.run(scenario())
+    assert len(sent) == 1
+    dest_chat, text = sent[0]
+    assert dest_chat == 5 and "2 条新消息" in text and "one\n\ntwo" in text
+    assert buffer.pending_count() == 0
+
+
+def test_digest_is_sent_once_max_items_is_reached():
+    async def scenario():
+        buffer, sent = collect()
+        for index in range(3):
+            buffer.add(1, -100, "Chat", 5, index, f"entry {index}", (60, 3))
+        await asyncio.sleep(0)
+        return buffer, sent
+
+    buffer, sent = asyncio.run(scenario())
+    assert len(sent) == 1 and "3 条新消息" in sent[0][1]
+    assert buffer.pending_count() == 0
+
+
+def test_digests_are_kept_per_destination():
+    async def scenario():
+        buffer, sent = collect()
+        buffer.add(1, -100, "Chat", 5, 4, "a", (60, 10))
+        buffer.add(1, -100, "Chat", 6, 5, "b", (60, 10))
+        buffer.flush_all()
+        await asyncio.sleep(0)
+        return sent
+
+    assert sorted(dest_chat for dest_chat, _ in asyncio.run(scenario())) == [5, 6]
+
+
+def test_digest_title_is_escaped():
+    async def scenario():
+        buffer, sent = collect()
+        buffer.add(1, -100, "Tom & <Jerry>", 5, 6, "one", (10, 1))
+        await asyncio.sleep(0)
+        return sent
+
+    sent = asyncio.run(scenario())
+    assert "来自 Tom &amp; &lt;Jerry&gt; 的" in sent[0][1]
+
+
+def test_digest_entry_of_a_message_without_a_date():
+    assert _digest_entry(SimpleNamespace(date=datetime(2026, 1, 1, 8, 5, 9)), "M", "文本") == "<b>08:05:09</b> M\n文本"
+    entry = _digest_entry(SimpleNamespace(date=None), "M", "文本")
+    assert entry.startswith("<b>") and entry.endswith("</b> M\n文本")
+
+
+def test_digest_ids_come_from_the_source_messages():
+    ids = []
+
+    async def send(user_id, source_chat_id, dest_chat, digest_id, text):
+        ids.append(digest_id)
+
+    async def scenario():
+        buffer = DigestBuffer(send)
+        buffer.add(1, -100, "Chat", 5, 10, "a", (60, 10))
+        buffer.add(1, -100, "Chat", 5, 12, "b", (60, 10))
+        buffer.flush_all()
+        buffer.add(1, -100, "Chat", 5, 13, "x" * 3000, (60, 10))
+        buffer.add(1, -100, "Chat", 5, 14, "y" * 3000, (60, 10))
+        buffer.flush_all()
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    assert ids == ["10-12", "13-14/1", "13-14/2"]
@@ -0,0 +1,121 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from pyrogram import enums
+from user_clients import handlers
+from user_clients.dedup import DedupCache
+from user_clients.digest import DigestBuffer
+
+
+def test_fan_out_reaches_every_destination_with_bounded_concurrency(monkeypatch):
+    monkeypatch.setattr(handlers, "FANOUT_CONCURRENCY", 3)
+    running = 0
+    peak = 0
+    delivered = []
+
+    async def deliver(dest_chat):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        delivered.append(dest_chat)
+
+    asyncio.run(handlers._fan_out(set(range(10)), deliver))
+    assert sorted(delivered) == list(range(10))
+    assert peak == 3
+
+
+def test_fan_out_is_not_held_up_by_a_slow_destination():
+    delivered = []
+
+    async def deliver(dest_chat):
+        await asyncio.sleep(0.2 if dest_chat == 1 else 0)
+        delivered.append(dest_chat)
+
+    asyncio.run(handlers._fan_out({1, 2, 3}, deliver))
+    assert delivered[-1] == 1
+
+
+def test_only_shared_chats_are_deduplicated(monkeypatch):
+    monkeypatch.setattr(handlers, "delivery_dedup", DedupCache(ttl=60, max_size=100, backend="memory"))
+
+    def message(chat_type):
+        return SimpleNamespace(id=1, chat=SimpleNamespace(id=-100, type=chat_type))
+
+    async def scenario():
+        channel = [await handlers._drop_duplicates(message(enums.ChatType.CHANNEL), {5, 6}) for _ in range(2)]
+        group = [await handlers._drop_duplicates(message(enums.ChatType.GROUP), {5, 6}) for _ in range(2)]
+        return channel, group
+
+    channel, group = asyncio.run(scenario())
+    assert channel == [{5, 6}, set()]
+    # Every account sees its own message IDs in basic groups, so equal IDs are not the same message
+    assert group == [{5, 6}, {5, 6}]
+
+
+class IdleOutbox:
+    """The parts of the outbox the drain reads; every delivery has completed."""
+
+    delivered = dropped = 0
+
+    def in_flight_count(self):
+        return 0
+
+    def pending_count(self):
+        return 0
+
+
+@pytest.fixture
+def drained(monkeypatch):
+    sent = []
+
+    async def send(user_id, source_chat_id, dest_chat, digest_id, text):
+        sent.append(text)
+
+    monkeypatch.setattr(handlers, "DRAIN_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(handlers, "intake", handlers._Intake())
+    monkeypatch.setattr(handlers, "outbox", IdleOutbox())
+    monkeypatch.setattr(handlers, "digest_buffer", DigestBuffer(send))
+    return sent
+
+
+def test_drain_stops_the_intake_and_waits_for_handlers_in_progress(drained):
+    handled = []
+
+    async def handler(client, update):
+        await asyncio.sleep(0.05)
+        handled.append(update)
+
+    async def scenario():
+        tracked = handlers.intake.track(handler)
+        handlers.digest_buffer.add(1, -100, "Chat", 5, 1, "entry", (3600, 10))
+        in_progress = asyncio.create_task(tracked(None, "first"))
+        await asyncio.sleep(0)
+        report = await handlers.drain(timeout=5)
+        await tracked(None, "after the drain")
+        await in_progress
+        return report
+
+    report = asyncio.run(scenario())
+    assert handled == ["first"]
+    # The buffered digest went out right away instead of after its window
+    assert len(drained) == 1
+    assert report['digest_items_flushed'] == 1 and report['interrupted'] == 0
+    assert report['seconds'] < 1
+
+
+def test_drain_gives_up_at_its_deadline(drained):
+    async def handler(client, update):
+        await asyncio.sleep(3600)
+
+    async def scenario():
+        task = asyncio.create_task(handlers.intake.track(handler)(None, "stuck"))
+        await asyncio.sleep(0)
+        report = await handlers.drain(timeout=0.05)
+        task.cancel()
+        return report
+
+    report = asyncio.run(scenario())
+    assert report['interrupted'] == 1
+    assert report['seconds'] < 1
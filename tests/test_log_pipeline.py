@@ -0,0 +1,48 @@
+import logging
+import log_pipeline as log_pipeline_module
+from log_pipeline import HotPathFilter, KeyValueFormatter
+
+
+def record(name="user_clients.handlers", level=logging.INFO, msg="Forwarded %s", args=(1,), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_sample_mode_passes_at_most_the_rate_per_logger(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(log_pipeline_module.time, "monotonic", lambda: now[0])
+    hot_path = HotPathFilter(["user_clients"], "sample", rate=2, summary_interval=3600)
+
+    passed = [hot_path.filter(record()) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    # Other loggers and warnings are never throttled
+    assert hot_path.filter(record(name="bot.app"))
+    assert hot_path.filter(record(level=logging.WARNING))
+    now[0] += 0.5
+    assert hot_path.filter(record()) and not hot_path.filter(record())
+    assert hot_path.suppressed_total == {"user_clients.handlers": 4}
+
+
+def test_count_mode_only_writes_the_summary(monkeypatch, caplog):
+    now = [100.0]
+    monkeypatch.setattr(log_pipeline_module.time, "monotonic", lambda: now[0])
+    hot_path = HotPathFilter(["user_clients"], "count", rate=20, summary_interval=60)
+
+    with caplog.at_level(logging.INFO, logger="log_pipeline"):
+        assert not any(hot_path.filter(record(args=(number,))) for number in range(3))
+        assert not hot_path.filter(record(msg="Skipped %s"))
+        assert caplog.records == []
+        now[0] += 60
+        hot_path.filter(record())
+
+    (summary,) = caplog.records
+    assert "5 lines not written" in summary.getMessage()
+    assert "4 x user_clients.handlers: Forwarded %s" in summary.getMessage()
+    # The summary itself is never suppressed
+    assert hot_path.filter(summary)
+
+
+def test_key_value_formatter_quotes_values_and_adds_extra_fields():
+    line = KeyValueFormatter().format(record(msg='Sent "%s"', args=("hi there",), user_id=7))
+    assert line.endswith('level=INFO logger=user_clients.handlers msg="Sent \\"hi there\\"" user_id=7')
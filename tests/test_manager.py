@@ -0,0 +1,90 @@
+import asyncio
+import pytest
+from user_clients import manager as manager_module
+from user_clients.manager import UserClientManager
+from user_clients.supervisor import BACKOFF
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(manager_module, "STARTUP_JITTER", 0)
+
+
+def users(count):
+    return [{'user_id': user_id, 'session_string': f"session {user_id}"} for user_id in range(1, count + 1)]
+
+
+def test_clients_start_concurrently_up_to_the_limit(monkeypatch):
+    monkeypatch.setattr(manager_module, "STARTUP_CONCURRENCY", 3)
+    manager = UserClientManager()
+    running = 0
+    peak = 0
+
+    async def start_client(user_id, session_string):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return user_id != 4
+
+    manager.start_client = start_client
+    results = asyncio.run(manager.start_clients(users(8)))
+    assert peak == 3
+    assert results == {user_id: user_id != 4 for user_id in range(1, 9)}
+
+
+class HangingClient:
+    """A client whose start never completes, like one stuck on a dead connection."""
+
+    def __init__(self, **kwargs):
+        self.is_connected = False
+
+    async def start(self):
+        await asyncio.sleep(3600)
+
+
+def test_a_hanging_start_times_out_and_is_retried_later(monkeypatch):
+    monkeypatch.setattr(manager_module, "Client", HangingClient)
+    monkeypatch.setattr(manager_module, "SESSION_STORAGE", "memory")
+    monkeypatch.setattr(manager_module, "STARTUP_CLIENT_TIMEOUT", 0.05)
+    manager = UserClientManager()
+
+    results = asyncio.run(manager.start_clients(users(2)))
+    assert results == {1: False, 2: False}
+    assert manager.running_clients == {}
+    assert all(manager.supervisor.health[user_id].state == BACKOFF for user_id in (1, 2))
+    assert manager.supervisor.is_retrying(1)
+
+
+class StoppingClient:
+    """A running client that takes `seconds` to stop."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.is_initialized = True
+        self.stopped = False
+
+    async def stop(self):
+        await asyncio.sleep(self.seconds)
+        self.stopped = True
+
+
+def test_clients_stop_concurrently_each_within_the_timeout(monkeypatch, caplog):
+    monkeypatch.setattr(manager_module, "SHUTDOWN_CLIENT_TIMEOUT", 0.2)
+    manager = UserClientManager()
+    clients = {user_id: StoppingClient(0.1) for user_id in range(1, 6)}
+    clients[6] = StoppingClient(3600)
+    manager.running_clients.update(clients)
+
+    async def scenario():
+        started_at = asyncio.get_running_loop().time()
+        await manager.stop_all()
+        return asyncio.get_running_loop().time() - started_at
+
+    with caplog.at_level("INFO", logger="user_clients.manager"):
+        seconds = asyncio.run(scenario())
+    assert seconds < 0.5
+    assert manager.running_clients == {}
+    assert all(clients[user_id].stopped for user_id in range(1, 6)) and not clients[6].stopped
+    assert "5/6 clients stopped cleanly" in caplog.text and "user 6: timed out" in caplog.text
@@ -0,0 +1,86 @@
+import asyncio
+import socket
+import pytest
+from metrics.registry import CallbackMetric, Counter, Histogram, Registry
+from metrics.server import MetricsServer
+
+
+def test_metrics_render_in_the_prometheus_text_format():
+    registry = Registry()
+    sent = registry.register(Counter("sent_total", "Messages sent.", ["user_id"]))
+    latency = registry.register(Histogram("latency_seconds", "Latency.", buckets=(1, 5)))
+    depth = registry.register(CallbackMetric("queue_depth", "Queued calls."))
+    sent.inc(7)
+    sent.inc(7, amount=2)
+    sent.inc('say "hi"\n')
+    latency.observe(0.5)
+    latency.observe(3)
+    latency.observe(60)
+    depth.set_function(lambda: 4)
+
+    assert registry.render().splitlines() == [
+        "# HELP sent_total Messages sent.",
+        "# TYPE sent_total counter",
+        'sent_total{user_id="7"} 3',
+        'sent_total{user_id="say \\"hi\\"\\n"} 1',
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="1"} 1',
+        'latency_seconds_bucket{le="5"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 63.5",
+        "latency_seconds_count 3",
+        "# HELP queue_depth Queued calls.",
+        "# TYPE queue_depth gauge",
+        "queue_depth 4",
+    ]
+
+
+def test_metrics_reject_wrong_labels_and_duplicate_names():
+    registry = Registry()
+    sent = registry.register(Counter("sent_total", "Messages sent.", ["user_id"]))
+    with pytest.raises(ValueError):
+        sent.inc()
+    with pytest.raises(ValueError):
+        registry.register(Counter("sent_total", "Again."))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def get(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response.decode()
+
+
+def test_server_answers_scrapes():
+    async def scenario():
+        server = MetricsServer("127.0.0.1", free_port())
+        await server.start()
+        try:
+            return await get(server.port, "/metrics"), await get(server.port, "/other")
+        finally:
+            await server.stop()
+
+    metrics, other = asyncio.run(scenario())
+    assert metrics.startswith("HTTP/1.1 200 OK") and "# TYPE forwarder_messages_received_total counter" in metrics
+    assert other.startswith("HTTP/1.1 404")
+
+
+def test_server_keeps_running_without_its_port():
+    async def scenario():
+        with socket.socket() as taken:
+            taken.bind(("127.0.0.1", 0))
+            taken.listen()
+            server = MetricsServer("127.0.0.1", taken.getsockname()[1])
+            await server.start()
+            return server
+
+    assert asyncio.run(scenario())._server is None
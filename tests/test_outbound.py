@@ -0,0 +1,150 @@
+import asyncio
+import pytest
+from pyrogram.errors import ChatWriteForbidden, FloodWait
+from bot.outbound import OutboundScheduler, TokenBucket
+from metrics import registry as metrics
+
+
+class FakeBot:
+    def __init__(self, bot_token="100:test"):
+        self.bot_token = bot_token
+        self.sent = []
+
+
+def test_token_bucket_spends_its_capacity_before_waiting():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # Reservations queue up behind each other, one refill interval apart
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_sends_to_a_chat_keep_their_order():
+    async def scenario():
+        scheduler = OutboundScheduler([FakeBot()])
+
+        async def send(client, text):
+            await asyncio.sleep(0)
+            client.sent.append(text)
+            return text
+
+        results = await asyncio.gather(*(
+            scheduler.submit(-100, lambda client, text=text: send(client, text)) for text in range(20)
+        ))
+        return scheduler, results
+
+    scheduler, results = asyncio.run(scenario())
+    assert results == list(range(20))
+    assert scheduler.primary.client.sent == list(range(20))
+    assert scheduler.stats()["sent"] == 20
+
+
+def test_send_errors_reach_the_caller():
+    async def scenario():
+        scheduler = OutboundScheduler([FakeBot()])
+
+        async def fail(client):
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            await scheduler.submit(5, fail)
+        return scheduler
+
+    assert asyncio.run(scenario()).stats()["failed"] == 1
+
+
+def test_flood_wait_is_retried_after_the_pause():
+    async def scenario():
+        scheduler = OutboundScheduler([FakeBot()])
+        calls = []
+
+        async def send(client):
+            calls.append(asyncio.get_running_loop().time())
+            if len(calls) == 1:
+                error = FloodWait(value=1)
+                error.value = 0.05
+                raise error
+            return "ok"
+
+        assert await scheduler.submit(5, send) == "ok"
+        return calls
+
+    calls = asyncio.run(scenario())
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.04
+
+
+def pool_scenario(chat_id, fail):
+    """Sends twice to `chat_id` with two bots; `fail(bot)` may raise for a bot's first send."""
+    async def scenario():
+        scheduler = OutboundScheduler([FakeBot("100:primary"), FakeBot("200:pool")])
+        assigned = scheduler.bot_for(chat_id)
+
+        async def send(client):
+            if client is assigned and not client.sent:
+                client.sent.append("failed")
+                fail(client)
+            client.sent.append("ok")
+            return client
+
+        first = await scheduler.submit(chat_id, send)
+        second = await scheduler.submit(chat_id, send)
+        return scheduler, assigned, first, second
+
+    return asyncio.run(scenario())
+
+
+def test_private_chats_are_always_sent_by_the_primary_bot():
+    scheduler, assigned, first, second = pool_scenario(5, lambda client: None)
+    assert assigned is first is second is scheduler.primary.client
+
+
+def test_pool_bot_without_access_is_excluded_from_the_chat():
+    def forbid(client):
+        raise ChatWriteForbidden()
+
+    # Find a group assigned to the pool bot, which is the one that can be excluded
+    chat_id = next(
+        chat_id for chat_id in range(-100, -200, -1)
+        if OutboundScheduler([FakeBot("100:primary"), FakeBot("200:pool")]).bot_for(chat_id).bot_token == "200:pool"
+    )
+    scheduler, assigned, first, second = pool_scenario(chat_id, forbid)
+    assert first is second is scheduler.primary.client
+    assert assigned.sent == ["failed"]
+    assert scheduler.bot_for(chat_id) is scheduler.primary.client
+
+
+def test_flood_wait_moves_the_send_to_the_next_bot():
+    def flood(client):
+        raise FloodWait(value=60)
+
+    scheduler, assigned, first, second = pool_scenario(-100, flood)
+    assert first is second
+    assert first is not assigned
+    assert scheduler.stats()["paused_chats"] == 1
+
+
+def test_a_failover_is_counted_once_per_send():
+    async def scenario():
+        scheduler = OutboundScheduler([FakeBot("100:primary"), FakeBot("200:pool")])
+        assigned = scheduler.bot_for(-100)
+        calls = []
+
+        async def send(client):
+            calls.append(client)
+            # The assigned bot is held for a minute, the other one twice briefly
+            if client is assigned or len(calls) <= 3:
+                error = FloodWait(value=1)
+                error.value = 60 if client is assigned else 0.01
+                raise error
+            return client
+
+        other = await scheduler.submit(-100, send)
+        return other, calls
+
+    before = {bot_id: metrics.bot_failovers.value(bot_id) for bot_id in ("100", "200")}
+    other, calls = asyncio.run(scenario())
+    other_id = other.bot_token.split(":")[0]
+    assert len(calls) == 4 and calls.count(other) == 3
+    assert metrics.bot_failovers.value(other_id) - before[other_id] == 1
@@ -0,0 +1,199 @@
+import asyncio
+from datetime import datetime
+import pytest
+from user_clients import outbox as outbox_module
+from user_clients.outbox import Outbox, OutboxEntry
+
+
+class FakeCollection:
+    """Records the outbox writes and fails them while `failing` is set."""
+
+    def __init__(self):
+        self.inserted = []
+        self.insert_calls = 0
+        self.updated = []
+        self.deleted = []
+        self.failing = False
+
+    async def insert(self, documents):
+        self.insert_calls += 1
+        self._check()
+        self.inserted.extend(document['_id'] for document in documents)
+
+    async def update(self, documents, upsert=False):
+        self._check()
+        assert upsert
+        self.updated.extend(document['_id'] for document in documents)
+
+    async def delete(self, keys):
+        self._check()
+        self.deleted.extend(keys)
+
+    def _check(self):
+        if self.failing:
+            raise ConnectionError("database unavailable")
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(outbox_module, "insert_outbox_entries", collection.insert)
+    monkeypatch.setattr(outbox_module, "update_outbox_entries", collection.update)
+    monkeypatch.setattr(outbox_module, "delete_outbox_entries", collection.delete)
+    return collection
+
+
+def make_outbox(failing_keys):
+    async def deliver(entry):
+        if entry.key in failing_keys:
+            raise RuntimeError("send failed")
+
+    return Outbox(deliver, lambda: [])
+
+
+def entry(key):
+    return OutboxEntry(key, 1, 5, {"text": key})
+
+
+def test_entries_are_written_before_delivery_and_deleted_after(collection):
+    written_before_delivery = []
+
+    async def deliver(entry):
+        written_before_delivery.append(entry.key in collection.inserted)
+
+    async def scenario():
+        outbox = Outbox(deliver, lambda: [])
+        await outbox.submit(entry("a"))
+        await outbox.submit(entry("a"))
+        await outbox.flush()
+        return outbox
+
+    outbox = asyncio.run(scenario())
+    assert written_before_delivery == [True]
+    assert collection.inserted == collection.deleted == ["a"] and collection.updated == []
+    assert outbox.stats()["delivered"] == 1 and outbox.pending_count() == 0
+
+
+def test_concurrent_submits_share_one_insert(collection):
+    async def scenario():
+        outbox = make_outbox(set())
+        await asyncio.gather(*(outbox.submit(entry(key)) for key in "abc"))
+        await outbox.submit(entry("d"))
+
+    asyncio.run(scenario())
+    assert collection.insert_calls == 2
+    assert collection.inserted == ["a", "b", "c", "d"]
+
+
+def test_failed_commit_still_delivers_and_leaves_the_insert_to_the_flusher(collection):
+    async def scenario():
+        outbox = make_outbox({"a"})
+        collection.failing = True
+        await outbox.submit(entry("a"))
+        await outbox.submit(entry("b"))
+        collection.failing = False
+        await outbox.flush()
+        return outbox
+
+    outbox = asyncio.run(scenario())
+    # "b" was delivered before any write succeeded, so there is nothing to delete
+    assert collection.inserted == ["a"] and collection.deleted == []
+    assert outbox.stats()["delivered"] == 1 and outbox.pending_count() == 1
+
+
+def test_failed_delivery_is_persisted_for_a_retry(collection):
+    async def scenario():
+        outbox = make_outbox({"a"})
+        await outbox.submit(entry("a"))
+        await outbox.flush()
+        return outbox
+
+    outbox = asyncio.run(scenario())
+    assert collection.inserted == ["a"]
+    assert outbox.pending_count() == 1 and outbox.stats()["retried"] == 1
+
+
+def test_failed_flush_keeps_its_writes_for_the_next_one(collection):
+    async def scenario():
+        outbox = make_outbox({"a", "b"})
+        await outbox.submit(entry("a"))
+        await outbox.submit(entry("b"))
+        collection.failing = True
+        with pytest.raises(ConnectionError):
+            await outbox.flush()
+        collection.failing = False
+        await outbox.flush()
+
+    asyncio.run(scenario())
+    assert collection.updated == ["a", "b"]
+
+
+def test_failed_flush_skips_entries_delivered_meanwhile(collection):
+    async def scenario():
+        failing = {"a", "b"}
+        outbox = make_outbox(failing)
+        await outbox.submit(entry("a"))
+        await outbox.submit(entry("b"))
+        await outbox.flush()
+        collection.updated.clear()
+
+        # Both retries are due for an update; "a" is delivered while the flush fails
+        for key in ("a", "b"):
+            outbox._to_update[key] = outbox._entries[key]
+        collection.failing = True
+        with pytest.raises(ConnectionError):
+            await outbox.flush()
+        failing.discard("a")
+        await outbox._dispatch(outbox._entries["a"])
+        collection.failing = False
+        await outbox.flush()
+
+    asyncio.run(scenario())
+    assert collection.updated == ["b"]
+    assert collection.deleted == ["a"]
+
+
+def test_failed_deletes_are_retried(collection):
+    async def scenario():
+        failing = {"a"}
+        outbox = make_outbox(failing)
+        await outbox.submit(entry("a"))
+        await outbox.flush()
+        failing.clear()
+        await outbox._dispatch(outbox._entries["a"])
+        collection.failing = True
+        with pytest.raises(ConnectionError):
+            await outbox.flush()
+        collection.failing = False
+        await outbox.flush()
+
+    asyncio.run(scenario())
+    assert collection.deleted == ["a"]
+
+
+def test_resume_skips_entries_this_process_already_knows(collection, monkeypatch):
+    delivered = []
+    limits = []
+
+    async def deliver(entry):
+        delivered.append(entry.key)
+        if entry.key == "a":
+            raise RuntimeError("send failed")
+
+    async def get_due(user_ids, limit):
+        limits.append(limit)
+        return [entry(key).to_document(datetime.utcnow()) for key in ("a", "b", "c")]
+
+    monkeypatch.setattr(outbox_module, "get_due_outbox_entries", get_due)
+
+    async def scenario():
+        outbox = Outbox(deliver, lambda: [1])
+        await outbox.submit(entry("a"))  # Pending with a retry scheduled
+        await outbox.submit(entry("b"))  # Delivered, its deletion not yet flushed
+        await outbox._resume_persisted()
+        await asyncio.gather(*outbox._tasks)
+
+    asyncio.run(scenario())
+    assert delivered == ["a", "b", "c"]
+    # The known entries cannot crowd the unknown ones out of the batch
+    assert limits == [outbox_module.RESUME_BATCH_SIZE + 2]
@@ -0,0 +1,46 @@
+from bot.pagination import parse_cursor, render_page
+from utils.telegram_text import MAX_MESSAGE_LENGTH
+
+
+def buttons(keyboard):
+    return [button.callback_data for button in keyboard.inline_keyboard[0]] if keyboard else []
+
+
+def test_parse_cursor():
+    assert parse_cursor("lu:n:12345") == ("lu", "12345", None)
+    assert parse_cursor("lu:p:12345") == ("lu", None, "12345")
+    # The prefix may contain colons itself, e.g. the user whose rules are listed
+    assert parse_cursor("lr:123:n:64b7f0c2a1") == ("lr:123", "64b7f0c2a1", None)
+
+
+def test_cursors_round_trip_through_the_buttons():
+    text, keyboard = render_page("H\n", [("a", "1\n"), ("b", "2\n")], "lu", True, True)
+    assert text == "H\n1\n2\n"
+    assert buttons(keyboard) == ["lu:p:a", "lu:n:b"]
+    assert [parse_cursor(data) for data in buttons(keyboard)] == [("lu", None, "a"), ("lu", "b", None)]
+
+
+def test_single_page_has_no_keyboard():
+    text, keyboard = render_page("H\n", [("a", "1\n")], "lu", False, False)
+    assert keyboard is None
+
+
+def test_entries_past_the_message_limit_move_to_the_next_page():
+    entry = "x" * (MAX_MESSAGE_LENGTH // 3)
+    text, keyboard = render_page("H\n", [(str(key), entry) for key in range(5)], "lu", False, False)
+    assert len(text) <= MAX_MESSAGE_LENGTH
+    assert buttons(keyboard) == ["lu:n:1"]
+
+
+def test_an_entry_longer_than_a_page_is_truncated():
+    entry = "<b>规则ID:</b> <code>1</code>\n  <b>目标:</b> <code>" + ", ".join(["-1001234567890"] * 500) + "</code>\n\n"
+    text, keyboard = render_page("H\n", [("a", entry), ("b", "2\n")], "lr:1", False, False)
+    assert len(text) <= MAX_MESSAGE_LENGTH
+    assert text.endswith("…</code>")
+    assert buttons(keyboard) == ["lr:1:n:a"]
+
+
+def test_callback_data_fits_telegram_limit():
+    key = "0" * 24  # ObjectId hex
+    _, keyboard = render_page("H\n", [(key, "1\n")], "lr:1234567890", True, True)
+    assert all(len(data.encode()) <= 64 for data in buttons(keyboard))
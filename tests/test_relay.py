@@ -0,0 +1,214 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from pyrogram import enums
+from pyrogram.errors import ChatForwardsRestricted
+from user_clients import relay as relay_module
+from user_clients.relay import MediaRelay
+
+BOT = SimpleNamespace(me=SimpleNamespace(id=900, username="relay_bot"))
+
+
+def photo(message_id, file_unique_id, protected=False):
+    return SimpleNamespace(
+        id=message_id,
+        chat=SimpleNamespace(id=-100, has_protected_content=protected),
+        has_protected_content=protected,
+        media=enums.MessageMediaType.PHOTO,
+        photo=SimpleNamespace(file_unique_id=file_unique_id, file_id=f"bot-{file_unique_id}", file_size=3),
+        caption=None,
+        caption_entities=None,
+    )
+
+
+class FakeUserClient:
+    """Forwards messages to the bot, whose copies arrive at the relay shortly after."""
+
+    def __init__(self, relay, deliver_copies=True):
+        self.me = SimpleNamespace(id=1)
+        self.relay = relay
+        self.deliver_copies = deliver_copies
+        self.forwards = []
+
+    async def forward_messages(self, chat_id, from_chat_id, message_ids, disable_notification):
+        self.forwards.append(message_ids)
+        if self.deliver_copies:
+            asyncio.get_running_loop().call_soon(self._arrive, message_ids)
+
+    def _arrive(self, message_ids):
+        for message_id in message_ids:
+            copy = photo(1000 + message_id, f"u{message_id}")
+            if self.relay.is_expecting(BOT, copy):
+                self.relay.capture(BOT, copy)
+
+
+def test_concurrent_acquires_share_one_forward():
+    async def scenario():
+        relay = MediaRelay(BOT)
+        client = FakeUserClient(relay)
+        message = photo(1, "u1")
+        results = await asyncio.gather(*(relay.acquire(client, message) for _ in range(5)))
+        return relay, client, results
+
+    relay, client, results = asyncio.run(scenario())
+    assert client.forwards == [[1]] and relay.upstream_transfers == 1
+    assert all(result is results[0] for result in results)
+    assert results[0].file_id == "bot-u1"
+
+
+def test_cached_media_is_not_forwarded_again():
+    async def scenario():
+        relay = MediaRelay(BOT)
+        client = FakeUserClient(relay)
+        first = await relay.acquire(client, photo(1, "u1"))
+        # Another account sees the same file in another message
+        second = await relay.acquire(client, photo(1, "u1"))
+        return client, first, second
+
+    client, first, second = asyncio.run(scenario())
+    assert first is second
+    assert client.forwards == [[1]]
+
+
+def test_album_transfers_only_the_parts_not_cached():
+    async def scenario():
+        relay = MediaRelay(BOT)
+        client = FakeUserClient(relay)
+        await relay.acquire(client, photo(1, "u1"))
+        parts = await relay.acquire_group(client, [photo(1, "u1"), photo(2, "u2"), photo(3, "u3")])
+        return client, parts
+
+    client, parts = asyncio.run(scenario())
+    assert client.forwards == [[1], [2, 3]]
+    assert [part.file_id for part in parts] == ["bot-u1", "bot-u2", "bot-u3"]
+
+
+def test_media_the_bot_never_receives_is_not_cached(monkeypatch):
+    monkeypatch.setattr(relay_module, "RELAY_CAPTURE_TIMEOUT", 0.05)
+
+    async def scenario():
+        relay = MediaRelay(BOT)
+        client = FakeUserClient(relay, deliver_copies=False)
+        first = await relay.acquire(client, photo(1, "u1"))
+        second = await relay.acquire(client, photo(1, "u1"))
+        return relay, client, first, second
+
+    relay, client, first, second = asyncio.run(scenario())
+    assert first is None and second is None
+    assert client.forwards == [[1], [1]]
+    assert relay._captures == {}
+
+
+def test_a_failed_transfer_reaches_every_waiting_caller():
+    class FailingClient(FakeUserClient):
+        async def forward_messages(self, **kwargs):
+            await asyncio.sleep(0)
+            raise ConnectionError("lost")
+
+    async def scenario():
+        relay = MediaRelay(BOT)
+        client = FailingClient(relay)
+        results = await asyncio.gather(
+            *(relay.acquire(client, photo(1, "u1")) for _ in range(3)), return_exceptions=True
+        )
+        return relay, results
+
+    relay, results = asyncio.run(scenario())
+    assert all(isinstance(result, ConnectionError) for result in results)
+    assert relay._inflight == {}
+
+
+class StreamingUserClient(FakeUserClient):
+    """A user client in a protected chat: forwards are refused and media is streamed in chunks."""
+
+    async def forward_messages(self, **kwargs):
+        raise AssertionError("protected messages cannot be forwarded")
+
+    async def stream_media(self, message):
+        for chunk in (b"ab", b"c"):
+            await asyncio.sleep(0)
+            yield chunk
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    uploads = []
+
+    async def submit(chat_id, call, client=None):
+        return await call(UploadingBot(uploads))
+
+    monkeypatch.setattr(relay_module.outbound, "submit", submit)
+    return uploads
+
+
+class UploadingBot:
+    def __init__(self, uploads):
+        self.uploads = uploads
+
+    async def send_photo(self, chat_id, photo, disable_notification, **kwargs):
+        self.uploads.append((chat_id, photo.read()))
+        return photo_copy(len(self.uploads))
+
+
+def photo_copy(number):
+    copy = photo(2000 + number, f"uploaded{number}")
+    copy.photo.file_id = f"uploaded-file-{number}"
+    return copy
+
+
+def test_protected_media_is_uploaded_once_by_the_primary_bot(uploads):
+    async def scenario():
+        relay = MediaRelay(BOT)
+        client = StreamingUserClient(relay)
+        message = photo(1, "u1", protected=True)
+        first = await asyncio.gather(*(relay.acquire(client, message, bot=object()) for _ in range(3)))
+        again = await relay.acquire(client, message)
+        return relay, first, again
+
+    relay, first, again = asyncio.run(scenario())
+    # Sent to the user's chat with the bot, from the spooled stream
+    assert uploads == [(1, b"abc")]
+    assert relay.uploads == 1 and relay.upstream_transfers == 0
+    assert all(item is again for item in first)
+    assert again.bot is BOT and again.file_id == "uploaded-file-1"
+
+
+def test_uploads_of_one_user_run_one_at_a_time(monkeypatch, uploads):
+    monkeypatch.setattr(relay_module, "RELAY_UPLOAD_PER_USER", 1)
+    running = 0
+    peak = 0
+    original = MediaRelay._upload_one
+
+    async def upload_one(self, client, message):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        try:
+            return await original(self, client, message)
+        finally:
+            running -= 1
+
+    monkeypatch.setattr(MediaRelay, "_upload_one", upload_one)
+
+    async def scenario():
+        relay = MediaRelay(BOT)
+        client = StreamingUserClient(relay)
+        await asyncio.gather(*(relay.acquire(client, photo(number, f"u{number}", protected=True)) for number in range(4)))
+
+    asyncio.run(scenario())
+    assert len(uploads) == 4 and peak == 1
+
+
+def test_unannounced_protection_falls_back_to_an_upload(uploads):
+    class RestrictedClient(StreamingUserClient):
+        async def forward_messages(self, **kwargs):
+            raise ChatForwardsRestricted()
+
+    async def scenario():
+        relay = MediaRelay(BOT)
+        relayed = await relay.acquire(RestrictedClient(relay), photo(1, "u1"))
+        return relay, relayed
+
+    relay, relayed = asyncio.run(scenario())
+    assert uploads == [(1, b"abc")] and relayed.file_id == "uploaded-file-1"
+    assert relay._captures == {}
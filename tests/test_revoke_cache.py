@@ -0,0 +1,107 @@
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+from pyrogram import enums
+from user_clients.revoke_cache import RevokeCache
+
+USER = 1
+CHAT = -100
+
+
+def message(message_id, chat_id=CHAT, text="hello", group=None):
+    return SimpleNamespace(
+        id=message_id,
+        chat=SimpleNamespace(id=chat_id, type=enums.ChatType.SUPERGROUP, title="Chat"),
+        date=datetime(2026, 1, 1),
+        from_user=SimpleNamespace(mention="Alice"),
+        text=text,
+        caption=None,
+        media_group_id=group,
+    )
+
+
+def make_cache(per_chat=3, max_bytes=10 ** 9, ttl=3600, spill=False):
+    return RevokeCache(per_chat, max_bytes, ttl, spill)
+
+
+def take(cache, message_ids, chat_id=CHAT):
+    return [cached.message_id for cached in asyncio.run(cache.take(USER, chat_id, message_ids))]
+
+
+def test_ring_buffer_keeps_the_latest_messages_of_a_chat():
+    cache = make_cache(per_chat=3)
+    for message_id in range(1, 6):
+        cache.record(USER, message(message_id), "消息", [5])
+    assert take(cache, [1, 2, 3, 4, 5]) == [3, 4, 5]
+
+
+def test_chats_have_separate_buffers():
+    cache = make_cache(per_chat=2)
+    for message_id in range(1, 4):
+        cache.record(USER, message(message_id), "消息", [5])
+        cache.record(USER, message(message_id, chat_id=-200), "消息", [5])
+    assert take(cache, [2, 3]) == [2, 3]
+    assert take(cache, [1, 2, 3], chat_id=-200) == [2, 3]
+
+
+def test_deleted_records_do_not_count_against_the_chat():
+    cache = make_cache(per_chat=3)
+    for message_id in (1, 2, 3):
+        cache.record(USER, message(message_id), "消息", [5])
+    assert take(cache, [2]) == [2]
+    # Two live records remain, so a new one evicts nothing
+    cache.record(USER, message(4), "消息", [5])
+    assert take(cache, [1, 3, 4]) == [1, 3, 4]
+
+
+def test_chat_buffer_stays_bounded_under_deletions():
+    cache = make_cache(per_chat=5)
+    for message_id in range(1000):
+        cache.record(USER, message(message_id), "消息", [5])
+        if message_id % 2:
+            asyncio.run(cache.take(USER, CHAT, [message_id - 1]))
+    chat = cache._chats[(USER, CHAT)]
+    assert len(chat.keys) <= 2 * cache.per_chat
+    # 991 to 997 and 998 were live when 999 pushed 991 out; deleting 998 leaves four
+    assert chat.live == 4
+    assert take(cache, list(range(990, 1000))) == [993, 995, 997, 999]
+
+
+def test_memory_cap_evicts_the_oldest_records():
+    cache = make_cache(per_chat=100)
+    cache.record(USER, message(1), "消息", [5])
+    cache.max_bytes = cache.size * 2
+    for message_id in (2, 3, 4):
+        cache.record(USER, message(message_id), "消息", [5])
+    assert cache.size <= cache.max_bytes
+    assert take(cache, [1, 2, 3, 4]) == [3, 4]
+
+
+def test_expired_records_are_dropped():
+    cache = make_cache(ttl=-1)
+    cache.record(USER, message(1), "消息", [5])
+    assert take(cache, [1]) == []
+    assert cache.stats()["messages"] == 0
+
+
+def test_evicted_records_are_still_found_before_they_are_spilled():
+    cache = make_cache(per_chat=1, spill=True)
+    cache.record(USER, message(1), "消息", [5])
+    cache.record(USER, message(2), "消息", [5])
+    assert take(cache, [1]) == [1]
+
+
+def test_album_parts_are_cached_with_their_group():
+    cache = make_cache(per_chat=10)
+    for message_id in (1, 2, 3):
+        cache.record(USER, message(message_id, group="g1"), "图片", [5])
+    parts = asyncio.run(cache.take(USER, CHAT, [1, 2, 3]))
+    assert [cached.group for cached in parts] == ["g1"] * 3
+
+
+def test_private_chats_share_the_common_box():
+    cache = make_cache()
+    private = message(1, chat_id=42)
+    private.chat.type = enums.ChatType.PRIVATE
+    cache.record(USER, private, "消息", [5])
+    assert take(cache, [1], chat_id=0) == [1]
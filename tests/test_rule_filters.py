@@ -0,0 +1,93 @@
+import pytest
+from database.rule_filters import KeywordMatcher, MessageFeatures, compile_keyword_groups, parse_rule_filter
+
+
+def features(text="", content_type="text", sender_id=42, is_mention=False):
+    return MessageFeatures(text, content_type, sender_id, is_mention)
+
+
+def test_keyword_matcher_finds_every_group_in_one_pass():
+    matcher = KeywordMatcher({0: ["he", "she"], 1: ["hers"], 2: ["his"], 3: ["zzz"]})
+    assert matcher.search("ushers") == {0, 1}
+    assert matcher.search("this") == {2}
+    assert matcher.search("nothing") == frozenset()
+
+
+def test_keyword_matcher_follows_failure_links():
+    # "abcd" fails after "abc" and must still find "bcd" and "c"
+    matcher = KeywordMatcher({0: ["abce"], 1: ["bcd"], 2: ["c"]})
+    assert matcher.search("xabcdx") == {1, 2}
+
+
+def test_keyword_matcher_is_case_insensitive():
+    matcher = KeywordMatcher({0: ["Sale"], 1: ["促销"]})
+    assert matcher.search("BIG SALE today") == {0}
+    assert matcher.search("今日促销") == {1}
+
+
+def test_keyword_matcher_ignores_empty_keywords():
+    assert KeywordMatcher({0: [""]}).search("anything") == frozenset()
+
+
+def test_rules_without_filters_compile_to_nothing():
+    assert parse_rule_filter({}) is None
+    assert parse_rule_filter({'filters': {}}) is None
+
+
+@pytest.mark.parametrize("filters", [
+    ["sale"],
+    {'keyword': ["sale"]},
+    {'keywords': "sale"},
+    {'keywords': [1]},
+    {'regex': ["("]},
+    {'content_types': ["hologram"]},
+    {'senders': ["alice"]},
+    {'mentions': "yes"},
+])
+def test_invalid_filters_are_rejected(filters):
+    with pytest.raises(ValueError):
+        parse_rule_filter({'filters': filters})
+
+
+def test_filter_checks_all_configured_conditions():
+    rule_filter = parse_rule_filter({'filters': {
+        'keywords': ["sale", "offer"],
+        'exclude_keywords': ["spam"],
+        'regex': [r"\d{3}"],
+        'content_types': ["text", "photo"],
+        'senders': [42],
+    }})
+    compile_keyword_groups([rule_filter])
+    assert rule_filter.matches(features("Sale: 100 items"))
+    assert rule_filter.matches(features("offer 999", content_type="photo"))
+    assert not rule_filter.matches(features("sale 100 spam"))
+    assert not rule_filter.matches(features("sale without digits"))
+    assert not rule_filter.matches(features("nothing 100"))
+    assert not rule_filter.matches(features("sale 100", content_type="video"))
+    assert not rule_filter.matches(features("sale 100", sender_id=7))
+
+
+def test_mentions_filter():
+    only_mentions = parse_rule_filter({'filters': {'mentions': True}})
+    no_mentions = parse_rule_filter({'filters': {'mentions': False}})
+    assert only_mentions.matches(features(is_mention=True))
+    assert not only_mentions.matches(features())
+    assert no_mentions.matches(features())
+
+
+def test_filters_share_one_matcher():
+    first = parse_rule_filter({'filters': {'keywords': ["apple"]}})
+    second = parse_rule_filter({'filters': {'keywords': ["pear"], 'exclude_keywords': ["apple"]}})
+    matcher = compile_keyword_groups([first, second])
+    assert first.matcher is second.matcher is matcher
+    message = features("apple and pear")
+    assert first.matches(message)
+    assert not second.matches(message)
+    assert second.matches(features("just a pear"))
+
+
+def test_keyword_groups_compile_from_a_generator():
+    rule_filter = parse_rule_filter({'filters': {'keywords': ["apple"]}})
+    matcher = compile_keyword_groups(rule_filter for _ in range(1))
+    assert rule_filter.matcher is matcher
+    assert rule_filter.matches(features("an apple"))
@@ -0,0 +1,98 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from bson.objectid import ObjectId
+import database.manager as db_manager
+from bot.handlers import rules as rules_handlers
+
+RULE_ID = ObjectId()
+
+
+def rule(user_id=1, **fields):
+    return {'user_id': user_id, 'source_chats': [-100], 'destination_chats': [5], **fields}
+
+
+def test_rules_files_are_read_as_json_arrays_or_lines():
+    assert rules_handlers._parse_rules_file(b'[{"a": 1}, {"b": 2}]') == [(1, {'a': 1}), (2, {'b': 2})]
+    # Positions are line numbers, so errors point at the right line
+    assert rules_handlers._parse_rules_file('﻿{"a": 1}\n\n{"b": 2}\n'.encode()) == [(1, {'a': 1}), (3, {'b': 2})]
+    with pytest.raises(ValueError, match="第 2 行"):
+        rules_handlers._parse_rules_file(b'{"a": 1}\n{"b": \n')
+
+
+def test_every_invalid_rule_is_reported_and_users_are_looked_up_once(monkeypatch):
+    lookups = []
+
+    async def get_user_by_id(user_id):
+        lookups.append(user_id)
+        return {'user_id': user_id} if user_id == 1 else None
+
+    monkeypatch.setattr(rules_handlers, "get_user_by_id", get_user_by_id)
+    entries = [
+        (1, rule(_id=str(RULE_ID))),
+        (2, rule()),
+        (3, rule(user_id=2)),
+        (4, rule(source_chats=-100)),
+        (5, "not a rule"),
+        (6, rule(_id=str(RULE_ID))),
+        (7, rule(_id="nonsense")),
+    ]
+    rules, errors = asyncio.run(rules_handlers._prepare_rules(entries, None, upsert=True))
+    assert [rule.get('_id') for rule in rules] == [RULE_ID, None]
+    assert [error.split(":")[0] for error in errors] == ["#3", "#4", "#5", "#6", "#7"]
+    assert lookups == [1, 2]
+
+
+def test_exported_ids_are_ignored_without_upsert(monkeypatch):
+    async def get_user_by_id(user_id):
+        return {'user_id': user_id}
+
+    monkeypatch.setattr(rules_handlers, "get_user_by_id", get_user_by_id)
+    rules, errors = asyncio.run(rules_handlers._prepare_rules([(1, rule(user_id=9, _id=str(RULE_ID)))], 1, upsert=False))
+    assert rules == [rule()] and errors == []
+
+
+class FakeRules:
+    """A forwarding_rules collection holding one rule of user 3."""
+
+    def __init__(self):
+        self.writes = None
+        self.bumped = []  # Users whose rules_version was raised
+
+    def find(self, query, projection):
+        async def cursor():
+            if RULE_ID in query['_id']['$in']:
+                yield {'_id': RULE_ID, 'user_id': 3}
+        return cursor()
+
+    async def bulk_write(self, requests, ordered):
+        self.writes = requests
+        replaced = sum(1 for request in requests if type(request).__name__ == "ReplaceOne")
+        return SimpleNamespace(matched_count=replaced, inserted_count=len(requests) - replaced, upserted_count=0)
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = FakeRules()
+
+    async def bump(user_id):
+        collection.bumped.append(user_id)
+
+    monkeypatch.setattr(db_manager, "forwarding_rules", collection)
+    monkeypatch.setattr(db_manager, "_bump_rules_version", bump)
+    monkeypatch.setattr(db_manager.rule_index, "is_loaded", lambda user_id: False)
+    return collection
+
+
+def test_import_writes_one_batch_and_refreshes_every_affected_user(collection):
+    counts = asyncio.run(db_manager.import_forwarding_rules([rule(_id=RULE_ID), rule(), rule(user_id=2)]))
+    assert counts == {'replaced': 1, 'inserted': 2}
+    assert len(collection.writes) == 3
+    # The replaced rule moved from user 3 to user 1
+    assert sorted(collection.bumped) == [1, 2, 3]
+
+
+def test_dry_run_writes_nothing(collection):
+    counts = asyncio.run(db_manager.import_forwarding_rules([rule(_id=RULE_ID), rule()], dry_run=True))
+    assert counts == {'replaced': 1, 'inserted': 1}
+    assert collection.writes is None and collection.bumped == []
@@ -0,0 +1,161 @@
+import pytest
+from config import DIGEST_DEFAULT_WINDOW, DIGEST_DEFAULT_MAX_ITEMS
+from database.rule_filters import MessageFeatures
+from database.rule_index import CompiledRules, RuleIndex, parse_digest_options
+
+
+def rule(rule_id, sources, dests, **extra):
+    return dict({'_id': rule_id, 'source_chats': sources, 'destination_chats': dests}, **extra)
+
+
+def test_route_merges_match_all_destinations():
+    compiled = CompiledRules([
+        rule('a', [-100], [1, 2]),
+        rule('b', [-100, -200], [3]),
+        rule('c', [], [9]),
+    ])
+    assert compiled.route(-100) == {1, 2, 3, 9}
+    assert compiled.route(-200) == {3, 9}
+    assert compiled.route(-300) == {9}
+
+
+def test_route_without_match_all_rules():
+    compiled = CompiledRules([rule('a', [-100], [1])])
+    assert compiled.route(-100) == {1}
+    assert compiled.route(-200) == frozenset()
+    assert compiled.covers(-100)
+    assert not compiled.covers(-200)
+
+
+def test_covers_every_chat_with_a_match_all_rule():
+    compiled = CompiledRules([rule('a', None, [1])])
+    assert compiled.covers(-100)
+    assert compiled.route(-100) == {1}
+
+
+def test_add_patches_the_tables_like_a_rebuild():
+    rules = [rule('a', [-100], [1]), rule('b', [], [2]), rule('c', [-200], [3])]
+    compiled = CompiledRules(rules[:1])
+    for new_rule in rules[1:]:
+        compiled.add(new_rule)
+    rebuilt = CompiledRules(rules)
+    for source in (-100, -200, -300):
+        assert compiled.route(source) == rebuilt.route(source)
+
+
+def test_remove_rebuilds_without_the_rule():
+    compiled = CompiledRules([rule('a', [-100], [1]), rule('b', [], [2])])
+    assert compiled.remove('b')
+    assert compiled.route(-100) == {1}
+    assert compiled.route(-300) == frozenset()
+    assert not compiled.remove('b')
+
+
+def test_index_tracks_rule_owners():
+    index = RuleIndex()
+    assert index.route(7, -100) is None
+    index.load(7, [rule('a', [-100], [1])])
+    index.add_rule(7, rule('b', [-100], [2]))
+    assert index.route(7, -100) == {1, 2}
+    index.remove_rule('a')
+    assert index.route(7, -100) == {2}
+    # Rules of users that are not loaded are ignored
+    index.add_rule(8, rule('c', [-100], [3]))
+    assert index.route(8, -100) is None
+    index.drop_user(7)
+    assert index.route(7, -100) is None
+
+
+def test_parse_digest_options():
+    assert parse_digest_options({}) is None
+    assert parse_digest_options({'digest': False}) is None
+    assert parse_digest_options({'digest': True}) == (DIGEST_DEFAULT_WINDOW, DIGEST_DEFAULT_MAX_ITEMS)
+    assert parse_digest_options({'digest': {'window': 30}}) == (30.0, DIGEST_DEFAULT_MAX_ITEMS)
+    assert parse_digest_options({'digest': {'window': 0.5, 'max_items': 3}}) == (0.5, 3)
+
+
+@pytest.mark.parametrize("digest", [
+    "yes",
+    1,
+    [60],
+    {'window': 0},
+    {'window': -5},
+    {'window': "60"},
+    {'window': True},
+    {'max_items': 0},
+    {'max_items': 2.5},
+    {'max_items': True},
+    {'windows': 60},
+])
+def test_parse_digest_options_rejects_invalid_settings(digest):
+    with pytest.raises(ValueError):
+        parse_digest_options({'digest': digest})
+
+
+def test_digest_route_only_for_destinations_no_immediate_rule_covers():
+    compiled = CompiledRules([
+        rule('a', [-100], [1, 2], digest={'window': 10, 'max_items': 5}),
+        rule('b', [-100], [2]),
+        rule('c', [-100], [1], digest={'window': 30, 'max_items': 2}),
+    ])
+    # The tighter limits of both digest rules apply to destination 1; 2 is delivered immediately
+    assert compiled.digest_route(-100) == {1: (10.0, 2)}
+    assert compiled.route(-100) == {1, 2}
+    assert compiled.digest_route(-200) == {}
+
+
+def test_match_all_digest_yields_to_immediate_rules_of_a_source():
+    compiled = CompiledRules([
+        rule('a', [], [1], digest=True),
+        rule('b', [-100], [1]),
+    ])
+    assert compiled.digest_route(-100) == {}
+    assert compiled.digest_route(-200) == {1: (DIGEST_DEFAULT_WINDOW, DIGEST_DEFAULT_MAX_ITEMS)}
+
+
+def test_stored_rule_with_invalid_digest_delivers_immediately():
+    compiled = CompiledRules([rule('a', [-100], [1], digest={'window': "soon"})])
+    assert compiled.route(-100) == {1}
+    assert compiled.digest_route(-100) == {}
+
+
+def test_adding_a_digest_rule_rebuilds_the_digest_tables():
+    compiled = CompiledRules([rule('a', [-100], [1])])
+    compiled.add(rule('b', [-100], [2], digest=True))
+    assert compiled.digest_route(-100) == {2: (DIGEST_DEFAULT_WINDOW, DIGEST_DEFAULT_MAX_ITEMS)}
+    compiled.remove('b')
+    assert compiled.digest_route(-100) == {}
+
+
+def test_filtered_rules_only_route_matching_messages():
+    compiled = CompiledRules([
+        rule('a', [-100], [1]),
+        rule('b', [-100], [2], filters={'keywords': ["urgent"]}),
+        rule('c', [], [3], filters={'content_types': ["photo"]}),
+    ])
+    assert compiled.route(-100, MessageFeatures("urgent!", "text", 1, False)) == {1, 2}
+    assert compiled.route(-100, MessageFeatures("hello", "photo", 1, False)) == {1, 3}
+    assert compiled.route(-100, MessageFeatures("hello", "text", 1, False)) == {1}
+    assert compiled.route(-200, MessageFeatures("hello", "text", 1, False)) == frozenset()
+    # Without features, filtered rules are skipped
+    assert compiled.route(-100) == {1}
+    # A source whose only rule has filters is still covered when they reject a message
+    assert compiled.covers(-200)
+
+
+def test_stored_rule_with_invalid_filters_matches_nothing():
+    compiled = CompiledRules([rule('a', [-100], [1], filters={'content_types': ["hologram"]})])
+    assert compiled.route(-100, MessageFeatures("hello", "text", 1, False)) == frozenset()
+
+
+def test_sources_include_filtered_rules():
+    index = RuleIndex()
+    index.load(7, [rule('a', [-100], [1]), rule('b', [-200], [2], filters={'keywords': ["x"]})])
+    assert index.is_source(7, -100) and index.is_source(7, -200)
+    assert not index.is_source(7, -300)
+    assert not index.routes_unlisted(7)
+    index.add_rule(7, rule('c', [], [3]))
+    assert index.routes_unlisted(7)
+    # Unknown users may have match-all rules that are not loaded yet
+    assert index.routes_unlisted(8)
+    assert not index.is_source(8, -100)
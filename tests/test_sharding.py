@@ -0,0 +1,257 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from user_clients import sharding as sharding_module
+from user_clients.sharding import ShardWorker
+from user_clients.supervisor import ClientSupervisor
+
+TTL = 60
+USERS = [1, 2]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeLeases:
+    """The `client_leases` collection on a fake clock; every operation fails while `failing` is set."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.leases = {}  # {user_id: (worker_id, expires_at)}
+        self.renewals = 0
+        self.renewal_gate = None  # Holds renewals in flight until set
+        self.failing = False
+
+    async def claim(self, user_id, worker_id, ttl):
+        self._check()
+        owner, expires_at = self.leases.get(user_id, (None, 0))
+        if owner not in (None, worker_id) and expires_at >= self.clock.now:
+            return False
+        self.leases[user_id] = (worker_id, self.clock.now + ttl)
+        return True
+
+    async def renew(self, worker_id, ttl):
+        self._check()
+        self.renewals += 1
+        held = [user_id for user_id, (owner, _) in self.leases.items() if owner == worker_id]
+        if self.renewal_gate is not None:
+            # The query has read the leases; its answer is still on the way
+            await self.renewal_gate.wait()
+        for user_id in held:
+            self.leases[user_id] = (worker_id, self.clock.now + ttl)
+        return held
+
+    async def release(self, worker_id, user_ids):
+        self._check()
+        for user_id in user_ids:
+            if self.leases.get(user_id, (None,))[0] == worker_id:
+                del self.leases[user_id]
+
+    async def active(self, user_ids=None):
+        self._check()
+        return {
+            user_id: {'worker_id': owner} for user_id, (owner, expires_at) in self.leases.items()
+            if expires_at >= self.clock.now
+        }
+
+    def _check(self):
+        if self.failing:
+            raise ConnectionError("database unavailable")
+
+
+class FakeManager:
+    """Starts clients only once `gate` is set, so a test can hold a startup open."""
+
+    def __init__(self):
+        self.running_clients = {}
+        self.stopped = []
+        self.restarted = []
+        self.gate = asyncio.Event()
+        self.supervisor = ClientSupervisor(self)
+
+    async def start_client(self, user_id, session_string):
+        self.restarted.append(user_id)
+        self.running_clients[user_id] = object()
+        return True
+
+    async def start_clients(self, users):
+        await self.gate.wait()
+        for user in users:
+            self.running_clients[user['user_id']] = object()
+        return {user['user_id']: True for user in users}
+
+    async def stop_client(self, user_id):
+        self.running_clients.pop(user_id, None)
+        self.stopped.append(user_id)
+
+    async def stop_all(self):
+        self.running_clients.clear()
+
+
+@pytest.fixture
+def fleet(monkeypatch):
+    clock = FakeClock()
+    leases = FakeLeases(clock)
+
+    async def get_managed_users(refresh=False):
+        return [{'user_id': user_id} for user_id in USERS]
+
+    async def get_sessions(user_ids):
+        return [{'user_id': user_id, 'session_string': "session"} for user_id in user_ids]
+
+    async def noop(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(sharding_module, "time", clock)
+    # The heartbeat waits for real but in short steps; leases expire on the fake clock
+    monkeypatch.setattr(sharding_module, "LEASE_TTL", TTL)
+    monkeypatch.setattr(sharding_module, "LEASE_HEARTBEAT", 0.01)
+    monkeypatch.setattr(sharding_module, "claim_client_lease", leases.claim)
+    monkeypatch.setattr(sharding_module, "renew_client_leases", leases.renew)
+    monkeypatch.setattr(sharding_module, "release_client_leases", leases.release)
+    monkeypatch.setattr(sharding_module, "get_active_client_leases", leases.active)
+    monkeypatch.setattr(sharding_module, "get_managed_users", get_managed_users)
+    monkeypatch.setattr(sharding_module, "get_sessions", get_sessions)
+    monkeypatch.setattr(sharding_module, "load_rule_index", noop)
+    monkeypatch.setattr(sharding_module, "report_client_health", noop)
+
+    def make_worker():
+        manager = FakeManager()
+        monkeypatch.setattr(sharding_module, "user_client_manager", manager)
+        return ShardWorker("w1"), manager
+
+    return SimpleNamespace(clock=clock, leases=leases, make_worker=make_worker)
+
+
+async def started(worker, manager):
+    manager.gate.set()
+    await worker.start()
+
+
+async def halt(worker):
+    for task in (worker._task, worker._heartbeat):
+        task.cancel()
+    await asyncio.gather(worker._task, worker._heartbeat, return_exceptions=True)
+
+
+def test_leases_are_renewed_while_a_slow_startup_runs(fleet):
+    async def scenario():
+        worker, manager = fleet.make_worker()
+        starting = asyncio.create_task(worker.start())
+        await asyncio.sleep(0.05)
+        assert fleet.leases.leases and not manager.running_clients
+
+        # Startup takes longer than the lease TTL
+        for _ in range(10):
+            fleet.clock.now += TTL / 4
+            await asyncio.sleep(0.03)
+        assert not await fleet.leases.claim(1, "w2", TTL)
+
+        manager.gate.set()
+        await starting
+        await halt(worker)
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert set(manager.running_clients) == set(USERS) and manager.stopped == []
+    assert fleet.leases.renewals > 2
+
+
+def test_a_lease_lost_after_a_renewal_stops_its_client(fleet):
+    async def scenario():
+        worker, manager = fleet.make_worker()
+        await started(worker, manager)
+        fleet.leases.leases[1] = ("w2", fleet.clock.now + TTL)
+        await asyncio.sleep(0.05)
+        await halt(worker)
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert manager.stopped == [1]
+    assert set(manager.running_clients) == {2}
+
+
+def test_repeated_renewal_failures_stop_all_local_clients(fleet):
+    async def scenario():
+        worker, manager = fleet.make_worker()
+        await started(worker, manager)
+        fleet.leases.failing = True
+
+        # Failures are tolerated while the leases cannot have expired yet
+        await asyncio.sleep(0.05)
+        assert set(manager.running_clients) == set(USERS)
+
+        fleet.clock.now += TTL
+        await asyncio.sleep(0.05)
+        await halt(worker)
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert manager.running_clients == {}
+    assert sorted(manager.stopped) == USERS
+
+
+def test_a_client_waiting_for_a_restart_is_not_restarted_without_its_lease(fleet):
+    async def scenario():
+        worker, manager = fleet.make_worker()
+        await started(worker, manager)
+        # The client of user 1 failed and waits for its backoff to pass
+        await manager.stop_client(1)
+        await manager.supervisor.failed(1, "session", ConnectionError("connection lost"))
+        assert manager.supervisor.is_retrying(1)
+
+        fleet.leases.leases[1] = ("w2", fleet.clock.now + TTL)
+        await asyncio.sleep(0.05)
+        manager.supervisor.health[1].next_attempt_at = 0
+        await manager.supervisor.check()
+        await halt(worker)
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert not manager.supervisor.is_retrying(1)
+    assert manager.restarted == [] and 1 not in manager.running_clients
+
+
+def test_the_supervisor_skips_users_whose_lease_is_gone(fleet):
+    async def scenario():
+        worker, manager = fleet.make_worker()
+        await started(worker, manager)
+        await halt(worker)
+        await manager.stop_client(1)
+        await manager.supervisor.failed(1, "session", ConnectionError("connection lost"))
+        # Lost between two renewals, before the worker noticed
+        worker._held.discard(1)
+        manager.supervisor.health[1].next_attempt_at = 0
+        await manager.supervisor.check()
+        return manager
+
+    manager = asyncio.run(scenario())
+    assert manager.restarted == [] and not manager.supervisor.is_retrying(1)
+
+
+def test_a_claim_made_during_a_renewal_is_kept(fleet):
+    async def scenario():
+        worker, manager = fleet.make_worker()
+        await started(worker, manager)
+        await halt(worker)
+        USERS.append(3)
+        try:
+            fleet.leases.renewal_gate = asyncio.Event()
+            renewal = asyncio.create_task(worker._renew())
+            await asyncio.sleep(0)
+            # The tick claims user 3 after the renewal query read the leases
+            fleet.leases.renewal_gate.set()
+            await worker._tick()
+            await renewal
+        finally:
+            USERS.remove(3)
+        return worker, manager
+
+    worker, manager = asyncio.run(scenario())
+    assert 3 in worker._held
+    assert 3 in manager.running_clients and manager.stopped == []
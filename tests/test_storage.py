@@ -0,0 +1,181 @@
+import asyncio
+import pytest
+from user_clients import storage as storage_module
+from user_clients.storage import MongoSessionStorage, SessionWriter
+
+
+class FakeDatabase:
+    """Stores the written peers and session states; every write fails while `failing` is set."""
+
+    def __init__(self):
+        self.peers = {}  # {peer_id: document}
+        self.sessions = {}  # {owner_id: document}
+        self.reads = []
+        self.failing = False
+
+    async def find_peer(self, user_id, query):
+        self.reads.append(query)
+        for document in self.peers.values():
+            if document['owner_id'] != user_id:
+                continue
+            if 'peer_id' in query and document['peer_id'] != query['peer_id']:
+                continue
+            if 'usernames' in query and query['usernames'] not in document['usernames']:
+                continue
+            return document
+        return None
+
+    async def save(self, peers, sessions):
+        if self.failing:
+            raise ConnectionError("database unavailable")
+        for peer in peers:
+            self.peers[peer['peer_id']] = peer
+        for session in sessions:
+            self.sessions[session['_id']] = session
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(storage_module, "find_client_peer", database.find_peer)
+    monkeypatch.setattr(storage_module, "save_client_state", database.save)
+    monkeypatch.setattr(storage_module, "session_writer", SessionWriter())
+    return database
+
+
+def make_storage():
+    return MongoSessionStorage("user_1", 1, "session")
+
+
+def peer(peer_id, access_hash=10, username=None):
+    return (peer_id, access_hash, "user", username, None)
+
+
+def test_known_peers_are_served_from_memory(database):
+    async def scenario():
+        storage = make_storage()
+        await storage.update_peers([peer(100), peer(200)])
+        return storage, await storage.get_peer_by_id(100)
+
+    storage, input_peer = asyncio.run(scenario())
+    assert (input_peer.user_id, input_peer.access_hash) == (100, 10)
+    assert database.reads == []
+
+
+def test_unchanged_peers_are_not_written_again(database):
+    async def scenario():
+        storage = make_storage()
+        writer = storage_module.session_writer
+        await storage.update_peers([peer(100)])
+        await writer.flush()
+        # Every update carries its peers again
+        await storage.update_peers([peer(100)])
+        await writer.flush()
+        await storage.update_peers([peer(100, access_hash=11)])
+        await writer.flush()
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert writer.written_peers == 2
+    assert database.peers[100]['access_hash'] == 11
+
+
+def test_unknown_peers_are_read_from_the_database_and_cached(database):
+    async def scenario():
+        writer_storage = make_storage()
+        await writer_storage.update_peers([peer(100)])
+        await storage_module.session_writer.flush()
+
+        # A restarted client only has the database
+        storage = make_storage()
+        await storage.get_peer_by_id(100)
+        await storage.get_peer_by_id(100)
+        with pytest.raises(KeyError):
+            await storage.get_peer_by_id(300)
+
+    asyncio.run(scenario())
+    assert database.reads == [{'peer_id': 100}, {'peer_id': 300}]
+
+
+def test_peers_are_found_by_every_username(database):
+    async def scenario():
+        storage = make_storage()
+        await storage.update_peers([peer(100, username="first")])
+        await storage.update_usernames([(100, "second")])
+        await storage_module.session_writer.flush()
+        by_first = await storage.get_peer_by_username("first")
+        by_second = await storage.get_peer_by_username("second")
+        with pytest.raises(KeyError):
+            await storage.get_peer_by_username("third")
+        return by_first, by_second
+
+    by_first, by_second = asyncio.run(scenario())
+    assert by_first.user_id == by_second.user_id == 100
+    assert database.peers[100]['usernames'] == ["first", "second"]
+
+
+def test_failed_flush_keeps_its_writes_for_the_next_one(database):
+    async def scenario():
+        storage = make_storage()
+        writer = storage_module.session_writer
+        await storage.update_peers([peer(100), peer(200)])
+        await storage.date(1234)
+        database.failing = True
+        with pytest.raises(ConnectionError):
+            await writer.flush()
+        # Changed while the write failed: the newer version must win
+        await storage.update_peers([peer(200, access_hash=22)])
+        database.failing = False
+        await writer.flush()
+
+    asyncio.run(scenario())
+    assert sorted(database.peers) == [100, 200]
+    assert database.peers[200]['access_hash'] == 22
+    assert database.sessions[1]['date'] == 1234
+
+
+def test_usernames_are_served_from_memory(database):
+    async def scenario():
+        storage = make_storage()
+        await storage.update_peers([peer(100, username="first")])
+        await storage.update_usernames([(100, "first"), (100, "second")])
+        return await storage.get_peer_by_username("first"), await storage.get_peer_by_username("second")
+
+    by_first, by_second = asyncio.run(scenario())
+    assert by_first.user_id == by_second.user_id == 100
+    assert database.reads == []
+
+
+def test_usernames_read_from_the_database_are_cached(database):
+    async def scenario():
+        writer_storage = make_storage()
+        await writer_storage.update_peers([peer(100, username="first")])
+        await storage_module.session_writer.flush()
+
+        storage = make_storage()
+        await storage.get_peer_by_username("first")
+        await storage.get_peer_by_username("first")
+
+    asyncio.run(scenario())
+    assert len(database.reads) == 1
+
+
+def test_new_usernames_of_a_written_peer_are_written(database):
+    async def scenario():
+        storage = make_storage()
+        writer = storage_module.session_writer
+        await storage.update_peers([peer(100, username="first")])
+        await writer.flush()
+        # The peer is unchanged, but has gained a second username
+        await storage.update_peers([peer(100, username="first")])
+        await storage.update_usernames([(100, "first"), (100, "second")])
+        await writer.flush()
+        # Nothing new the next time
+        await storage.update_peers([peer(100, username="first")])
+        await storage.update_usernames([(100, "first"), (100, "second")])
+        await writer.flush()
+        return writer
+
+    writer = asyncio.run(scenario())
+    assert database.peers[100]['usernames'] == ["first", "second"]
+    assert writer.written_peers == 2
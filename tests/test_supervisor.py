@@ -0,0 +1,119 @@
+import asyncio
+import pytest
+from pyrogram.errors import AuthKeyDuplicated
+from user_clients import supervisor as supervisor_module
+from user_clients.supervisor import BACKOFF, REVOKED, RUNNING, ClientSupervisor
+
+
+class FakeClient:
+    def __init__(self, error=None):
+        self.is_connected = True
+        self.error = error
+
+    async def invoke(self, query):
+        if self.error is not None:
+            raise self.error
+
+
+class FakeManager:
+    """Starts a healthy client for every restart, like a session that recovered."""
+
+    def __init__(self):
+        self.running_clients = {}
+        self.supervisor = ClientSupervisor(self)
+        self.starts = []
+
+    async def start_client(self, user_id, session_string):
+        self.starts.append(user_id)
+        self.running_clients[user_id] = FakeClient()
+        self.supervisor.started(user_id, session_string)
+        return True
+
+    async def stop_client(self, user_id):
+        self.supervisor.forget(user_id)
+        self.running_clients.pop(user_id, None)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(supervisor_module.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(supervisor_module.random, "uniform", lambda low, high: 1.0)
+    monkeypatch.setattr(supervisor_module, "SUPERVISOR_BACKOFF_BASE", 10)
+    monkeypatch.setattr(supervisor_module, "SUPERVISOR_BACKOFF_MAX", 60)
+    return now
+
+
+@pytest.fixture
+def revoked(monkeypatch):
+    revoked = []
+
+    async def mark_session_revoked(user_id, reason):
+        revoked.append(user_id)
+
+    monkeypatch.setattr(supervisor_module, "mark_session_revoked", mark_session_revoked)
+    return revoked
+
+
+def test_backoff_doubles_up_to_the_maximum(clock):
+    supervisor = FakeManager().supervisor
+    delays = []
+
+    async def scenario():
+        for _ in range(5):
+            await supervisor.failed(1, "session", ConnectionError("down"))
+            delays.append(supervisor.health[1].next_attempt_at - clock[0])
+
+    asyncio.run(scenario())
+    assert delays == [10, 20, 40, 60, 60]
+    assert supervisor.health[1].state == BACKOFF and supervisor.is_retrying(1)
+
+
+def test_failed_client_is_restarted_once_its_backoff_has_passed(clock):
+    manager = FakeManager()
+
+    async def scenario():
+        await manager.start_client(1, "session")
+        manager.running_clients[1].error = TimeoutError("no answer")
+        await manager.supervisor.check()
+        assert 1 not in manager.running_clients and manager.supervisor.health[1].state == BACKOFF
+        clock[0] += 9
+        await manager.supervisor.check()
+        assert manager.starts == [1]
+        clock[0] += 1
+        await manager.supervisor.check()
+
+    asyncio.run(scenario())
+    health = manager.supervisor.health[1]
+    assert manager.starts == [1, 1]
+    assert health.state == RUNNING and health.restarts == 1 and health.failures == 0
+
+
+def test_revoked_session_opens_the_circuit(clock, revoked):
+    manager = FakeManager()
+
+    async def scenario():
+        await manager.start_client(1, "session")
+        manager.running_clients[1].error = AuthKeyDuplicated()
+        await manager.supervisor.check()
+        clock[0] += 3600
+        await manager.supervisor.check()
+
+    asyncio.run(scenario())
+    assert revoked == [1]
+    assert manager.starts == [1]
+    assert manager.supervisor.health[1].state == REVOKED and manager.supervisor.is_revoked(1)
+
+
+def test_clients_stopped_on_purpose_are_not_restarted(clock):
+    manager = FakeManager()
+
+    async def scenario():
+        await manager.supervisor.failed(1, "session", ConnectionError("down"))
+        await manager.stop_client(1)
+        clock[0] += 3600
+        await manager.supervisor.check()
+
+    asyncio.run(scenario())
+    assert manager.starts == []
+    assert not manager.supervisor.is_retrying(1)
@@ -0,0 +1,22 @@
+from utils.telegram_text import truncate_html
+
+
+def test_short_text_is_left_alone():
+    assert truncate_html("<b>a</b>", 8) == "<b>a</b>"
+
+
+def test_truncate_html_closes_the_tags_it_cuts_into():
+    entry = '<b>12:00</b> <a href="tg://user?id=1">Name</a>'
+    # The cut would fall inside the href and then inside the link text
+    assert truncate_html(entry, 30) == "<b>12:00</b> …"
+    assert truncate_html(entry, 45) == '<b>12:00</b> <a href="tg://user?id=1">Na…</a>'
+
+
+def test_truncate_html_never_cuts_an_entity():
+    assert truncate_html("a &amp; b &amp; c", 8) == "a &amp;…"
+
+
+def test_truncated_text_fits_the_limit():
+    text = "<b>" + "x" * 100 + "</b>" + "<i>y</i>" * 50
+    for limit in range(1, len(text)):
+        assert len(truncate_html(text, limit)) <= limit
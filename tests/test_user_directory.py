@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+import database.manager as db_manager
+from database import user_directory as user_directory_module
+from database.user_directory import UserDirectory
+
+
+class FakeUsers:
+    """A managed_users collection that counts its reads."""
+
+    def __init__(self, users):
+        self.users = users
+        self.reads = 0
+
+    def find(self, query, projection):
+        self.reads += 1
+        users = [dict(user) for user in self.users]
+
+        class Cursor:
+            async def to_list(self, length):
+                return users
+
+        return Cursor()
+
+    async def find_one(self, query, projection):
+        self.reads += 1
+        return next((dict(user) for user in self.users if user['user_id'] == query['user_id']), None)
+
+
+@pytest.fixture
+def users(monkeypatch):
+    users = FakeUsers([{'user_id': 2, 'is_active': True}, {'user_id': 1, 'is_active': True}, {'user_id': 3}])
+    monkeypatch.setattr(db_manager, "managed_users", users)
+    monkeypatch.setattr(db_manager, "user_directory", UserDirectory(ttl=60))
+    return users
+
+
+def test_directory_expires_after_its_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(user_directory_module.time, "monotonic", lambda: now[0])
+    directory = UserDirectory(ttl=60)
+    assert not directory.is_fresh()
+    directory.replace([{'user_id': 1, 'is_active': True}])
+    now[0] += 59
+    assert directory.is_fresh()
+    now[0] += 1
+    assert not directory.is_fresh()
+
+
+def test_directory_lists_active_users_in_order_and_applies_writes():
+    directory = UserDirectory(ttl=60)
+    directory.replace([{'user_id': 2, 'is_active': True}, {'user_id': 1, 'is_active': True}, {'user_id': 3}])
+    assert [user['user_id'] for user in directory.active_users()] == [1, 2]
+    directory.update(2, {'is_active': False})
+    directory.update(4, {'is_active': True})
+    assert [user['user_id'] for user in directory.active_users()] == [1, 4]
+
+
+def test_lookups_are_served_from_the_directory(users):
+    async def scenario():
+        return [await db_manager.get_user_by_id(user_id) for user_id in (1, 2, 1)], await db_manager.get_managed_users()
+
+    found, active = asyncio.run(scenario())
+    assert [user['user_id'] for user in found] == [1, 2, 1]
+    assert [user['user_id'] for user in active] == [1, 2]
+    assert users.reads == 1
+
+
+def test_users_added_by_another_process_are_looked_up(users):
+    async def scenario():
+        await db_manager.get_managed_users()
+        users.users.append({'user_id': 5, 'is_active': True})
+        return await db_manager.get_user_by_id(5), await db_manager.get_user_by_id(6)
+
+    added, unknown = asyncio.run(scenario())
+    assert added['user_id'] == 5 and unknown is None
+    assert users.reads == 3
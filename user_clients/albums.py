@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Tuple
+from pyrogram import Client
+from pyrogram.types import Message
+from config import ALBUM_WINDOW, ALBUM_MAX_DELAY, ALBUM_MAX_PENDING
+
+logger = logging.getLogger(__name__)
+
+# Telegram albums contain at most 10 items
+ALBUM_MAX_PARTS = 10
+
+
+class _PendingAlbum:
+    __slots__ = ("client", "messages", "started", "timer")
+
+    def __init__(self, client: Client):
+        self.client = client
+        self.messages: List[Message] = []
+        self.started = time.monotonic()
+        self.timer = None
+
+
+class AlbumAggregator:
+    """
+    Collects the parts of an album, which Telegram delivers as separate updates,
+    and hands each complete album to `on_album` as one batch.
+    An album is flushed ALBUM_WINDOW seconds after its latest part, but never later than
+    ALBUM_MAX_DELAY seconds after its first one, or immediately once it holds 10 parts.
+    At most ALBUM_MAX_PENDING albums are buffered; beyond that the oldest is flushed early.
+    """
+
+    def __init__(self, on_album: Callable[[Client, List[Message]], Awaitable[None]]):
+        self.on_album = on_album
+        self._pending: "OrderedDict[Tuple[int, int, str], _PendingAlbum]" = OrderedDict()
+        self._tasks = set()  # Albums currently being delivered
+
+    def add(self, client: Client, message: Message):
+        key = (client.me.id, message.chat.id, message.media_group_id)
+        album = self._pending.get(key)
+        if album is None:
+            album = _PendingAlbum(client)
+            self._pending[key] = album
+            while len(self._pending) > ALBUM_MAX_PENDING:
+                oldest_key = next(iter(self._pending))
+                logger.warning(f"Too many pending albums; flushing album {oldest_key[2]} early.")
+                self.flush(oldest_key)
+
+        album.messages.append(message)
+        if album.timer is not None:
+            album.timer.cancel()
+            album.timer = None
+
+        if len(album.messages) >= ALBUM_MAX_PARTS:
+            self.flush(key)
+            return
+
+        delay = min(ALBUM_WINDOW, album.started + ALBUM_MAX_DELAY - time.monotonic())
+        album.timer = asyncio.get_running_loop().call_later(max(delay, 0), self.flush, key)
+
+    def flush(self, key: Tuple[int, int, str]):
+        """Hands a pending album to `on_album`, ordered by message ID."""
+        album = self._pending.pop(key, None)
+        if album is None:
+            return
+        if album.timer is not None:
+            album.timer.cancel()
+        messages = sorted(album.messages, key=lambda message: message.id)
+        task = asyncio.create_task(self._dispatch(album.client, messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, client: Client, messages: List[Message]):
+        try:
+            await self.on_album(client, messages)
+        except Exception as e:
+            logger.error(f"Failed to deliver album {messages[0].media_group_id}. Error: {e}", exc_info=True)
+
+    def flush_all(self):
+        for key in list(self._pending):
+            self.flush(key)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def in_flight_count(self) -> int:
+        return len(self._tasks)
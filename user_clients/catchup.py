@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+from pyrogram.filters import Filter
+from pyrogram.types import Message
+from config import CATCHUP_MAX_MESSAGES, CATCHUP_MAX_AGE, CATCHUP_HISTORY_RATE, CATCHUP_REPLAY_RATE
+from database.manager import get_chat_checkpoints, save_chat_checkpoints
+from bot.outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Checkpoints are written to the database every this many seconds
+CHECKPOINT_FLUSH_INTERVAL = 5
+# Dialogs and history are fetched in pages of this size by Pyrogram
+PAGE_SIZE = 100
+
+
+class CatchUp:
+    """
+    Replays the messages a user client missed while it was offline.
+    The handler records the newest message it saw per (user, chat) as a checkpoint. When a
+    client starts, its dialogs are scanned for chats with newer messages than their checkpoint,
+    and those messages (at most CATCHUP_MAX_MESSAGES per chat, no older than CATCHUP_MAX_AGE)
+    are passed oldest first through the live filter and handler. History requests and replayed
+    messages are paced by token buckets shared by all clients, so a long outage is caught up
+    slowly instead of setting off a FloodWait cascade.
+    While a client catches up, the first message its live handler sees in each chat marks where
+    the live updates begin; the replay of that chat stops there, so no message is handled twice.
+    """
+
+    def __init__(self, handler: Callable[[Client, Message], Awaitable[None]], message_filter: Filter):
+        self.handler = handler
+        self.message_filter = message_filter
+        self._history_bucket = TokenBucket(CATCHUP_HISTORY_RATE, 1)
+        self._replay_bucket = TokenBucket(CATCHUP_REPLAY_RATE, CATCHUP_REPLAY_RATE)
+        self._checkpoints: Dict[Tuple[int, int], int] = {}  # {(user_id, chat_id): message_id}
+        self._dirty: Dict[Tuple[int, int], int] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}  # {user_id: catch-up in progress}
+        self._live_floors: Dict[Tuple[int, int], int] = {}  # {(user_id, chat_id): first message handled live}
+        self._replaying: Set[Tuple[int, int, int]] = set()  # (user_id, chat_id, message_id) being replayed
+        self._flusher = None
+        self.replayed = 0
+
+    async def start(self):
+        self._flusher = asyncio.create_task(self._run_flusher())
+
+    async def stop(self):
+        """Cancels running catch-ups and writes the remaining checkpoints."""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    def record(self, user_id: int, message: Message):
+        """Remembers a handled message as the newest one of its chat. Called on the hot path."""
+        key = (user_id, message.chat.id)
+        if message.id > self._checkpoints.get(key, 0):
+            self._checkpoints[key] = message.id
+            self._dirty[key] = message.id
+        if user_id in self._tasks and (*key, message.id) not in self._replaying:
+            self._live_floors[key] = min(self._live_floors.get(key, message.id), message.id)
+
+    async def flush(self):
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        try:
+            await save_chat_checkpoints([
+                {'user_id': user_id, 'chat_id': chat_id, 'message_id': message_id}
+                for (user_id, chat_id), message_id in dirty.items()
+            ])
+        except Exception:
+            for key, message_id in dirty.items():
+                self._dirty.setdefault(key, message_id)
+            raise
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to save catch-up checkpoints. Error: {e}", exc_info=True)
+
+    def schedule(self, client: Client):
+        """Starts catching up a freshly started client in the background."""
+        if CATCHUP_MAX_MESSAGES <= 0:
+            return
+        user_id = client.me.id
+        self.cancel(user_id)
+        # Taken before any live update is handled, so those cannot advance past missed messages
+        known = {chat_id: message_id for (owner, chat_id), message_id in self._checkpoints.items() if owner == user_id}
+        task = asyncio.create_task(self._catch_up(client, known))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda _: self._finished(user_id, task))
+
+    def cancel(self, user_id: int):
+        task = self._tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+            self._forget_live_floors(user_id)
+
+    def _finished(self, user_id: int, task: asyncio.Task):
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+            self._forget_live_floors(user_id)
+
+    def _forget_live_floors(self, user_id: int):
+        for key in [key for key in self._live_floors if key[0] == user_id]:
+            del self._live_floors[key]
+
+    async def _catch_up(self, client: Client, known: Dict[int, int]):
+        user_id = client.me.id
+        try:
+            checkpoints = await get_chat_checkpoints(user_id)
+            for chat_id, message_id in known.items():
+                checkpoints[chat_id] = max(checkpoints.get(chat_id, 0), message_id)
+            for chat_id, message_id in checkpoints.items():
+                key = (user_id, chat_id)
+                self._checkpoints[key] = max(self._checkpoints.get(key, 0), message_id)
+
+            missed = await self._find_missed_chats(client, checkpoints)
+            replayed = 0
+            for chat_id, checkpoint, newest in missed:
+                replayed += await self._replay_chat(client, chat_id, checkpoint, newest)
+            if missed:
+                logger.info(
+                    f"User client {user_id}: Caught up {replayed} missed messages in {len(missed)} chats."
+                )
+        except FloodWait as e:
+            logger.warning(f"User client {user_id}: Catch-up stopped by a FloodWait of {e.value}s.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"User client {user_id}: Catch-up failed. Error: {e}", exc_info=True)
+
+    async def _find_missed_chats(self, client: Client, checkpoints: Dict[int, int]) -> List[Tuple[int, int, int]]:
+        """
+        Returns [(chat_id, checkpoint, newest message ID)] for chats with messages newer than their checkpoint.
+        Dialogs come most recently active first, so the scan stops at the first one that has
+        been quiet for longer than CATCHUP_MAX_AGE.
+        """
+        if not checkpoints:
+            return []
+        cutoff = time.time() - CATCHUP_MAX_AGE
+        missed = []
+        scanned = 0
+        await self._history_bucket.acquire()
+        async for dialog in client.get_dialogs():
+            scanned += 1
+            if scanned % PAGE_SIZE == 0:
+                # The next dialog comes from a new page request
+                await self._history_bucket.acquire()
+            top_message = dialog.top_message
+            if top_message is None or top_message.date is None:
+                continue
+            if top_message.date.timestamp() < cutoff:
+                if dialog.is_pinned:
+                    continue
+                break
+            checkpoint = checkpoints.get(dialog.chat.id)
+            if checkpoint is not None and top_message.id > checkpoint:
+                missed.append((dialog.chat.id, checkpoint, top_message.id))
+        return missed
+
+    async def _replay_chat(self, client: Client, chat_id: int, checkpoint: int, newest: int) -> int:
+        """
+        Replays the messages of one chat after `checkpoint` up to `newest`, oldest first.
+        Later messages arrived live and went through the handler already, and so may the newest ones
+        up to `newest` if they arrived after the client started: the replay stops at the first
+        message the live handler saw. Returns how many were handled.
+        """
+        user_id = client.me.id
+        cutoff = time.time() - CATCHUP_MAX_AGE
+        messages = []
+        await self._history_bucket.acquire()
+        async for message in client.get_chat_history(
+            chat_id, limit=CATCHUP_MAX_MESSAGES, min_id=checkpoint, max_id=newest + 1
+        ):
+            # Newest first: everything after the first message that is too old is too old as well
+            if message.date is not None and message.date.timestamp() < cutoff:
+                break
+            messages.append(message)
+            if len(messages) % PAGE_SIZE == 0:
+                await self._history_bucket.acquire()
+
+        handled = 0
+        for message in reversed(messages):
+            if not await self.message_filter(client, message):
+                continue
+            await self._replay_bucket.acquire()
+            # Read after the wait: live updates keep arriving while the replay is paced
+            if message.id >= self._live_floors.get((user_id, chat_id), newest + 1):
+                break
+            replay_key = (user_id, chat_id, message.id)
+            self._replaying.add(replay_key)
+            try:
+                await self.handler(client, message)
+            finally:
+                self._replaying.discard(replay_key)
+            handled += 1
+        self.replayed += handled
+        return handled
@@ -0,0 +1,69 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List
+from config import DEDUP_TTL, DEDUP_MAX_SIZE, DEDUP_BACKEND
+from database.manager import claim_dedup_keys
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DedupCache:
+    """
+    Remembers which (source chat, message ID, destination) deliveries already happened,
+    so a message seen by several managed accounts reaches each destination once.
+    Keys live in a bounded in-memory LRU with a TTL; with the "mongo" backend, keys that
+    are new to this process are additionally claimed in MongoDB so that separate worker
+    processes agree on who delivers.
+    """
+
+    def __init__(self, ttl: float, max_size: int, backend: str):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.backend = backend
+        self._seen: "OrderedDict[Hashable, float]" = OrderedDict()  # {key: expires_at}
+        self.hits = 0
+        self.misses = 0
+
+    def _seen_locally(self, key: Hashable, now: float) -> bool:
+        expires_at = self._seen.get(key)
+        if expires_at is None:
+            return False
+        if expires_at < now:
+            del self._seen[key]
+            return False
+        self._seen.move_to_end(key)
+        return True
+
+    def _remember(self, key: Hashable, now: float):
+        self._seen[key] = now + self.ttl
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+    async def claim(self, keys: List[Hashable]) -> List[Hashable]:
+        """Records the given keys and returns those that had not been seen before."""
+        now = time.monotonic()
+        new_keys = [key for key in keys if not self._seen_locally(key, now)]
+        if new_keys and self.backend == "mongo":
+            try:
+                claimed = set(await claim_dedup_keys([":".join(map(str, key)) for key in new_keys]))
+                new_keys = [key for key in new_keys if ":".join(map(str, key)) in claimed]
+            except Exception as e:
+                # Fail open: a duplicate is better than a lost notification
+                logger.error(f"Could not claim dedup keys in the database. Error: {e}", exc_info=True)
+
+        for key in keys:
+            self._remember(key, now)
+        self.hits += len(keys) - len(new_keys)
+        self.misses += len(new_keys)
+        return new_keys
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._seen), "hits": self.hits, "misses": self.misses}
+
+
+# Shared by every user client in this process
+delivery_dedup = DedupCache(DEDUP_TTL, DEDUP_MAX_SIZE, DEDUP_BACKEND)
+metrics.dedup_lookups.set_function(lambda: {("hit",): delivery_dedup.hits, ("miss",): delivery_dedup.misses})
@@ -0,0 +1,126 @@
+import asyncio
+import html
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+from database.rule_index import DigestOptions
+from utils.telegram_text import MAX_MESSAGE_LENGTH, truncate_html
+
+logger = logging.getLogger(__name__)
+
+
+def split_digest(header: str, entries: List[str], limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Joins digest entries into as few messages as possible, each at most `limit` characters.
+    Messages are only split between entries so HTML tags are never cut in half;
+    a single entry longer than the limit is truncated with `truncate_html`.
+    When more than one message is needed, the first line of each header is labelled "(i/n)".
+    """
+    reserve = 0
+    while True:
+        bodies = _group_entries(entries, limit - len(header) - reserve)
+        label_length = len(f" ({len(bodies)}/{len(bodies)})") if len(bodies) > 1 else 0
+        # A label longer than the room kept for it means fewer entries fit; split again
+        if label_length <= reserve:
+            break
+        reserve = label_length
+    if len(bodies) == 1:
+        return [header + bodies[0]]
+    title = header.rstrip("\n")
+    rest = header[len(title):]
+    return [f"{title} ({number}/{len(bodies)}){rest}{body}" for number, body in enumerate(bodies, 1)]
+
+
+def _group_entries(entries: List[str], limit: int) -> List[str]:
+    """Joins the entries into bodies of at most `limit` characters, separated by blank lines."""
+    bodies = []
+    current = ""
+    for entry in entries:
+        entry = truncate_html(entry, limit)
+        if current and len(current) + 2 + len(entry) > limit:
+            bodies.append(current)
+            current = ""
+        current = f"{current}\n\n{entry}" if current else entry
+    if current:
+        bodies.append(current)
+    return bodies
+
+
+class _PendingDigest:
+    __slots__ = ("title", "entries", "message_ids", "max_items", "timer")
+
+    def __init__(self, title: str, max_items: int):
+        self.title = title
+        self.entries: List[str] = []
+        self.message_ids: List[int] = []
+        self.max_items = max_items
+        self.timer = None
+
+
+class DigestBuffer:
+    """
+    Coalesces notifications for rules in digest mode.
+    Entries are buffered per (user, source chat, destination) and sent as one combined
+    message when the rule's window elapses or its max_items is reached, whichever comes first.
+    Each message is sent with a digest ID made of the first and last source message IDs (and
+    the part number when split), so sending the same digest again yields the same ID.
+    """
+
+    def __init__(self, send: Callable[[int, int, int, str, str], Awaitable[None]]):
+        self.send = send
+        self._pending: Dict[Tuple[int, int, int], _PendingDigest] = {}
+        self._tasks = set()  # Digests currently being sent
+
+    def add(self, user_id: int, source_chat_id: int, source_title: str, dest_chat: int,
+            message_id: int, entry: str, options: DigestOptions):
+        window, max_items = options
+        key = (user_id, source_chat_id, dest_chat)
+        digest = self._pending.get(key)
+        if digest is None:
+            digest = _PendingDigest(source_title, max_items)
+            digest.timer = asyncio.get_running_loop().call_later(window, self.flush, key)
+            self._pending[key] = digest
+
+        digest.entries.append(entry)
+        digest.message_ids.append(message_id)
+        if len(digest.entries) >= digest.max_items:
+            self.flush(key)
+
+    def flush(self, key: Tuple[int, int, int]):
+        """Sends a pending digest now."""
+        digest = self._pending.pop(key, None)
+        if digest is None:
+            return
+        if digest.timer is not None:
+            digest.timer.cancel()
+        task = asyncio.create_task(self._send(key, digest))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def flush_all(self):
+        for key in list(self._pending):
+            self.flush(key)
+
+    async def _send(self, key: Tuple[int, int, int], digest: _PendingDigest):
+        user_id, source_chat_id, dest_chat = key
+        header = f"🗂 <b>来自 {html.escape(digest.title)} 的 {len(digest.entries)} 条新消息</b>\n\n"
+        try:
+            digest_id = f"{digest.message_ids[0]}-{digest.message_ids[-1]}"
+            chunks = split_digest(header, digest.entries)
+            for number, chunk in enumerate(chunks, 1):
+                part_id = f"{digest_id}/{number}" if len(chunks) > 1 else digest_id
+                await self.send(user_id, source_chat_id, dest_chat, part_id, chunk)
+            logger.info(
+                f"User client {user_id}: Sent digest of {len(digest.entries)} messages "
+                f"from chat {source_chat_id} to {dest_chat}."
+            )
+        except Exception as e:
+            logger.error(
+                f"User client {user_id}: Failed to send digest from chat {source_chat_id} to {dest_chat}. Error: {e}",
+                exc_info=True
+            )
+
+    def pending_count(self) -> int:
+        return sum(len(digest.entries) for digest in self._pending.values())
+
+    def in_flight_count(self) -> int:
+        return len(self._tasks)
@@ -1,15 +1,78 @@
+import asyncio
+import html
 import logging
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
 from pyrogram import Client, filters, enums
-from pyrogram.handlers import MessageHandler
+from pyrogram.handlers import DeletedMessagesHandler, MessageHandler
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from database.manager import get_forwarding_rules_for_user
-from bot.app import bot_client
+from database.manager import load_rule_index
+from database.rule_index import rule_index
+from database.rule_filters import MessageFeatures
+from bot.outbound import outbound
+from utils.telegram_text import MAX_MESSAGE_LENGTH
+from config import FANOUT_CONCURRENCY, FORWARD_UNMATCHED_TO_PM
+from user_clients.relay import media_relay
+from user_clients.albums import AlbumAggregator
+from user_clients.digest import DigestBuffer
+from user_clients.outbox import Outbox, OutboxEntry
+from user_clients.dedup import delivery_dedup
+from user_clients.catchup import CatchUp
+from user_clients.revoke_cache import CachedMessage, revoke_cache
+from metrics import registry as metrics
 
 logger = logging.getLogger(__name__)
 
-# A broad filter to capture all relevant messages for forwarding.
-# Includes private messages and group messages where the user is mentioned. Excludes messages sent by the user client itself or by other bots.
-FORWARD_FILTER = (filters.private | (filters.group & filters.mentioned)) & ~filters.me & ~filters.bot
+# How often the drain on shutdown checks whether deliveries are still in progress (seconds)
+DRAIN_POLL_INTERVAL = 0.1
+
+class _Intake:
+    """
+    Admits updates to the registered handlers and counts those in progress, so a shutdown can
+    stop taking new updates and wait for the ones already being handled.
+    """
+
+    def __init__(self):
+        self.open = True
+        self.active = 0
+
+    def track(self, handler: Callable[[Client, Any], Awaitable[None]]) -> Callable[[Client, Any], Awaitable[None]]:
+        async def run(client: Client, update: Any):
+            # Messages refused here are replayed by catch-up on the next start
+            if not self.open:
+                return
+            self.active += 1
+            try:
+                await handler(client, update)
+            finally:
+                self.active -= 1
+        return run
+
+intake = _Intake()
+
+def _is_group_mention(message: Message) -> bool:
+    """Whether the message is a mention of the user in a group, which is only notified, never forwarded."""
+    return bool(message.mentioned) and message.chat.type in [enums.ChatType.GROUP, enums.ChatType.SUPERGROUP]
+
+async def _routed_chat_filter(_, client: Client, message: Message) -> bool:
+    """
+    Admits messages from chats the client's rules list as sources (groups and channels included),
+    plus private messages and group mentions when unmatched ones go to the user's PM or match-all
+    rules apply. Reads the live rule index, so it follows rule changes without re-registering.
+    """
+    if message.chat is None:
+        return False
+    user_id = client.me.id
+    if rule_index.is_source(user_id, message.chat.id):
+        return True
+    if message.chat.type != enums.ChatType.PRIVATE and not _is_group_mention(message):
+        return False
+    return FORWARD_UNMATCHED_TO_PM or rule_index.routes_unlisted(user_id)
+
+# Drops irrelevant updates in the dispatcher before the handler runs.
+# Excludes messages sent by the user client itself or by other bots.
+FORWARD_FILTER = filters.create(_routed_chat_filter, "RoutedChatFilter") & ~filters.me & ~filters.bot
 
 async def _get_message_details(message: Message) -> (str, str, bool): # type: ignore
     """
@@ -74,6 +137,87 @@ async def _get_message_details(message: Message) -> (str, str, bool): # type: ig
     
     return content_type, content_detail.strip(), is_media
 
+async def _resolve_target_chats(user_id: int, message: Message) -> Optional[Set[int]]:
+    """
+    Looks up the destinations of a message in the rule index.
+    Falls back to the user's PM (if enabled) when no rule applies to the source chat, returns an empty set when
+    the rules that do apply filtered the message out, and None if the rules could not be loaded.
+    """
+    source_chat_id = message.chat.id
+    features = MessageFeatures.from_message(message, _is_group_mention(message))
+    matching_destination_chats = rule_index.route(user_id, source_chat_id, features)
+    if matching_destination_chats is None:
+        # Rules are compiled at client start; this only happens if that load was missed
+        try:
+            await load_rule_index(user_id)
+        except Exception as e:
+            logger.error(f"User client {user_id}: Could not retrieve forwarding rules. Error: {e}", exc_info=True)
+            return None
+        matching_destination_chats = rule_index.route(user_id, source_chat_id, features)
+
+    if matching_destination_chats:
+        metrics.rules_matched.inc(user_id)
+        logger.info(
+            "User client %s: Message %s matched destinations: %s",
+            user_id, message.id, sorted(matching_destination_chats),
+            extra={"user_id": user_id, "message_id": message.id, "destinations": len(matching_destination_chats)},
+        )
+        return set(matching_destination_chats)
+
+    if rule_index.covers(user_id, source_chat_id):
+        logger.info(
+            "User client %s: Message %s was rejected by the filters of all rules for chat %s.",
+            user_id, message.id, source_chat_id, extra={"user_id": user_id, "message_id": message.id},
+        )
+        return set()
+
+    if not FORWARD_UNMATCHED_TO_PM:
+        return set()
+
+    # If no rules matched, forward to user's PM by default
+    logger.info(
+        "User client %s: No rules matched message %s. Forwarding to user's PM by default.",
+        user_id, message.id, extra={"user_id": user_id, "message_id": message.id},
+    )
+    return {user_id}
+
+async def _drop_duplicates(message: Message, target_chats: Set[int]) -> Set[int]:
+    """
+    Removes destinations that already received this message through another managed account.
+    Only supergroups and channels share message IDs between accounts; in private chats and
+    basic groups every account sees its own IDs, so those messages are never deduplicated.
+    """
+    if message.chat.type not in [enums.ChatType.SUPERGROUP, enums.ChatType.CHANNEL]:
+        return target_chats
+    keys = [(message.chat.id, message.id, dest_chat) for dest_chat in target_chats]
+    new_keys = await delivery_dedup.claim(keys)
+    if len(new_keys) < len(keys):
+        logger.info(
+            "Message %s from chat %s was already delivered to %s of its destinations by another account; skipping those.",
+            message.id, message.chat.id, len(keys) - len(new_keys),
+        )
+    return {dest_chat for _, _, dest_chat in new_keys}
+
+async def _fan_out(target_chats: Set[int], deliver: Callable[[int], Awaitable[None]]):
+    """
+    Runs `deliver` for all destinations concurrently, at most FANOUT_CONCURRENCY at a time.
+    Each destination still receives its own messages in order, and a slow or failing
+    destination does not hold up the others.
+    """
+    semaphore = asyncio.Semaphore(FANOUT_CONCURRENCY)
+
+    async def run(dest_chat: int):
+        async with semaphore:
+            await deliver(dest_chat)
+
+    await asyncio.gather(*(run(dest_chat) for dest_chat in target_chats))
+
+def _digest_entry(message: Message, user_mention: str, content: str) -> str:
+    """One line of a digest: when the message was sent, by whom, and what it contains."""
+    # Service messages and some updates carry no date
+    sent_at = message.date or datetime.now()
+    return f"<b>{sent_at:%H:%M:%S}</b> {user_mention}\n{content}"
+
 async def forwarding_handler(client: Client, message: Message):
     """
     Handles all incoming messages for a user client, checks against forwarding rules,
@@ -82,104 +226,364 @@ async def forwarding_handler(client: Client, message: Message):
     user_id = client.me.id
     user_mention = message.from_user.mention if message.from_user else "未知"
     source_chat_id = message.chat.id
-    logger.info(f"User client {user_id}: Received message {message.id} from chat {source_chat_id}.")
-    logger.info(f"User mention content: {repr(user_mention)}")
+    metrics.messages_received.inc(user_id)
+    logger.info(
+        "User client %s: Received message %s from chat %s.", user_id, message.id, source_chat_id,
+        extra={"user_id": user_id, "chat_id": source_chat_id, "message_id": message.id},
+    )
+    catch_up.record(user_id, message)
 
-    try:
-        rules = await get_forwarding_rules_for_user(user_id)
-    except Exception as e:
-        logger.error(f"User client {user_id}: Could not retrieve forwarding rules. Error: {e}", exc_info=True)
+    # Album parts arrive as separate updates; they are collected and delivered together by album_handler
+    if message.media_group_id and not _is_group_mention(message):
+        album_aggregator.add(client, message)
         return
 
-    matching_destination_chats = set()
-    
-    # Determine which destinations to forward to based on rules
-    for rule in rules:
-        # An empty source_chats list means the rule applies to all sources
-        is_match_all_rule = not rule.get('source_chats')
-        
-        if is_match_all_rule or source_chat_id in rule.get('source_chats', []):
-            dests = rule.get('destination_chats', [])
-            logger.info(f"User client {user_id}: Message {message.id} matched rule {rule['_id']}. Adding destinations: {dests}")
-            for dest in dests:
-                matching_destination_chats.add(dest)
+    target_chats = await _resolve_target_chats(user_id, message)
+    if target_chats is None:
+        return
+    target_chats = await _drop_duplicates(message, target_chats)
+    if not target_chats:
+        return
 
-    # If no rules matched, forward to user's PM by default
-    if not matching_destination_chats:
-        logger.info(f"User client {user_id}: No rules matched message {message.id}. Forwarding to user's PM by default.")
-        target_chats = {user_id}
+    # Build the notification once; it is identical for every destination
+    notification_text = ""
+    link = None
+    should_forward = False
+    content_type = None
+
+    # 1. Handle mentions specifically
+    if _is_group_mention(message):
+        sender = message.from_user.mention if message.from_user else "Someone"
+        notification_text = (
+            f"🔔 **您在 {message.chat.title} 被提及**\n\n"
+            f"<b>来自:</b> {sender}\n"
+            f"<b>消息内容:</b> {message.text or message.caption or '...'}\n\n"
+        )
+        # Rendered as a "view message" button
+        link = message.link
+        # 群组提及只通知，不转发。
+        should_forward = False
+
+    # 2. Handle other messages
     else:
-        target_chats = matching_destination_chats
+        content_type, content_detail, is_media = await _get_message_details(message)
+        notification_text = (
+            f"🔔 新的{content_type} 来自 {user_mention}\n\n"
+            f"{content_detail}\n\n"
+        ).strip()
 
-    # Perform the forwarding and send a notification
-    for dest_chat in target_chats:
-        try:
-            notification_text = ""
-            reply_markup = None
-            should_forward = False
-            
-            # 1. Handle mentions specifically
-            if message.mentioned and message.chat.type in [enums.ChatType.GROUP, enums.ChatType.SUPERGROUP]:
-                sender = message.from_user.mention if message.from_user else "Someone"
-                notification_text = (
-                    f"🔔 **您在 {message.chat.title} 被提及**\n\n"
-                    f"<b>来自:</b> {sender}\n"
-                    f"<b>消息内容:</b> {message.text or message.caption or '...'}\n\n"
-                )
-                if message.link:
-                    reply_markup = InlineKeyboardMarkup(
-                        [[InlineKeyboardButton(text="💬 查看消息", url=message.link)]]
-                    )
-                # 群组提及只通知，不转发。
-                should_forward = False
-
-            # 2. Handle other messages
-            else:
-                content_type, content_detail, is_media = await _get_message_details(message)
-                notification_text = (
-                    f"🔔 新的{content_type} 来自 {user_mention}\n\n"
-                    f"{content_detail}\n\n"
-                ).strip()
-
-                
-                # Only forward private messages that are media
-                if is_media:
-                    should_forward = True
-
-            # Send the notification message via the BOT
-            await bot_client.send_message(
-                chat_id=dest_chat,
-                text=notification_text,
-                reply_markup=reply_markup,
-                disable_web_page_preview=True,
-                parse_mode=enums.ParseMode.HTML,
-            )
+        # Only forward private messages that are media
+        if is_media:
+            should_forward = True
 
-            # Then, forward the original message(s) if needed
-            if should_forward:
-                forwarded = await message.forward(chat_id=bot_client.me.id,disable_notification=True)
-                if forwarded:
-                    await bot_client.send_message(
-                        chat_id=dest_chat,
-                        text=f"✅ 以上是转发的{content_type}",
-                        reply_markup=reply_markup,
-                        disable_web_page_preview=True,
-                        parse_mode=enums.ParseMode.HTML,
-                    )
-                logger.info(f"User client {user_id}: Successfully forwarded message {message.id} to {dest_chat}.")
-            else:
-                logger.info(f"User client {user_id}: Sent notification for message {message.id} to {dest_chat} (no forward).")
+    # Kept for anti-revoke with the destinations this account delivers to
+    revoke_cache.record(user_id, message, content_type or "提及消息", target_chats)
 
-        except Exception as e:
-            logger.error(
-                f"User client {user_id}: Failed to process message {message.id} for destination {dest_chat}. Error: {e}",
-                exc_info=True
+    # Destinations of digest-mode rules get plain notifications batched instead of one by one
+    if not should_forward and content_type is not None:
+        digest_dests = rule_index.digest_route(user_id, source_chat_id).items()
+        if digest_dests:
+            entry = _digest_entry(message, user_mention, content_detail or content_type)
+            # Plain text; the digest escapes it
+            source_title = message.chat.title or message.chat.first_name or str(source_chat_id)
+            for dest_chat, options in digest_dests:
+                if dest_chat in target_chats:
+                    digest_buffer.add(user_id, source_chat_id, source_title, dest_chat, message.id, entry, options)
+                    target_chats.discard(dest_chat)
+            if not target_chats:
+                return
+
+    await _fan_out(
+        target_chats,
+        lambda dest_chat: outbox.submit(_build_entry(
+            client, [message], dest_chat, notification_text, link, should_forward, content_type
+        )),
+    )
+
+async def album_handler(client: Client, messages: List[Message]):
+    """
+    Delivers a complete album (all messages sharing a media_group_id) as one batch:
+    one notification, one media group and one confirmation per destination.
+    """
+    user_id = client.me.id
+    first = messages[0]
+    user_mention = first.from_user.mention if first.from_user else "未知"
+    logger.info(
+        "User client %s: Collected album %s of %s messages from chat %s.",
+        user_id, first.media_group_id, len(messages), first.chat.id,
+        extra={"user_id": user_id, "chat_id": first.chat.id, "message_id": first.id},
+    )
+
+    # Albums carry at most one caption, usually on the first part
+    captioned = next((message for message in messages if message.caption), first)
+
+    # Rule filters look at the caption, so the album is routed by its captioned part
+    target_chats = await _resolve_target_chats(user_id, captioned)
+    if target_chats is None:
+        return
+    target_chats = await _drop_duplicates(first, target_chats)
+    if not target_chats:
+        return
+
+    _, content_detail, _ = await _get_message_details(captioned)
+    notification_text = (
+        f"🔔 新的相册（{len(messages)} 项） 来自 {user_mention}\n\n"
+        f"{content_detail}\n\n"
+    ).strip()
+    # Every part is kept: a single item can be deleted from an album
+    for message in messages:
+        content_type, _, _ = await _get_message_details(message)
+        revoke_cache.record(user_id, message, content_type, target_chats)
+
+    await _fan_out(
+        target_chats,
+        lambda dest_chat: outbox.submit(_build_entry(
+            client, messages, dest_chat, notification_text, None, True, "相册"
+        )),
+    )
+
+async def deleted_messages_handler(client: Client, messages: List[Message]):
+    """
+    Anti-revoke: sends the cached content of deleted messages to the destinations they were routed to.
+    Deletions in supergroups and channels name their chat; all others only carry message IDs,
+    which are unique per account (see user_clients.revoke_cache).
+    """
+    user_id = client.me.id
+    boxes = {}
+    for message in messages:
+        boxes.setdefault(message.chat.id if message.chat else 0, []).append(message.id)
+    for box, message_ids in boxes.items():
+        # The parts of an album deleted together are reported together
+        reports = {}
+        for cached in await revoke_cache.take(user_id, box, message_ids):
+            reports.setdefault((cached.chat_id, cached.group or cached.message_id), []).append(cached)
+        for parts in reports.values():
+            first = parts[0]
+            logger.info(
+                "User client %s: Message %s in chat %s was deleted; reporting it to %s destinations.",
+                user_id, first.message_id, first.chat_id, len(first.targets),
+                extra={"user_id": user_id, "chat_id": first.chat_id, "message_id": first.message_id},
             )
+            metrics.revoked_messages.inc(user_id)
+            await _report_revoked(parts)
+
+async def _report_revoked(parts: List[CachedMessage]):
+    """Sends one report for a deleted message, or for the deleted parts of one album."""
+    cached = parts[0]
+    if len(parts) > 1:
+        what = f"相册中的 {len(parts)} 项"
+    elif cached.group:
+        what = f"相册中的一项（{cached.label}）"
+    else:
+        what = f"一条{cached.label}"
+    lines = [f"🗑 <b>{cached.sender} 删除了{what}</b>\n"]
+    if cached.chat_title:
+        lines.append(f"<b>来自:</b> {html.escape(cached.chat_title)}")
+    if cached.sent_at:
+        lines.append(f"<b>发送时间:</b> {datetime.fromtimestamp(cached.sent_at):%Y-%m-%d %H:%M:%S}")
+    header = "\n".join(lines)
+    content = "\n".join(part.text for part in parts if part.text)
+    text = header
+    while content:
+        text = f"{header}\n<b>内容:</b> {html.escape(content)}"
+        if len(text) <= MAX_MESSAGE_LENGTH:
+            break
+        # Escaping lengthens the text; cut the raw text so no entity is split
+        content = content[:len(content) - (len(text) - MAX_MESSAGE_LENGTH)]
+    prefix = f"revoked:{cached.user_id}:{cached.chat_id}:{cached.message_id}"
+    await _fan_out(
+        set().union(*(part.targets for part in parts)),
+        lambda dest_chat: outbox.submit(OutboxEntry(f"{prefix}:{dest_chat}", cached.user_id, dest_chat, {'text': text})),
+    )
+
+def _build_entry(
+    client: Client,
+    messages: List[Message],
+    dest_chat: int,
+    notification_text: str,
+    link: Optional[str],
+    should_forward: bool,
+    content_type: Optional[str],
+) -> OutboxEntry:
+    """
+    Describes the delivery of one message (or all parts of one album) to one destination.
+    The key identifies the source message and destination, so the same delivery is never queued twice.
+    """
+    user_id = client.me.id
+    first = messages[0]
+    payload = {
+        'text': notification_text,
+        'link': link,
+        'media': {'chat_id': first.chat.id, 'message_ids': [message.id for message in messages]} if should_forward else None,
+        'content_type': content_type,
+        # Source timestamp for the end-to-end latency metric
+        'date': first.date.timestamp() if first.date else None,
+    }
+    key = f"{user_id}:{first.chat.id}:{first.id}:{dest_chat}"
+    return OutboxEntry(key, user_id, dest_chat, payload, messages=messages, client=client)
+
+async def _load_entry_media(entry: OutboxEntry) -> (Client, List[Message]): # type: ignore
+    """Returns the user client and source messages of an entry, fetching them again for resumed entries."""
+    if entry.messages:
+        return entry.client, entry.messages
+
+    from user_clients.manager import user_client_manager  # Local import to avoid a cycle
+    client = user_client_manager.running_clients.get(entry.user_id)
+    if client is None:
+        raise RuntimeError(f"Client for user {entry.user_id} is not running in this process.")
+    media = entry.payload['media']
+    messages = await client.get_messages(media['chat_id'], media['message_ids'])
+    messages = [message for message in messages if message and not message.empty]
+    if not messages:
+        raise RuntimeError(f"Source messages {media['message_ids']} are no longer available.")
+    entry.client, entry.messages = client, messages
+    return client, messages
+
+async def _deliver_entry(entry: OutboxEntry):
+    """
+    Sends the notification, the forwarded media and the confirmation of an outbox entry, in that order.
+    Each completed step is recorded on the entry so a retry resumes after it instead of repeating it.
+    Raises on failure so the outbox can retry.
+    """
+    payload = entry.payload
+    dest_chat = entry.dest_chat
+    reply_markup = None
+    if payload.get('link'):
+        reply_markup = InlineKeyboardMarkup(
+            [[InlineKeyboardButton(text="💬 查看消息", url=payload['link'])]]
+        )
+
+    # Send the notification message via the BOT
+    if entry.step == 0:
+        await outbound.send_message(
+            chat_id=dest_chat,
+            text=payload['text'],
+            reply_markup=reply_markup,
+            disable_web_page_preview=True,
+            parse_mode=enums.ParseMode.HTML,
+        )
+        metrics.notifications_sent.inc(entry.user_id)
+        entry.step = 1
+
+    if not payload.get('media'):
+        _observe_latency(payload)
+        logger.info(
+            "User client %s: Sent notification %s to %s (no forward).", entry.user_id, entry.key, dest_chat,
+            extra={"user_id": entry.user_id, "dest_chat": dest_chat},
+        )
+        return
+
+    # Then, deliver the media. It is transferred to the bot only once
+    # per file and re-sent to every destination from the cached file_id.
+    client, messages = await _load_entry_media(entry)
+    if entry.step == 1:
+        # Transferred to the bot that will send it, as a file_id only works for that bot
+        bot = outbound.bot_for(dest_chat)
+        if len(messages) == 1:
+            relayed = await media_relay.acquire(client, messages[0], bot)
+            if not relayed:
+                raise RuntimeError("The bot did not receive the relayed media.")
+            await media_relay.deliver(relayed, dest_chat, entry.user_id, messages[0])
+        else:
+            relayed = await media_relay.acquire_group(client, messages, bot)
+            if not relayed:
+                raise RuntimeError("The bot did not receive the relayed album.")
+            await media_relay.deliver_group(relayed, dest_chat, entry.user_id, messages)
+        metrics.forwards_done.inc(entry.user_id)
+        entry.step = 2
+
+    if entry.step == 2:
+        await outbound.send_message(
+            chat_id=dest_chat,
+            text=f"✅ 以上是转发的{payload['content_type']}",
+            reply_markup=reply_markup,
+            disable_web_page_preview=True,
+            parse_mode=enums.ParseMode.HTML,
+        )
+        entry.step = 3
+    _observe_latency(payload)
+    logger.info(
+        "User client %s: Successfully forwarded %s to %s.", entry.user_id, entry.key, dest_chat,
+        extra={"user_id": entry.user_id, "dest_chat": dest_chat},
+    )
+
+def _observe_latency(payload: dict):
+    if payload.get('date'):
+        metrics.delivery_latency.observe(max(time.time() - payload['date'], 0))
+
+async def _send_digest(user_id: int, source_chat_id: int, dest_chat: int, digest_id: str, text: str):
+    # The same digest (e.g. replayed by catch-up) maps to the same key and is delivered once
+    key = f"digest:{user_id}:{source_chat_id}:{dest_chat}:{digest_id}"
+    await outbox.submit(OutboxEntry(key, user_id, dest_chat, {'text': text}))
+
+def _running_user_ids() -> List[int]:
+    from user_clients.manager import user_client_manager  # Local import to avoid a cycle
+    return list(user_client_manager.running_clients)
+
+# Durable delivery of everything the handlers send
+outbox = Outbox(_deliver_entry, _running_user_ids)
+# Collects album parts per (user, chat, media_group_id) and hands complete albums to album_handler
+album_aggregator = AlbumAggregator(album_handler)
+# Coalesces notifications for destinations of digest-mode rules
+digest_buffer = DigestBuffer(_send_digest)
+# Replays messages missed while a client was offline through the same filter and handler
+catch_up = CatchUp(forwarding_handler, FORWARD_FILTER)
+metrics.outbox_pending.set_function(outbox.pending_count)
+
+def _busy_count() -> int:
+    return (
+        intake.active + outbox.in_flight_count()
+        + album_aggregator.in_flight_count() + digest_buffer.in_flight_count()
+    )
+
+async def drain(timeout: float) -> Dict[str, Any]:
+    """
+    First phase of a shutdown: stops handling new updates, sends buffered albums and digests right
+    away and gives the deliveries in progress up to `timeout` seconds to finish. Deliveries still
+    running at the deadline are cancelled with the other tasks; like those waiting for a retry,
+    they stay in the outbox, which outbox.stop() persists for the next start.
+    Logs and returns a report of what was drained and what was left.
+    """
+    intake.open = False
+    for user_id in _running_user_ids():
+        catch_up.cancel(user_id)
+    albums, digest_items = album_aggregator.pending_count(), digest_buffer.pending_count()
+    album_aggregator.flush_all()
+    digest_buffer.flush_all()
+    delivered, dropped = outbox.delivered, outbox.dropped
+
+    started_at = time.monotonic()
+    while _busy_count() and time.monotonic() - started_at < timeout:
+        await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+    report = {
+        'seconds': time.monotonic() - started_at,
+        'albums_flushed': albums,
+        'digest_items_flushed': digest_items,
+        'delivered': outbox.delivered - delivered,
+        'given_up': outbox.dropped - dropped,
+        'interrupted': _busy_count(),
+        'persisted': outbox.pending_count(),
+    }
+    lines = [
+        f"Drain report: {report['delivered']} deliveries completed in {report['seconds']:.1f}s "
+        f"(flushed {albums} buffered albums and {digest_items} digest items).",
+    ]
+    if report['interrupted']:
+        lines.append(f"  {report['interrupted']} deliveries and handlers still running at the {timeout:.0f}s deadline are interrupted.")
+    if report['persisted']:
+        lines.append(f"  {report['persisted']} undelivered outbox entries are persisted and retried on the next start.")
+    if report['given_up']:
+        lines.append(f"  {report['given_up']} deliveries failed for good and were dropped.")
+    logger.info("\n".join(lines))
+    return report
 
 def register_handlers(client: Client):
     """
     Registers all necessary handlers for a user client instance.
     This approach is used instead of decorators to support multiple client instances.
     """
-    client.add_handler(MessageHandler(forwarding_handler, FORWARD_FILTER), group=1)
+    client.add_handler(MessageHandler(intake.track(forwarding_handler), FORWARD_FILTER), group=1)
+    if revoke_cache.enabled:
+        client.add_handler(DeletedMessagesHandler(intake.track(deleted_messages_handler)), group=1)
     logger.info("Registered user client message handlers.")
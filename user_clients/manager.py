@@ -1,8 +1,25 @@
 import asyncio
 import logging
+import random
+import time
+from typing import Dict, Optional
 from pyrogram import Client
-from config import API_ID, API_HASH, PROXY
-from user_clients.handlers import register_handlers
+from config import (
+    API_ID,
+    API_HASH,
+    PROXY,
+    SESSION_STORAGE,
+    STARTUP_CONCURRENCY,
+    STARTUP_CLIENT_TIMEOUT,
+    STARTUP_JITTER,
+    SHUTDOWN_CLIENT_TIMEOUT,
+)
+from database.manager import load_rule_index
+from user_clients.handlers import register_handlers, catch_up
+from user_clients.dedup import delivery_dedup
+from user_clients.storage import MongoSessionStorage
+from user_clients.supervisor import ClientSupervisor
+from metrics import registry as metrics
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +32,10 @@ class UserClientManager:
 
     def __init__(self):
         self.running_clients = {}  # {user_id: client_instance}
+        # Shared by all clients so a message seen by several accounts is delivered once
+        self.dedup = delivery_dedup
+        # Health-checks the running clients and restarts failed ones
+        self.supervisor = ClientSupervisor(self)
 
     async def start_client(self, user_id: int, session_string: str) -> bool:
         """
@@ -26,6 +47,7 @@ class UserClientManager:
             await self.stop_client(user_id)
 
         logger.info(f"Starting client for user {user_id}...")
+        client = None
         try:
             client_params = {
                 "name": f"user_{user_id}",
@@ -34,43 +56,89 @@ class UserClientManager:
                 "session_string": session_string,
                 "in_memory": True,
             }
+            if SESSION_STORAGE == "mongo":
+                # Keeps the peer cache across restarts; the session string still provides the auth key
+                client_params["storage"] = MongoSessionStorage(client_params["name"], user_id, session_string)
             if PROXY:
                 client_params["proxy"] = PROXY
                 
             client = Client(**client_params)
             
-            await client.start()
+            # A hanging session must not block the caller forever
+            await asyncio.wait_for(client.start(), timeout=STARTUP_CLIENT_TIMEOUT)
+            # Compile the routing index before any update can reach the handler
+            await load_rule_index(user_id)
             register_handlers(client)
 
-            me = await client.get_me()
+            # client.start() already fetched the account via get_me()
+            me = client.me
             logger.info(f"Client for user {me.first_name} ({me.id}) started successfully.")
 
             self.running_clients[user_id] = client
+            self.supervisor.started(user_id, session_string)
+            # Messages that arrived while the client was offline are replayed in the background
+            catch_up.schedule(client)
             return True
 
         except Exception as e:
-            logger.error(f"Failed to start client for user {user_id}. Error: {e}", exc_info=True)
+            if isinstance(e, asyncio.TimeoutError):
+                logger.error(f"Failed to start client for user {user_id}: timed out after {STARTUP_CLIENT_TIMEOUT}s.")
+            else:
+                logger.error(f"Failed to start client for user {user_id}. Error: {e}", exc_info=True)
+            await self._discard_client(client)
+            await self.supervisor.failed(user_id, session_string, e)
             return False
 
+    async def _discard_client(self, client: Optional[Client]):
+        """Best-effort cleanup of a client whose start failed halfway."""
+        if client is None or not client.is_connected:
+            return
+        try:
+            if client.is_initialized:
+                await client.stop()
+            else:
+                await client.disconnect()
+        except Exception as e:
+            logger.warning(f"Error while cleaning up a failed client: {e}")
+
     async def stop_client(self, user_id: int) -> bool:
-        """Stops a specific running user client."""
+        """Stops a specific running user client. It is no longer supervised."""
+        self.supervisor.forget(user_id)
         if user_id not in self.running_clients:
             logger.warning(f"Attempted to stop a non-running client for user {user_id}.")
             return False
 
         logger.info(f"Stopping client for user {user_id}...")
         client = self.running_clients.pop(user_id)
-        
-        if client.is_initialized:
-            await client.stop()
-        
+        catch_up.cancel(user_id)
+
+        error = await self._close_client(client)
+        if error is not None:
+            # E.g. a client whose connection already died; it is gone either way
+            logger.warning(f"Error while stopping client for user {user_id}: {error}")
+
         logger.info(f"Client for user {user_id} stopped.")
         return True
 
+    @staticmethod
+    async def _close_client(client: Client) -> Optional[str]:
+        """Stops a client within SHUTDOWN_CLIENT_TIMEOUT. Returns why it did not stop cleanly, if it did not."""
+        if not client.is_initialized:
+            return None
+        try:
+            await asyncio.wait_for(client.stop(), timeout=SHUTDOWN_CLIENT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return f"timed out after {SHUTDOWN_CLIENT_TIMEOUT}s"
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        return None
+
     async def start_all_from_db(self):
         """
         Loads all active users from the database and starts their clients.
         To be called on application startup.
+        Clients are started concurrently (at most STARTUP_CONCURRENCY at a time), each
+        after a random delay so connections do not all hit Telegram's DCs at once.
         """
         from database.manager import get_all_active_users  # Local import
         
@@ -80,16 +148,66 @@ class UserClientManager:
             logger.info("No active users found in the database.")
             return
 
-        for user in active_users:
-            await self.start_client(user['user_id'], user['session_string'])
+        await self.start_clients(active_users)
+
+    async def start_clients(self, users) -> Dict[int, bool]:
+        """
+        Starts the clients of the given user documents concurrently and logs a startup report.
+        Returns {user_id: success}.
+        """
+        semaphore = asyncio.Semaphore(STARTUP_CONCURRENCY)
+        report = []  # [(user_id, seconds, success)]
+
+        async def start_one(user):
+            await asyncio.sleep(random.uniform(0, STARTUP_JITTER))
+            async with semaphore:
+                started_at = time.monotonic()
+                success = await self.start_client(user['user_id'], user['session_string'])
+                report.append((user['user_id'], time.monotonic() - started_at, success))
+
+        started_at = time.monotonic()
+        await asyncio.gather(*(start_one(user) for user in users))
+        self._log_startup_report(report, time.monotonic() - started_at)
+        return {user_id: success for user_id, _, success in report}
+
+    @staticmethod
+    def _log_startup_report(report, total_seconds: float):
+        failed = [user_id for user_id, _, success in report if not success]
+        lines = [
+            f"Startup report: {len(report) - len(failed)}/{len(report)} clients started in {total_seconds:.1f}s."
+        ]
+        for user_id, seconds, success in sorted(report, key=lambda entry: entry[1], reverse=True):
+            lines.append(f"  user {user_id}: {'ok' if success else 'FAILED'} in {seconds:.2f}s")
+        if failed:
+            lines.append(f"  Failed users: {failed}")
+        logger.info("\n".join(lines))
 
     async def stop_all(self):
-        """Stops all running user clients gracefully."""
+        """
+        Stops all running user clients at once, each within SHUTDOWN_CLIENT_TIMEOUT seconds,
+        and logs a report of the clients that did not stop cleanly.
+        """
         logger.info("Stopping all user clients...")
-        user_ids = list(self.running_clients.keys())
-        for user_id in user_ids:
-            await self.stop_client(user_id)
-        logger.info("All user clients have been stopped.")
+        # Otherwise a health check could restart clients while they are being stopped
+        await self.supervisor.stop()
+        clients = list(self.running_clients.items())
+        self.running_clients.clear()
+        for user_id, _ in clients:
+            self.supervisor.forget(user_id)
+            catch_up.cancel(user_id)
+
+        started_at = time.monotonic()
+        errors = await asyncio.gather(*(self._close_client(client) for _, client in clients))
+        failed = [(user_id, error) for (user_id, _), error in zip(clients, errors) if error is not None]
+        lines = [
+            f"Shutdown report: {len(clients) - len(failed)}/{len(clients)} clients stopped cleanly "
+            f"in {time.monotonic() - started_at:.1f}s."
+        ]
+        for user_id, error in failed:
+            lines.append(f"  user {user_id}: {error}")
+        logger.info("\n".join(lines))
 
 # A single instance of the manager to be used throughout the application
 user_client_manager = UserClientManager()
+metrics.running_clients.set_function(lambda: len(user_client_manager.running_clients))
+metrics.client_states.set_function(user_client_manager.supervisor.state_counts)
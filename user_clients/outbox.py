@@ -0,0 +1,333 @@
+import asyncio
+import logging
+import random
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from config import (
+    OUTBOX_COMMIT_WINDOW,
+    OUTBOX_FLUSH_INTERVAL,
+    OUTBOX_POLL_INTERVAL,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_RETRY_BASE,
+    OUTBOX_RETRY_MAX,
+)
+from database.manager import (
+    insert_outbox_entries,
+    update_outbox_entries,
+    delete_outbox_entries,
+    get_due_outbox_entries,
+)
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# How many recently delivered keys are remembered to drop duplicate enqueues
+RECENT_KEYS_SIZE = 10000
+# How many persisted entries one poll picks up at most
+RESUME_BATCH_SIZE = 500
+
+
+class OutboxEntry:
+    """
+    One delivery to one destination. `payload` describes what to send and `step`
+    records how much of it has already been sent, so a retry resumes where it failed.
+    `messages` and `client` are only set on the hot path and are never persisted.
+    """
+
+    __slots__ = ("key", "user_id", "dest_chat", "payload", "attempts", "step", "messages", "client")
+
+    def __init__(self, key: str, user_id: int, dest_chat: int, payload: Dict[str, Any],
+                 attempts: int = 0, step: int = 0, messages=None, client=None):
+        self.key = key
+        self.user_id = user_id
+        self.dest_chat = dest_chat
+        self.payload = payload
+        self.attempts = attempts
+        self.step = step
+        self.messages = messages
+        self.client = client
+
+    def to_document(self, next_attempt_at: datetime) -> Dict[str, Any]:
+        return {
+            '_id': self.key,
+            'user_id': self.user_id,
+            'dest_chat': self.dest_chat,
+            'payload': self.payload,
+            'attempts': self.attempts,
+            'step': self.step,
+            'next_attempt_at': next_attempt_at,
+        }
+
+    @classmethod
+    def from_document(cls, document: Dict[str, Any]) -> "OutboxEntry":
+        return cls(
+            document['_id'],
+            document['user_id'],
+            document['dest_chat'],
+            document['payload'],
+            attempts=document.get('attempts', 0),
+            step=document.get('step', 0),
+        )
+
+
+class Outbox:
+    """
+    Durable, at-least-once delivery of forwarding notifications.
+    Every entry is written to the `outbox` collection before its first attempt. Entries
+    submitted within OUTBOX_COMMIT_WINDOW of each other share one insert (group commit),
+    so the hot path does not pay a database round trip per send. Retry state and the
+    deletion of delivered entries are written by a background flusher in batches.
+    Failed deliveries are retried with jittered exponential backoff, and persisted entries
+    (e.g. left over from a previous run) are picked up by a poller for every user whose
+    client runs in this process.
+    Keys are idempotency keys (message + destination): an entry is never queued twice.
+    """
+
+    def __init__(self, deliver: Callable[[OutboxEntry], Awaitable[None]],
+                 running_users: Callable[[], List[int]]):
+        self.deliver = deliver
+        self.running_users = running_users
+        self._entries: Dict[str, OutboxEntry] = {}  # Undelivered entries known to this process
+        self._commit_batch: Optional[Dict[str, OutboxEntry]] = None  # Entries waiting for the next group commit
+        self._commit_done: Optional[asyncio.Future] = None
+        self._committing = 0  # Submitted entries waiting for their group commit
+        self._to_insert: Dict[str, OutboxEntry] = {}  # Entries whose group commit failed
+        self._to_update: Dict[str, OutboxEntry] = {}
+        self._to_delete = set()
+        self._failed: Dict[str, OutboxEntry] = {}  # Entries that exhausted their attempts
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._tasks = set()  # Retries and resumed deliveries in progress
+        self._loops: List[asyncio.Task] = []
+        self._in_flight = 0  # Delivery attempts running right now
+        self.delivered = 0
+        self.retried = 0
+        self.dropped = 0
+
+    async def start(self):
+        self._loops = [
+            asyncio.create_task(self._run_flusher()),
+            asyncio.create_task(self._run_poller()),
+        ]
+
+    async def stop(self):
+        """Stops the background loops and persists every undelivered entry."""
+        for task in self._loops:
+            task.cancel()
+        await asyncio.gather(*self._loops, return_exceptions=True)
+        self._loops = []
+        for key, entry in self._entries.items():
+            if key not in self._to_insert:
+                self._to_update[key] = entry
+        await self.flush()
+        logger.info(f"Outbox stopped with {len(self._entries)} undelivered entries persisted.")
+
+    def pending_count(self) -> int:
+        return len(self._entries)
+
+    def in_flight_count(self) -> int:
+        return self._in_flight + self._committing
+
+    async def submit(self, entry: OutboxEntry):
+        """
+        Queues an entry, writes it to the database and delivers it. Returns once the first
+        attempt finishes; a failed attempt is retried in the background.
+        """
+        if entry.key in self._entries or entry.key in self._recent:
+            logger.debug(f"Outbox entry {entry.key} is already queued or delivered; skipping.")
+            return
+        self._entries[entry.key] = entry
+        self._committing += 1
+        try:
+            await self._commit(entry)
+        finally:
+            self._committing -= 1
+        await self._dispatch(entry)
+
+    async def _commit(self, entry: OutboxEntry):
+        """Waits until the group commit that includes `entry` has been written."""
+        if self._commit_batch is None:
+            self._commit_batch = {}
+            self._commit_done = asyncio.get_running_loop().create_future()
+            task = asyncio.create_task(self._run_commit(self._commit_batch, self._commit_done))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        self._commit_batch[entry.key] = entry
+        # Shielded: a cancelled submitter must not fail the commit for the rest of its batch
+        await asyncio.shield(self._commit_done)
+
+    async def _run_commit(self, batch: Dict[str, OutboxEntry], done: asyncio.Future):
+        try:
+            await asyncio.sleep(OUTBOX_COMMIT_WINDOW)
+            self._detach_commit(batch)
+            await insert_outbox_entries([entry.to_document(datetime.utcnow()) for entry in batch.values()])
+        except asyncio.CancelledError:
+            self._defer_insert(batch)
+            raise
+        except Exception as e:
+            # The entries are still delivered; the flusher keeps trying to write them
+            logger.error(f"Failed to write {len(batch)} outbox entries before delivery. Error: {e}")
+            self._defer_insert(batch)
+        finally:
+            self._detach_commit(batch)
+            if not done.done():
+                done.set_result(None)
+
+    def _detach_commit(self, batch: Dict[str, OutboxEntry]):
+        """Closes `batch`: entries submitted from here on go into the next group commit."""
+        if self._commit_batch is batch:
+            self._commit_batch = self._commit_done = None
+
+    def _defer_insert(self, batch: Dict[str, OutboxEntry]):
+        """Hands the entries of a failed group commit to the flusher."""
+        for key, entry in batch.items():
+            if self._entries.get(key) is entry:
+                self._to_insert.setdefault(key, entry)
+
+    async def _dispatch(self, entry: OutboxEntry):
+        entry.attempts += 1
+        self._in_flight += 1
+        try:
+            await self.deliver(entry)
+        except Exception as e:
+            metrics.delivery_failures.inc(entry.user_id, type(e).__name__)
+            self._schedule_retry(entry, e)
+        else:
+            self._ack(entry)
+        finally:
+            # A cancelled attempt stays in _entries, so stop() persists it for a retry
+            self._in_flight -= 1
+
+    def _ack(self, entry: OutboxEntry):
+        self.delivered += 1
+        self._entries.pop(entry.key, None)
+        self._to_update.pop(entry.key, None)
+        # An entry whose group commit failed and is still waiting for its insert is simply
+        # forgotten; anything else was written (or is being written right now) and must be deleted
+        if self._to_insert.pop(entry.key, None) is None:
+            self._to_delete.add(entry.key)
+        self._recent[entry.key] = None
+        while len(self._recent) > RECENT_KEYS_SIZE:
+            self._recent.popitem(last=False)
+
+    def _schedule_retry(self, entry: OutboxEntry, error: Exception):
+        if entry.attempts >= OUTBOX_MAX_ATTEMPTS:
+            self.dropped += 1
+            logger.error(
+                f"User client {entry.user_id}: Giving up on delivery {entry.key} to {entry.dest_chat} "
+                f"after {entry.attempts} attempts. Error: {error}"
+            )
+            self._entries.pop(entry.key, None)
+            self._to_insert.pop(entry.key, None)
+            self._to_update.pop(entry.key, None)
+            self._failed[entry.key] = entry
+            return
+
+        delay = min(OUTBOX_RETRY_BASE * 2 ** (entry.attempts - 1), OUTBOX_RETRY_MAX)
+        delay *= random.uniform(0.8, 1.2)
+        logger.warning(
+            f"User client {entry.user_id}: Delivery {entry.key} to {entry.dest_chat} failed "
+            f"(attempt {entry.attempts}/{OUTBOX_MAX_ATTEMPTS}), retrying in {delay:.1f}s. Error: {error}"
+        )
+        self.retried += 1
+        if entry.key not in self._to_insert:
+            self._to_update[entry.key] = entry
+        asyncio.get_running_loop().call_later(delay, self._spawn_retry, entry)
+
+    def _spawn_retry(self, entry: OutboxEntry):
+        if self._entries.get(entry.key) is not entry:
+            return
+        task = asyncio.create_task(self._dispatch(entry))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        """Writes all buffered inserts, updates and deletions to the database in batches."""
+        now = datetime.utcnow()
+        to_insert, self._to_insert = self._to_insert, {}
+        to_update, self._to_update = self._to_update, {}
+        to_delete, self._to_delete = self._to_delete, set()
+        failed, self._failed = self._failed, {}
+
+        try:
+            if to_insert:
+                await insert_outbox_entries([entry.to_document(now) for entry in to_insert.values()])
+                to_insert = {}
+            if to_update:
+                documents = []
+                for entry in to_update.values():
+                    delay = min(OUTBOX_RETRY_BASE * 2 ** max(entry.attempts - 1, 0), OUTBOX_RETRY_MAX)
+                    documents.append(entry.to_document(now + timedelta(seconds=delay)))
+                # Upserted: the entry's insert may have been lost with an earlier failed flush
+                await update_outbox_entries(documents, upsert=True)
+                to_update = {}
+            if failed:
+                # Keep exhausted entries for inspection, but never retry them
+                await update_outbox_entries([
+                    dict(entry.to_document(now), failed=True) for entry in failed.values()
+                ], upsert=True)
+                failed = {}
+            if to_delete:
+                await delete_outbox_entries(list(to_delete))
+        except Exception:
+            self._restore(to_insert, to_update, failed, to_delete)
+            raise
+
+    def _restore(self, to_insert: Dict[str, OutboxEntry], to_update: Dict[str, OutboxEntry],
+                 failed: Dict[str, OutboxEntry], to_delete: set):
+        """Puts back what a failed flush did not write, skipping entries delivered meanwhile."""
+        for key, entry in to_insert.items():
+            if self._entries.get(key) is entry:
+                self._to_insert.setdefault(key, entry)
+        for key, entry in to_update.items():
+            if self._entries.get(key) is entry and key not in self._to_insert:
+                self._to_update.setdefault(key, entry)
+        for key, entry in failed.items():
+            self._failed.setdefault(key, entry)
+        self._to_delete |= to_delete
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(OUTBOX_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to flush the outbox. Error: {e}", exc_info=True)
+
+    async def _run_poller(self):
+        while True:
+            try:
+                await self._resume_persisted()
+            except Exception as e:
+                logger.error(f"Failed to poll the outbox. Error: {e}", exc_info=True)
+            await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+    async def _resume_persisted(self):
+        """Picks up due entries from the database that this process does not know about yet."""
+        user_ids = self.running_users()
+        if not user_ids:
+            return
+        # Entries this process already knows about are skipped here rather than excluded in the
+        # query, and may take up part of the batch
+        documents = await get_due_outbox_entries(
+            user_ids, limit=RESUME_BATCH_SIZE + len(self._entries) + len(self._to_delete)
+        )
+        resumed = 0
+        for document in documents:
+            entry = OutboxEntry.from_document(document)
+            # Entries delivered since the query may still be in the database until the next flush
+            if entry.key in self._entries or entry.key in self._to_delete or entry.key in self._recent:
+                continue
+            self._entries[entry.key] = entry
+            self._spawn_retry(entry)
+            resumed += 1
+        if resumed:
+            logger.info(f"Resumed {resumed} pending deliveries from the outbox.")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._entries),
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,368 @@
+import asyncio
+import logging
+import mimetypes
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from pyrogram import Client, enums
+from pyrogram.errors import ChatForwardsRestricted
+from pyrogram.types import (
+    Message,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+)
+from bot.app import bot_client
+from bot.outbound import outbound
+from config import (
+    RELAY_CACHE_TTL,
+    RELAY_CACHE_SIZE,
+    RELAY_CAPTURE_TIMEOUT,
+    RELAY_SPOOL_THRESHOLD,
+    RELAY_SPOOL_DIR,
+    RELAY_UPLOAD_CONCURRENCY,
+    RELAY_UPLOAD_PER_USER,
+)
+
+logger = logging.getLogger(__name__)
+
+# Media types that may be sent together with send_media_group
+MEDIA_GROUP_TYPES = {
+    enums.MessageMediaType.PHOTO: InputMediaPhoto,
+    enums.MessageMediaType.VIDEO: InputMediaVideo,
+    enums.MessageMediaType.DOCUMENT: InputMediaDocument,
+    enums.MessageMediaType.AUDIO: InputMediaAudio,
+}
+
+# How the bot uploads each media type: (send method, media attributes passed along)
+UPLOAD_METHODS = {
+    enums.MessageMediaType.PHOTO: ("send_photo", ()),
+    enums.MessageMediaType.VIDEO: ("send_video", ("duration", "width", "height", "file_name", "supports_streaming")),
+    enums.MessageMediaType.DOCUMENT: ("send_document", ("file_name",)),
+    enums.MessageMediaType.AUDIO: ("send_audio", ("duration", "performer", "title", "file_name")),
+    enums.MessageMediaType.VOICE: ("send_voice", ("duration",)),
+    enums.MessageMediaType.ANIMATION: ("send_animation", ("duration", "width", "height", "file_name")),
+    enums.MessageMediaType.VIDEO_NOTE: ("send_video_note", ("duration", "length")),
+    enums.MessageMediaType.STICKER: ("send_sticker", ()),
+}
+# Media types whose send method takes no caption
+UNCAPTIONED_TYPES = {enums.MessageMediaType.VIDEO_NOTE, enums.MessageMediaType.STICKER}
+
+
+def get_file_unique_id(message: Message) -> Optional[str]:
+    """Returns the file_unique_id of a message's media, which is identical for every account and bot."""
+    if not message.media:
+        return None
+    media = getattr(message, message.media.value, None)
+    return getattr(media, "file_unique_id", None)
+
+
+def is_protected(message: Message) -> bool:
+    """Whether the message comes from a chat with content protection, so it cannot be forwarded."""
+    return bool(message.has_protected_content or getattr(message.chat, "has_protected_content", False))
+
+
+def _upload_arguments(message: Message) -> Tuple[str, Dict[str, Any]]:
+    """Returns the bot method and keyword arguments that re-create the media of `message`."""
+    method, attributes = UPLOAD_METHODS[message.media]
+    media = getattr(message, message.media.value)
+    kwargs = {attribute: getattr(media, attribute, None) for attribute in attributes}
+    if "file_name" in kwargs and not kwargs["file_name"]:
+        # Pyrogram guesses the MIME type from the name
+        extension = mimetypes.guess_extension(getattr(media, "mime_type", None) or "") or ""
+        kwargs["file_name"] = f"{media.file_unique_id}{extension}"
+    if message.media not in UNCAPTIONED_TYPES:
+        kwargs["caption"] = message.caption or ""
+        kwargs["caption_entities"] = message.caption_entities
+    return method, kwargs
+
+
+# (bot ID, file_unique_id): a file_id only works for the bot that received it
+CacheKey = Tuple[int, str]
+
+
+def _cache_key(bot: Client, file_unique_id: str) -> CacheKey:
+    return bot.me.id, file_unique_id
+
+
+class RelayedMedia:
+    """A bot-side reference to a media file that the bot holding it can re-send to any chat."""
+
+    __slots__ = ("bot", "media_type", "file_id", "caption", "caption_entities", "expires_at", "source_keys")
+
+    def __init__(self, bot: Client, bot_message: Message):
+        self.bot = bot
+        self.media_type = bot_message.media
+        self.file_id: str = getattr(bot_message, bot_message.media.value).file_id
+        self.caption = bot_message.caption or ""
+        self.caption_entities = bot_message.caption_entities
+        self.expires_at = time.monotonic() + RELAY_CACHE_TTL
+        # Source messages that were forwarded upstream into their owner's chat with the bot
+        self.source_keys: Set[Tuple[int, int]] = set()
+
+
+class MediaRelay:
+    """
+    Moves media from user clients to the bot with a single upstream transfer.
+    A user client forwards the media to the bot once; the bot-side copy is captured by
+    a bot handler, and its file_id is cached so every destination gets a cheap
+    `send_cached_media` instead of another forward.
+    Media is matched by file_unique_id, which is the same on both sides.
+    With a pool of bots, media is transferred to the bot that will send it, as a file_id
+    cannot be used by another bot; each bot has its own cache entries.
+    Media from chats with content protection is downloaded by the user client and uploaded by
+    the primary bot into the user's chat with it instead, which gives the same cacheable file_id.
+    """
+
+    def __init__(self, primary: Client):
+        self.primary = primary
+        self._cache: "OrderedDict[CacheKey, RelayedMedia]" = OrderedDict()
+        self._inflight: Dict[CacheKey, asyncio.Future] = {}  # {key (of all album parts): Future of the shared transfer}
+        self._captures: Dict[CacheKey, asyncio.Future] = {}  # {key: Future[Message]}
+        self._upload_slots = asyncio.Semaphore(RELAY_UPLOAD_CONCURRENCY)
+        self._user_upload_slots: Dict[int, asyncio.Semaphore] = {}
+        self.upstream_transfers = 0
+        self.uploads = 0
+
+    def is_expecting(self, bot: Client, message: Message) -> bool:
+        """Whether a message received by a bot is the bot-side copy of a pending relay."""
+        file_unique_id = get_file_unique_id(message)
+        return file_unique_id is not None and _cache_key(bot, file_unique_id) in self._captures
+
+    def capture(self, bot: Client, message: Message):
+        """Called by a bot for each incoming copy of a relayed media message."""
+        future = self._captures.pop(_cache_key(bot, get_file_unique_id(message)), None)
+        if future is not None and not future.done():
+            future.set_result(message)
+
+    def _get_cached(self, key: CacheKey) -> Optional[RelayedMedia]:
+        relayed = self._cache.get(key)
+        if relayed is None:
+            return None
+        if relayed.expires_at < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return relayed
+
+    def _store(self, key: CacheKey, relayed: RelayedMedia):
+        self._cache[key] = relayed
+        self._cache.move_to_end(key)
+        while len(self._cache) > RELAY_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    async def _single_flight(self, key: CacheKey, transfer: Callable[[], Awaitable]):
+        """Runs `transfer` once per key; concurrent callers with the same key share its result."""
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            return await asyncio.shield(inflight)
+
+        inflight = asyncio.get_running_loop().create_future()
+        self._inflight[key] = inflight
+        try:
+            result = await transfer()
+            inflight.set_result(result)
+            return result
+        except BaseException as e:
+            inflight.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            inflight.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def acquire(self, client: Client, message: Message, bot: Optional[Client] = None) -> Optional[RelayedMedia]:
+        """
+        Returns a reference for the media of `message` held by `bot` (the primary bot by default),
+        transferring it upstream only if no valid cached reference exists. Concurrent callers
+        share one transfer. Returns None if the bot never received its copy.
+        """
+        # Uploaded media is held by the primary bot, the only one sure to reach the user's chat
+        bot = self.primary if is_protected(message) else bot or self.primary
+        file_unique_id = get_file_unique_id(message)
+        if file_unique_id is None:
+            return None
+
+        relayed = self._get_cached(_cache_key(bot, file_unique_id))
+        if relayed is not None:
+            return relayed
+
+        async def transfer():
+            return (await self._transfer(client, bot, [message]))[0]
+
+        return await self._single_flight(_cache_key(bot, file_unique_id), transfer)
+
+    async def acquire_group(self, client: Client, messages: List[Message],
+                            bot: Optional[Client] = None) -> List[Optional[RelayedMedia]]:
+        """
+        Like `acquire`, for all parts of an album. Parts that are not cached are
+        transferred together with a single forward_messages call.
+        Returns an empty list if none of the parts reached the bot.
+        """
+        bot = self.primary if any(is_protected(message) for message in messages) else bot or self.primary
+        cached = [self._get_cached(_cache_key(bot, get_file_unique_id(message) or "")) for message in messages]
+        missing = [message for message, relayed in zip(messages, cached) if relayed is None]
+        if not missing:
+            return cached
+
+        key = _cache_key(bot, ",".join(get_file_unique_id(message) or str(message.id) for message in missing))
+        transferred = iter(await self._single_flight(key, lambda: self._transfer(client, bot, missing)))
+        results = [relayed if relayed is not None else next(transferred) for relayed in cached]
+        return results if any(results) else []
+
+    async def _transfer(self, client: Client, bot: Client, messages: List[Message]) -> List[Optional[RelayedMedia]]:
+        """Forwards `messages` from one chat to `bot` in a single call and waits for the bot-side copies."""
+        if any(is_protected(message) for message in messages):
+            return await self._upload(client, messages)
+        loop = asyncio.get_running_loop()
+        keys = [_cache_key(bot, get_file_unique_id(message)) for message in messages]
+        captures = []
+        for key in keys:
+            future = self._captures.get(key)
+            if future is None:
+                future = loop.create_future()
+                self._captures[key] = future
+            captures.append(future)
+
+        try:
+            await client.forward_messages(
+                # User clients have a chat with the primary bot; pool bots are resolved by username once
+                chat_id=bot.me.id if bot is self.primary else bot.me.username,
+                from_chat_id=messages[0].chat.id,
+                message_ids=[message.id for message in messages],
+                disable_notification=True,
+            )
+            self.upstream_transfers += 1
+            done, _ = await asyncio.wait(captures, timeout=RELAY_CAPTURE_TIMEOUT)
+        except ChatForwardsRestricted:
+            # Protected content the messages did not announce
+            done = None
+        finally:
+            for key in keys:
+                self._captures.pop(key, None)
+        if done is None:
+            return await self._upload(client, messages)
+
+        results = []
+        for message, key, future in zip(messages, keys, captures):
+            if future not in done:
+                logger.warning(
+                    f"User client {client.me.id}: Bot did not receive relayed media of message {message.id} "
+                    f"within {RELAY_CAPTURE_TIMEOUT}s."
+                )
+                results.append(None)
+                continue
+            relayed = RelayedMedia(bot, future.result())
+            relayed.source_keys.add((message.chat.id, message.id))
+            self._store(key, relayed)
+            results.append(relayed)
+        return results
+
+    async def _upload(self, client: Client, messages: List[Message]) -> List[Optional[RelayedMedia]]:
+        """Transfers each message by download and upload, for chats whose messages cannot be forwarded."""
+        user_id = client.me.id
+        user_slots = self._user_upload_slots.get(user_id)
+        if user_slots is None:
+            user_slots = self._user_upload_slots[user_id] = asyncio.Semaphore(RELAY_UPLOAD_PER_USER)
+        results = []
+        for message in messages:
+            if message.media not in UPLOAD_METHODS:
+                results.append(None)
+                continue
+            # The user's own limit first, so a user with a backlog does not hold global slots while waiting
+            async with user_slots, self._upload_slots:
+                relayed = await self._upload_one(client, message)
+            self._store(_cache_key(self.primary, get_file_unique_id(message)), relayed)
+            results.append(relayed)
+        return results
+
+    async def _upload_one(self, client: Client, message: Message) -> RelayedMedia:
+        """
+        Streams the media of one message from the user client into a spool file and uploads it
+        from the bot into the user's chat with the bot. The spool stays in memory up to
+        RELAY_SPOOL_THRESHOLD bytes and moves to disk beyond that.
+        """
+        user_id = client.me.id
+        media = getattr(message, message.media.value)
+        size = getattr(media, "file_size", None) or 0
+        method, kwargs = _upload_arguments(message)
+        with tempfile.SpooledTemporaryFile(max_size=RELAY_SPOOL_THRESHOLD, dir=RELAY_SPOOL_DIR) as spool:
+            in_memory = 0 < size <= RELAY_SPOOL_THRESHOLD
+            async for chunk in client.stream_media(message):
+                if in_memory:
+                    spool.write(chunk)
+                else:
+                    await asyncio.to_thread(spool.write, chunk)
+
+            def upload(bot: Client):
+                # Invoked again if a FloodWait forces a retry
+                spool.seek(0)
+                return getattr(bot, method)(user_id, spool, disable_notification=True, **kwargs)
+
+            bot_message = await outbound.submit(user_id, upload, client=self.primary)
+        self.uploads += 1
+        logger.info(
+            f"User client {user_id}: Uploaded protected media of message {message.id} ({size} bytes) through the bot."
+        )
+        relayed = RelayedMedia(self.primary, bot_message)
+        # The upload went to the user's chat with the bot, like a forward would have
+        relayed.source_keys.add((message.chat.id, message.id))
+        return relayed
+
+    async def deliver(self, relayed: RelayedMedia, dest_chat: int, owner_id: int, message: Message):
+        """
+        Sends relayed media to a destination through the outbound scheduler, by the bot holding it.
+        The owner's own chat with the bot is skipped when the upstream forward of this
+        very message already put the media there.
+        """
+        if dest_chat == owner_id and relayed.bot is self.primary and (message.chat.id, message.id) in relayed.source_keys:
+            return
+        await outbound.submit(
+            dest_chat,
+            lambda bot: bot.send_cached_media(
+                chat_id=dest_chat,
+                file_id=relayed.file_id,
+                caption=relayed.caption,
+                caption_entities=relayed.caption_entities,
+                disable_notification=True,
+            ),
+            client=relayed.bot,
+        )
+
+    async def deliver_group(
+        self, relayed: List[Optional[RelayedMedia]], dest_chat: int, owner_id: int, messages: List[Message]
+    ):
+        """
+        Sends all parts of a relayed album to a destination as one media group.
+        Falls back to one send per part if some parts are missing or cannot be grouped.
+        """
+        if dest_chat == owner_id and all(
+            item is not None and item.bot is self.primary and (message.chat.id, message.id) in item.source_keys
+            for item, message in zip(relayed, messages)
+        ):
+            return
+
+        parts = [item for item in relayed if item is not None]
+        if len(parts) < 2 or any(item.media_type not in MEDIA_GROUP_TYPES for item in parts):
+            for item, message in zip(relayed, messages):
+                if item is not None:
+                    await self.deliver(item, dest_chat, owner_id, message)
+            return
+
+        media = [
+            MEDIA_GROUP_TYPES[item.media_type](
+                media=item.file_id, caption=item.caption, caption_entities=item.caption_entities
+            )
+            for item in parts
+        ]
+        await outbound.submit(
+            dest_chat,
+            lambda bot: bot.send_media_group(chat_id=dest_chat, media=media, disable_notification=True),
+            client=parts[0].bot,
+        )
+
+
+# A single relay shared by all user clients
+media_relay = MediaRelay(bot_client)
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, FrozenSet, Iterable, List, Optional, Tuple
+from pyrogram import enums
+from pyrogram.types import Message
+from config import ANTI_REVOKE_PER_CHAT, ANTI_REVOKE_MAX_BYTES, ANTI_REVOKE_TTL, ANTI_REVOKE_MAX_TEXT, ANTI_REVOKE_SPILL
+from database.manager import save_cached_messages, take_cached_messages
+from database.rule_index import rule_index
+from metrics import registry as metrics
+
+logger = logging.getLogger(__name__)
+
+# Spilled messages are written to the database every this many seconds, in batches of at most this size
+SPILL_FLUSH_INTERVAL = 5
+SPILL_BATCH_SIZE = 1000
+# Rough per-record cost of the slots object, the index entries and the ring buffer slot, on top of the strings
+RECORD_OVERHEAD = 400
+
+# (user_id, message box, message_id). Telegram numbers messages per supergroup and channel, but
+# private chats and basic groups share one sequence per account, the "common box" 0. Deletion
+# updates only name the chat for supergroups and channels, so records are looked up by box.
+Key = Tuple[int, int, int]
+
+
+def message_box(message: Message) -> int:
+    if message.chat.type in [enums.ChatType.SUPERGROUP, enums.ChatType.CHANNEL]:
+        return message.chat.id
+    return 0
+
+
+class CachedMessage:
+    """What is kept of a received message to report it once it is deleted."""
+
+    __slots__ = (
+        "user_id", "box", "chat_id", "message_id", "sent_at", "created_at",
+        "chat_title", "sender", "label", "text", "targets", "group", "size",
+    )
+
+    def __init__(self, user_id: int, box: int, chat_id: int, message_id: int, sent_at: Optional[float],
+                 created_at: float, chat_title: Optional[str], sender: str, label: str, text: str,
+                 targets: FrozenSet[int], group: Optional[str] = None):
+        self.user_id = user_id
+        self.box = box
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.sent_at = sent_at
+        self.created_at = created_at
+        self.chat_title = chat_title
+        self.sender = sender
+        self.label = label
+        self.text = text
+        self.targets = targets
+        self.group = group  # media_group_id of album parts
+        self.size = (
+            RECORD_OVERHEAD + sys.getsizeof(text) + sys.getsizeof(sender) + sys.getsizeof(targets)
+            + (sys.getsizeof(chat_title) if chat_title else 0)
+        )
+
+    @property
+    def key(self) -> Key:
+        return self.user_id, self.box, self.message_id
+
+    def to_document(self) -> Dict[str, Any]:
+        return {
+            '_id': _document_id(self.key),
+            'user_id': self.user_id,
+            'box': self.box,
+            'chat_id': self.chat_id,
+            'message_id': self.message_id,
+            'sent_at': self.sent_at,
+            'chat_title': self.chat_title,
+            'sender': self.sender,
+            'label': self.label,
+            'text': self.text,
+            'targets': sorted(self.targets),
+            'group': self.group,
+            'created_at': datetime.utcfromtimestamp(self.created_at),
+        }
+
+    @classmethod
+    def from_document(cls, document: Dict[str, Any]) -> "CachedMessage":
+        return cls(
+            document['user_id'], document['box'], document['chat_id'], document['message_id'],
+            document.get('sent_at'), time.time(), document.get('chat_title'), document['sender'],
+            document['label'], document['text'], frozenset(document['targets']), document.get('group'),
+        )
+
+
+def _document_id(key: Key) -> str:
+    return ":".join(map(str, key))
+
+
+class _ChatBuffer:
+    """
+    The ring buffer of one (user, chat): its keys, oldest first, and how many of them are still cached.
+    Keys of records taken out of the middle by a deletion stay behind until they reach the front.
+    """
+
+    __slots__ = ("keys", "live")
+
+    def __init__(self):
+        self.keys: Deque[Key] = deque()
+        self.live = 0
+
+
+class RevokeCache:
+    """
+    Keeps the recent messages of routed chats so they can be reported after the sender deletes them.
+    Records sit in one ring buffer per (user, chat) of at most `per_chat` entries, under a global
+    memory cap of `max_bytes` and a TTL. Records are kept in arrival order, so the oldest record of
+    the process is always the oldest of its chat as well and both limits evict from the front.
+    With `spill`, records evicted by the limits are written to MongoDB in batches, where they
+    expire through a TTL index, and deletions the memory cache misses are looked up there.
+    """
+
+    def __init__(self, per_chat: int, max_bytes: int, ttl: float, spill: bool):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill = spill
+        self._records: "OrderedDict[Key, CachedMessage]" = OrderedDict()
+        self._chats: Dict[Tuple[int, int], _ChatBuffer] = {}  # {(user_id, chat_id): ring buffer}
+        self._spilled: Dict[Key, CachedMessage] = {}  # Evicted, not written yet
+        self._task: Optional[asyncio.Task] = None
+        self.size = 0
+        self.recovered = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.per_chat > 0
+
+    async def start(self):
+        if self.enabled and self.spill:
+            self._task = asyncio.create_task(self._run_flusher())
+
+    async def stop(self):
+        """Stops the background writer; with spilling, the records still in memory are written as well."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.spill:
+            self._expire(time.time())
+            for key in list(self._records):
+                self._spilled[key] = self._remove(key)
+            await self.flush()
+
+    def record(self, user_id: int, message: Message, label: str, targets: Iterable[int]):
+        """Remembers a routed message and its destinations. Called on the hot path."""
+        if not self.enabled:
+            return
+        key = (user_id, message_box(message), message.id)
+        if key in self._records:
+            return
+        if message.from_user:
+            sender_name = message.from_user.mention
+        else:
+            # Anonymous admins and channel posts are sent on behalf of a chat
+            sender_name = getattr(getattr(message, "sender_chat", None), "title", None) or "未知"
+        now = time.time()
+        cached = CachedMessage(
+            user_id, key[1], message.chat.id, message.id,
+            message.date.timestamp() if message.date else None, now,
+            message.chat.title, sender_name, label,
+            (message.text or message.caption or "")[:ANTI_REVOKE_MAX_TEXT], frozenset(targets),
+            getattr(message, "media_group_id", None),
+        )
+
+        chat = self._chats.get((user_id, message.chat.id))
+        if chat is None:
+            chat = self._chats[(user_id, message.chat.id)] = _ChatBuffer()
+        chat.keys.append(key)
+        chat.live += 1
+        self._records[key] = cached
+        self.size += cached.size
+        while chat.live > self.per_chat:
+            # The front key is always live (see _remove)
+            self._evict(self._records[chat.keys[0]])
+        if len(chat.keys) > 2 * self.per_chat:
+            # Deletions from the middle left many stale keys behind
+            chat.keys = deque(chat_key for chat_key in chat.keys if chat_key in self._records)
+
+        self._expire(now)
+        while self.size > self.max_bytes and self._records:
+            self._evict(self._records[next(iter(self._records))])
+
+    def _remove(self, key: Key) -> Optional[CachedMessage]:
+        cached = self._records.pop(key, None)
+        if cached is None:
+            return None
+        self.size -= cached.size
+        chat_key = (cached.user_id, cached.chat_id)
+        chat = self._chats.get(chat_key)
+        if chat is not None:
+            chat.live -= 1
+            while chat.keys and chat.keys[0] not in self._records:
+                chat.keys.popleft()
+            if not chat.live:
+                del self._chats[chat_key]
+        return cached
+
+    def _evict(self, cached: CachedMessage):
+        """Drops a record pushed out by a limit, spilling it to the database if enabled."""
+        self._remove(cached.key)
+        if self.spill:
+            self._spilled[cached.key] = cached
+
+    def _expire(self, now: float):
+        cutoff = now - self.ttl
+        while self._records:
+            cached = self._records[next(iter(self._records))]
+            if cached.created_at >= cutoff:
+                break
+            self._remove(cached.key)
+
+    async def take(self, user_id: int, box: int, message_ids: List[int]) -> List[CachedMessage]:
+        """Removes and returns the cached records of deleted messages, oldest first."""
+        if not self.enabled:
+            return []
+        self._expire(time.time())
+        found = []
+        missing = []
+        for message_id in message_ids:
+            key = (user_id, box, message_id)
+            cached = self._remove(key) or self._spilled.pop(key, None)
+            if cached is not None:
+                found.append(cached)
+            else:
+                missing.append(key)
+
+        # Deletions in supergroups and channels name their chat, so only routed ones are looked up
+        if missing and self.spill and (box == 0 or rule_index.is_source(user_id, box)):
+            try:
+                documents = await take_cached_messages([_document_id(key) for key in missing])
+                found.extend(CachedMessage.from_document(document) for document in documents)
+            except Exception as e:
+                logger.error(f"User client {user_id}: Could not look up deleted messages. Error: {e}", exc_info=True)
+        self.recovered += len(found)
+        return sorted(found, key=lambda cached: cached.message_id)
+
+    async def flush(self):
+        spilled, self._spilled = self._spilled, {}
+        documents = [cached.to_document() for cached in spilled.values()]
+        for start in range(0, len(documents), SPILL_BATCH_SIZE):
+            # Best effort: records that cannot be written are dropped rather than piling up in memory
+            await save_cached_messages(documents[start:start + SPILL_BATCH_SIZE])
+
+    async def _run_flusher(self):
+        while True:
+            await asyncio.sleep(SPILL_FLUSH_INTERVAL)
+            try:
+                self._expire(time.time())
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to spill cached messages. Error: {e}", exc_info=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"messages": len(self._records), "bytes": self.size, "recovered": self.recovered}
+
+
+# Shared by every user client in this process
+revoke_cache = RevokeCache(ANTI_REVOKE_PER_CHAT, ANTI_REVOKE_MAX_BYTES, ANTI_REVOKE_TTL, ANTI_REVOKE_SPILL)
+metrics.revoke_cache_bytes.set_function(lambda: revoke_cache.size)
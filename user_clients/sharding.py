@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, Optional, Set
+from config import WORKER_ID, LEASE_TTL, LEASE_HEARTBEAT, WORKER_MAX_CLIENTS
+from database.manager import (
+    get_managed_users,
+    get_sessions,
+    load_rule_index,
+    claim_client_lease,
+    renew_client_leases,
+    release_client_leases,
+    get_active_client_leases,
+    report_client_health,
+)
+from user_clients.manager import user_client_manager
+
+logger = logging.getLogger(__name__)
+
+
+class ShardWorker:
+    """
+    Runs a share of the managed user clients in sharded mode (RUN_MODE=worker).
+    Each worker claims users through lease documents in `client_leases` and renews them
+    every LEASE_HEARTBEAT seconds. Leases of a worker that stops heartbeating expire after
+    LEASE_TTL seconds and are claimed by the remaining workers.
+    Renewal runs in its own task, so leases stay alive while a tick is busy starting clients,
+    and a client whose lease is lost, or could not be renewed in time, is stopped at once:
+    the same session must never run on two workers.
+    """
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self._task: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._held: Set[int] = set()  # Users whose lease the last renewal confirmed, or claimed since
+        self._fresh_claims: Set[int] = set()  # Claimed while a renewal was in flight
+        self._renewed_at = 0.0  # time.monotonic() before the last successful renewal
+        self._rule_versions: Dict[int, int] = {}  # {user_id: rules_version of the loaded index}
+
+    async def start(self):
+        logger.info(f"Worker {self.worker_id} joining the fleet (capacity {WORKER_MAX_CLIENTS} clients).")
+        user_client_manager.supervisor.is_leased = lambda user_id: user_id in self._held
+        await self._renew()
+        self._heartbeat = asyncio.create_task(self._run_heartbeat())
+        await self._tick()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops heartbeating, stops the local clients and hands their leases back."""
+        for task in (self._task, self._heartbeat):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._task = self._heartbeat = None
+        user_ids = list(user_client_manager.running_clients)
+        await user_client_manager.stop_all()
+        await release_client_leases(self.worker_id, user_ids)
+        logger.info(f"Worker {self.worker_id} released {len(user_ids)} leases.")
+
+    async def _run_heartbeat(self):
+        while True:
+            await asyncio.sleep(LEASE_HEARTBEAT)
+            try:
+                await self._renew()
+            except Exception as e:
+                logger.error(f"Worker {self.worker_id}: lease renewal failed. Error: {e}", exc_info=True)
+                if time.monotonic() - self._renewed_at > LEASE_TTL - LEASE_HEARTBEAT:
+                    # The leases may expire before the next attempt and be claimed by another worker
+                    self._held = set()
+                    await self._stop_unleased("its lease could not be renewed")
+
+    async def _renew(self):
+        renewing_at = time.monotonic()
+        self._fresh_claims.clear()
+        renewed = await renew_client_leases(self.worker_id, LEASE_TTL)
+        # A tick may have claimed leases that the renewal query did not see yet
+        self._held = set(renewed) | self._fresh_claims
+        self._renewed_at = renewing_at
+        # Leases we lost (e.g. after a long pause) now belong to someone else
+        await self._stop_unleased("it lost its lease")
+
+    async def _stop_unleased(self, reason: str):
+        supervisor = user_client_manager.supervisor
+        for user_id in list(user_client_manager.running_clients):
+            if user_id not in self._held:
+                logger.warning(f"Worker {self.worker_id}: stopping the client of user {user_id}, {reason}.")
+                await user_client_manager.stop_client(user_id)
+        # Clients waiting for a restart must not come back without their lease either
+        for user_id in list(supervisor.health):
+            if user_id not in self._held and supervisor.is_retrying(user_id):
+                logger.warning(f"Worker {self.worker_id}: no longer restarting the client of user {user_id}, {reason}.")
+                supervisor.forget(user_id)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(LEASE_HEARTBEAT)
+            try:
+                await self._tick()
+            except Exception as e:
+                logger.error(f"Worker {self.worker_id}: tick failed. Error: {e}", exc_info=True)
+
+    async def _tick(self):
+        held = set(self._held)
+        supervisor = user_client_manager.supervisor
+
+        # Fresh read: users and rules may have been changed through the bot process
+        active_users = {user['user_id']: user for user in await get_managed_users(refresh=True)}
+
+        # Users deactivated through the admin bot
+        deactivated = held - active_users.keys()
+        for user_id in deactivated:
+            if user_id in user_client_manager.running_clients:
+                await user_client_manager.stop_client(user_id)
+            supervisor.forget(user_id)
+            self._rule_versions.pop(user_id, None)
+        await release_client_leases(self.worker_id, list(deactivated))
+        held -= deactivated
+
+        # Rules changed by another process since we compiled them
+        for user_id in held & user_client_manager.running_clients.keys():
+            version = active_users[user_id].get('rules_version', 0)
+            if self._rule_versions.get(user_id) != version:
+                await load_rule_index(user_id)
+                self._rule_versions[user_id] = version
+
+        # Liveness of our clients for /listusers in the bot process
+        await report_client_health(self.worker_id, {
+            user_id: snapshot for user_id, snapshot in supervisor.snapshots().items() if user_id in held
+        })
+
+        # Held leases whose client is not running yet and free users. Clients that failed are
+        # restarted by the supervisor with backoff, and revoked sessions are not started at all.
+        leases = await get_active_client_leases()
+        candidates = [
+            user_id for user_id, user in active_users.items()
+            if user_id not in leases and not user.get('session_revoked')
+        ]
+        random.shuffle(candidates)  # Spread claims evenly when several workers start together
+        capacity = WORKER_MAX_CLIENTS - len(held)
+        claimed = [
+            user_id for user_id in held
+            if user_id not in user_client_manager.running_clients and not supervisor.is_retrying(user_id)
+        ]
+        for user_id in candidates[:max(capacity, 0)]:
+            if await claim_client_lease(user_id, self.worker_id, LEASE_TTL):
+                self._held.add(user_id)
+                self._fresh_claims.add(user_id)
+                claimed.append(user_id)
+
+        if not claimed:
+            return
+        logger.info(f"Worker {self.worker_id}: starting {len(claimed)} claimed clients.")
+        # Session strings are only read for the clients about to start
+        results = await user_client_manager.start_clients(await get_sessions(claimed))
+        for user_id, success in results.items():
+            if success:
+                self._rule_versions[user_id] = active_users[user_id].get('rules_version', 0)
+        # Clients that are not going to be retried here (revoked sessions, or users whose session
+        # could not be read) are handed back; the supervisor retries the rest under this lease
+        released = [user_id for user_id in claimed if not results.get(user_id) and not supervisor.is_retrying(user_id)]
+        await release_client_leases(self.worker_id, released)
+        # Leases lost while the clients were starting
+        await self._stop_unleased("it lost its lease during startup")
+
+
+# The worker instance of this process, used when RUN_MODE=worker
+shard_worker = ShardWorker(WORKER_ID)
@@ -0,0 +1,334 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from pyrogram.storage import MemoryStorage, Storage
+from pyrogram.storage.sqlite_storage import get_input_peer
+from config import SESSION_FLUSH_INTERVAL, SESSION_PEER_CACHE_SIZE
+from database.manager import get_client_session, find_client_peer, save_client_state, delete_client_state
+
+logger = logging.getLogger(__name__)
+
+# Session fields Pyrogram reads and writes through the storage accessors
+SESSION_FIELDS = ("dc_id", "api_id", "test_mode", "auth_key", "date", "user_id", "is_bot")
+
+# (peer_id, access_hash, type, username, phone_number), as passed to Storage.update_peers
+PeerRow = Tuple[int, int, str, Optional[str], Optional[str]]
+
+
+def _auth_key_id(auth_key: Optional[bytes]) -> Optional[str]:
+    """Identifies an auth key without storing it, the same way MTProto does (last 8 bytes of its SHA-1)."""
+    return hashlib.sha1(auth_key).digest()[-8:].hex() if auth_key else None
+
+
+class MongoSessionStorage(Storage):
+    """
+    Pyrogram storage of one user client that survives restarts.
+    The auth key comes from the managed user's session string as before; the peer cache
+    (access hashes, usernames) is kept in MongoDB, so a restarted client resolves known
+    chats without asking Telegram again. The update state stays in memory: clients start
+    with skip_updates, so Pyrogram never reads it back, and messages missed while offline
+    are replayed by `catch_up` instead.
+    Reads are served from memory where possible. Writes only update memory and are
+    written to the database in batches by `session_writer`.
+    """
+
+    # Usernames older than this are resolved again, as in Pyrogram's SQLite storage
+    USERNAME_TTL = 8 * 60 * 60
+
+    def __init__(self, name: str, user_id: int, session_string: str):
+        super().__init__(name)
+        self.owner_id = user_id
+        self.session_string = session_string
+        self._session: Dict[str, Any] = {}
+        self._states: Dict[int, Tuple[int, int, int, int, int]] = {}  # {entity id: update state}, never written
+        self._peers: "OrderedDict[int, PeerRow]" = OrderedDict()  # LRU of known peers
+        self._usernames: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()  # LRU of {username: (peer_id, seen at)}
+        self._pending_peers: Dict[int, Dict[str, Any]] = {}  # {peer_id: fields not written yet}
+        self._session_dirty = False
+
+    async def open(self):
+        # MemoryStorage already knows every session string format
+        seed = MemoryStorage(self.name, self.session_string)
+        await seed.open()
+        self._session = {field: await getattr(seed, field)() for field in SESSION_FIELDS}
+        await seed.close()
+
+        document = await get_client_session(self.owner_id)
+        if document is not None and document.get('auth_key_id') == _auth_key_id(self._session['auth_key']):
+            self._session['date'] = document.get('date', 0)
+        else:
+            # New user or a new login: the stored session document belongs to another session.
+            # Peers stay valid, as access hashes are bound to the account, not the session.
+            self._mark_session_dirty()
+
+    async def save(self):
+        await self.date(int(time.time()))
+
+    async def close(self):
+        try:
+            await session_writer.flush(self)
+        except Exception as e:
+            # Only costs a colder start next time; the client must still shut down
+            logger.error(f"User client {self.owner_id}: Could not write session state on close. Error: {e}")
+
+    async def delete(self):
+        session_writer.discard(self)
+        self._pending_peers.clear()
+        self._session_dirty = False
+        await delete_client_state(self.owner_id)
+
+    # --- Peers ---
+
+    def _cache_peer(self, row: PeerRow):
+        self._peers[row[0]] = row
+        self._peers.move_to_end(row[0])
+        while len(self._peers) > SESSION_PEER_CACHE_SIZE:
+            self._peers.popitem(last=False)
+
+    def _cache_username(self, username: str, peer_id: int, seen_at: float):
+        self._usernames[username] = (peer_id, seen_at)
+        self._usernames.move_to_end(username)
+        while len(self._usernames) > SESSION_PEER_CACHE_SIZE:
+            self._usernames.popitem(last=False)
+
+    async def update_peers(self, peers: List[PeerRow]):
+        changed = False
+        now = time.time()
+        for row in peers:
+            row = tuple(row)
+            peer_id, username = row[0], row[3]
+            if username:
+                self._cache_username(username, peer_id, now)
+            # Every update carries its users and chats again; only actual changes are written
+            old = self._peers.get(peer_id)
+            if old == row:
+                self._peers.move_to_end(peer_id)
+                continue
+            if old is not None and old[3] and old[3] != username:
+                # A username the peer gave up may belong to someone else by now
+                self._usernames.pop(old[3], None)
+            self._cache_peer(row)
+            self._pending_peers[peer_id] = self._document(row)
+            changed = True
+        if changed:
+            session_writer.mark(self)
+
+    async def update_usernames(self, usernames: List[Tuple[int, str]]):
+        # Pyrogram passes every username of a peer that has several, right after update_peers
+        by_peer: Dict[int, List[str]] = {}
+        for peer_id, username in usernames:
+            by_peer.setdefault(peer_id, []).append(username)
+        now = time.time()
+        changed = False
+        for peer_id, names in by_peer.items():
+            known = all(self._usernames.get(name, (None,))[0] == peer_id for name in names)
+            for name in names:
+                self._cache_username(name, peer_id, now)
+            pending = self._pending_peers.get(peer_id)
+            if pending is None:
+                row = self._peers.get(peer_id)
+                if row is None or known:
+                    continue
+                pending = self._pending_peers[peer_id] = self._document(row)
+                changed = True
+            for name in names:
+                if name not in pending['usernames']:
+                    pending['usernames'].append(name)
+        if changed:
+            session_writer.mark(self)
+
+    async def get_peer_by_id(self, peer_id: int):
+        row = self._peers.get(peer_id)
+        if row is not None:
+            self._peers.move_to_end(peer_id)
+            return get_input_peer(*row[:3])
+        document = await find_client_peer(self.owner_id, {'peer_id': peer_id})
+        if document is None:
+            raise KeyError(f"ID not found: {peer_id}")
+        self._cache_peer(self._row(document))
+        return get_input_peer(document['peer_id'], document['access_hash'], document['type'])
+
+    async def get_peer_by_username(self, username: str):
+        cached = self._usernames.get(username)
+        if cached is not None:
+            peer_id, seen_at = cached
+            row = self._peers.get(peer_id)
+            if row is not None and time.time() - seen_at <= self.USERNAME_TTL:
+                self._usernames.move_to_end(username)
+                self._peers.move_to_end(peer_id)
+                return get_input_peer(*row[:3])
+        document = await find_client_peer(self.owner_id, {
+            'usernames': username,
+            'updated_at': {'$gte': datetime.utcnow() - timedelta(seconds=self.USERNAME_TTL)},
+        })
+        if document is None:
+            raise KeyError(f"Username not found: {username}")
+        self._cache_peer(self._row(document))
+        # The username is as old as the document that holds it
+        seen_at = document['updated_at'].replace(tzinfo=timezone.utc).timestamp()
+        self._cache_username(username, document['peer_id'], seen_at)
+        return get_input_peer(document['peer_id'], document['access_hash'], document['type'])
+
+    async def get_peer_by_phone_number(self, phone_number: str):
+        document = await find_client_peer(self.owner_id, {'phone_number': phone_number})
+        if document is None:
+            raise KeyError(f"Phone number not found: {phone_number}")
+        return get_input_peer(document['peer_id'], document['access_hash'], document['type'])
+
+    @staticmethod
+    def _document(row: PeerRow) -> Dict[str, Any]:
+        peer_id, access_hash, peer_type, username, phone_number = row
+        return {
+            'peer_id': peer_id,
+            'access_hash': access_hash,
+            'type': peer_type,
+            'username': username,
+            'usernames': [username] if username else [],
+            'phone_number': phone_number,
+        }
+
+    @staticmethod
+    def _row(document: Dict[str, Any]) -> PeerRow:
+        return (
+            document['peer_id'], document['access_hash'], document['type'],
+            document.get('username'), document.get('phone_number'),
+        )
+
+    # --- Update state ---
+
+    async def update_state(self, value: Tuple[int, int, int, int, int] = object):
+        if value == object:
+            return list(self._states.values())
+        if isinstance(value, int):
+            self._states.pop(value, None)
+        else:
+            self._states[value[0]] = tuple(value)
+
+    # --- Session fields ---
+
+    def _mark_session_dirty(self):
+        self._session_dirty = True
+        session_writer.mark(self)
+
+    def _accessor(self, field: str, value: Any):
+        if value == object:
+            return self._session.get(field)
+        self._session[field] = value
+        if field == 'date':
+            self._mark_session_dirty()
+
+    async def dc_id(self, value: int = object):
+        return self._accessor('dc_id', value)
+
+    async def api_id(self, value: int = object):
+        return self._accessor('api_id', value)
+
+    async def test_mode(self, value: bool = object):
+        return self._accessor('test_mode', value)
+
+    async def auth_key(self, value: bytes = object):
+        return self._accessor('auth_key', value)
+
+    async def date(self, value: int = object):
+        return self._accessor('date', value)
+
+    async def user_id(self, value: int = object):
+        return self._accessor('user_id', value)
+
+    async def is_bot(self, value: bool = object):
+        return self._accessor('is_bot', value)
+
+    # --- Write-behind ---
+
+    def take_pending(self) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
+        """Hands the unwritten peers and session state to the writer as documents."""
+        now = datetime.utcnow()
+        peers, self._pending_peers = self._pending_peers, {}
+        peer_documents = [dict(peer, owner_id=self.owner_id, updated_at=now) for peer in peers.values()]
+        session_document = None
+        if self._session_dirty:
+            self._session_dirty = False
+            session_document = {
+                '_id': self.owner_id,
+                'auth_key_id': _auth_key_id(self._session.get('auth_key')),
+                'date': self._session.get('date') or 0,
+                'updated_at': now,
+            }
+        return peer_documents, session_document
+
+    def restore_pending(self, peer_documents: List[Dict[str, Any]], session_document: Optional[Dict[str, Any]]):
+        """Puts back what a failed write took, unless newer changes replaced it meanwhile."""
+        for document in peer_documents:
+            fields = {key: value for key, value in document.items() if key not in ('owner_id', 'updated_at')}
+            self._pending_peers.setdefault(document['peer_id'], fields)
+        if session_document is not None:
+            self._session_dirty = True
+
+
+class SessionWriter:
+    """
+    Write-behind for all MongoSessionStorage instances of this process: storages with
+    unwritten changes are collected and written every SESSION_FLUSH_INTERVAL seconds,
+    with one bulk write for all peers and one for all session states.
+    """
+
+    def __init__(self):
+        self._dirty: Dict[int, MongoSessionStorage] = {}  # {user_id: storage}
+        self._task: Optional[asyncio.Task] = None
+        self.written_peers = 0
+
+    def mark(self, storage: MongoSessionStorage):
+        self._dirty[storage.owner_id] = storage
+
+    def discard(self, storage: MongoSessionStorage):
+        if self._dirty.get(storage.owner_id) is storage:
+            del self._dirty[storage.owner_id]
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the background writer and writes everything still buffered."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self, storage: Optional[MongoSessionStorage] = None):
+        """Writes the buffered changes of one storage, or of all of them."""
+        if storage is not None:
+            self.discard(storage)
+            storages = [storage]
+        else:
+            storages, self._dirty = list(self._dirty.values()), {}
+        if not storages:
+            return
+
+        taken = [(storage, *storage.take_pending()) for storage in storages]
+        peers = [peer for _, storage_peers, _ in taken for peer in storage_peers]
+        sessions = [session for _, _, session in taken if session is not None]
+        try:
+            await save_client_state(peers, sessions)
+        except Exception:
+            for storage, storage_peers, session in taken:
+                storage.restore_pending(storage_peers, session)
+                self.mark(storage)
+            raise
+        self.written_peers += len(peers)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(SESSION_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to write user client session state. Error: {e}", exc_info=True)
+
+
+# Shared by the storages of all user clients in this process
+session_writer = SessionWriter()
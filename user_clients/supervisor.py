@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import random
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional
+from pyrogram import raw
+from pyrogram.errors import AuthKeyDuplicated, Unauthorized
+from config import SUPERVISOR_INTERVAL, SUPERVISOR_PING_TIMEOUT, SUPERVISOR_BACKOFF_BASE, SUPERVISOR_BACKOFF_MAX
+from database.manager import mark_session_revoked
+from metrics import registry as metrics
+
+if TYPE_CHECKING:
+    from user_clients.manager import UserClientManager
+
+logger = logging.getLogger(__name__)
+
+# Client states shown by /listusers
+RUNNING = "running"
+BACKOFF = "backoff"  # Failed; restarted once the backoff delay has passed
+REVOKED = "revoked"  # The session is no longer valid; circuit open until the user logs in again
+STOPPED = "stopped"  # Stopped on purpose; not supervised
+
+
+def is_session_revoked(error: BaseException) -> bool:
+    """Whether an error means the session can never work again (logged out, banned, key reused elsewhere)."""
+    return isinstance(error, (Unauthorized, AuthKeyDuplicated))
+
+
+class ClientHealth:
+    """What the supervisor knows about one user's client."""
+
+    __slots__ = ("state", "restarts", "failures", "started_at", "last_error", "next_attempt_at")
+
+    def __init__(self):
+        self.state = STOPPED
+        self.restarts = 0
+        self.failures = 0  # Consecutive failures, reset by a successful start
+        self.started_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.next_attempt_at = 0.0
+
+
+class ClientSupervisor:
+    """
+    Keeps the user clients of this process alive. Every SUPERVISOR_INTERVAL seconds each running
+    client is pinged; a client that is disconnected or does not answer is restarted, as is a
+    client whose start failed, after a jittered exponential backoff (SUPERVISOR_BACKOFF_BASE
+    doubling up to SUPERVISOR_BACKOFF_MAX seconds). A revoked session opens the circuit: the
+    client is not retried and the user is marked in `managed_users` until they log in again.
+    In sharded mode, `is_leased` tells whether this worker still holds a user's lease; a client
+    whose lease is gone is never restarted here.
+    """
+
+    def __init__(self, manager: "UserClientManager"):
+        self.manager = manager
+        self.health: Dict[int, ClientHealth] = {}
+        self._sessions: Dict[int, str] = {}  # {user_id: session string} of supervised clients
+        self.is_leased: Callable[[int], bool] = lambda user_id: True
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _health(self, user_id: int) -> ClientHealth:
+        health = self.health.get(user_id)
+        if health is None:
+            health = self.health[user_id] = ClientHealth()
+        return health
+
+    def started(self, user_id: int, session_string: str):
+        health = self._health(user_id)
+        health.state = RUNNING
+        health.failures = 0
+        health.started_at = time.time()
+        self._sessions[user_id] = session_string
+
+    async def failed(self, user_id: int, session_string: str, error: BaseException):
+        """Records a failed start or a failed health check and schedules a retry, or opens the circuit."""
+        health = self._health(user_id)
+        health.failures += 1
+        health.last_error = f"{type(error).__name__}: {error}"
+        if is_session_revoked(error):
+            health.state = REVOKED
+            self._sessions.pop(user_id, None)
+            logger.error(f"User client {user_id}: Session is no longer valid ({health.last_error}). Not retrying.")
+            try:
+                await mark_session_revoked(user_id, health.last_error)
+            except Exception as e:
+                logger.error(f"User client {user_id}: Could not mark the session as revoked. Error: {e}")
+            return
+        delay = min(SUPERVISOR_BACKOFF_BASE * 2 ** (health.failures - 1), SUPERVISOR_BACKOFF_MAX)
+        delay *= random.uniform(0.8, 1.2)
+        health.state = BACKOFF
+        health.next_attempt_at = time.monotonic() + delay
+        self._sessions[user_id] = session_string
+        logger.warning(
+            f"User client {user_id}: Failure {health.failures} ({health.last_error}), restarting in {delay:.0f}s."
+        )
+
+    def forget(self, user_id: int):
+        """Stops supervising a client that is stopped on purpose."""
+        self._sessions.pop(user_id, None)
+        health = self.health.get(user_id)
+        if health is not None and health.state != REVOKED:
+            health.state = STOPPED
+
+    def is_retrying(self, user_id: int) -> bool:
+        health = self.health.get(user_id)
+        return health is not None and health.state == BACKOFF and user_id in self._sessions
+
+    def is_revoked(self, user_id: int) -> bool:
+        health = self.health.get(user_id)
+        return health is not None and health.state == REVOKED
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(SUPERVISOR_INTERVAL)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Client supervisor check failed. Error: {e}", exc_info=True)
+
+    async def check(self):
+        """Pings every running client and restarts the failed ones that are due."""
+        running = list(self.manager.running_clients.items())
+        results = await asyncio.gather(*(self._ping(client) for _, client in running), return_exceptions=True)
+        for (user_id, client), error in zip(running, results):
+            if error is None or self.manager.running_clients.get(user_id) is not client:
+                continue
+            session_string = self._sessions.get(user_id)
+            await self.manager.stop_client(user_id)
+            if session_string is not None:
+                await self.failed(user_id, session_string, error)
+
+        now = time.monotonic()
+        for user_id, session_string in list(self._sessions.items()):
+            health = self.health[user_id]
+            if health.state != BACKOFF or health.next_attempt_at > now:
+                continue
+            if not self.is_leased(user_id):
+                # Another worker may run this session by now
+                self.forget(user_id)
+                continue
+            health.restarts += 1
+            metrics.client_restarts.inc(user_id)
+            logger.info(f"User client {user_id}: Restart attempt {health.restarts}.")
+            await self.manager.start_client(user_id, session_string)
+
+    async def _ping(self, client) -> Optional[BaseException]:
+        """Returns None if the client is connected and answers a cheap request in time, else the error."""
+        if not client.is_connected:
+            return ConnectionError("Client is disconnected.")
+        try:
+            await asyncio.wait_for(client.invoke(raw.functions.updates.GetState()), SUPERVISOR_PING_TIMEOUT)
+        except asyncio.TimeoutError:
+            return TimeoutError(f"No answer within {SUPERVISOR_PING_TIMEOUT}s.")
+        except Exception as e:
+            return e
+        return None
+
+    def snapshot(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """The state of one client for /listusers, or None if it was never started in this process."""
+        health = self.health.get(user_id)
+        if health is None:
+            return None
+        client = self.manager.running_clients.get(user_id)
+        last_update_time = getattr(client, "last_update_time", None) if client is not None else None
+        # Pyrogram sets last_update_time on every update it receives; until then, the start time
+        last_update_at = last_update_time.timestamp() if last_update_time is not None else health.started_at
+        return {
+            'state': health.state,
+            'restarts': health.restarts,
+            'last_update_at': last_update_at,
+            'last_error': health.last_error,
+        }
+
+    def snapshots(self) -> Dict[int, Dict[str, Any]]:
+        return {user_id: self.snapshot(user_id) for user_id in self.health}
+
+    def state_counts(self) -> Dict[tuple, int]:
+        counts = {(state,): 0 for state in (RUNNING, BACKOFF, REVOKED, STOPPED)}
+        for health in self.health.values():
+            counts[(health.state,)] += 1
+        return counts
@@ -0,0 +1,53 @@
+import re
+from typing import List
+
+# Telegram rejects text messages longer than this
+MAX_MESSAGE_LENGTH = 4096
+
+# An HTML tag (group 1: "/" of a closing tag, group 2: its name) or a character entity
+_HTML_TOKEN = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^>]*>|&#?\w+;")
+
+
+def _closing_length(tags: List[str]) -> int:
+    return sum(len(name) + 3 for name in tags)
+
+
+def truncate_html(text: str, limit: int) -> str:
+    """
+    Cuts HTML `text` to at most `limit` characters, ending with "…". The cut never falls
+    inside a tag or an entity, and the tags it leaves open are closed again.
+    """
+    if len(text) <= limit:
+        return text
+    parts = []
+    used = 0
+    open_tags: List[str] = []
+    position = 0
+    for match in _HTML_TOKEN.finditer(text):
+        # The closing tags and the ellipsis must always still fit
+        room = limit - used - _closing_length(open_tags) - 1
+        run = text[position:match.start()]
+        if len(run) > room:
+            parts.append(run[:max(room, 0)])
+            break
+        parts.append(run)
+        used += len(run)
+
+        tags = list(open_tags)
+        closing, name = match.group(1), match.group(2)
+        if name and closing:
+            if name.lower() in tags:
+                del tags[len(tags) - 1 - tags[::-1].index(name.lower())]
+        elif name:
+            tags.append(name.lower())
+        token = match.group(0)
+        if used + len(token) + _closing_length(tags) + 1 > limit:
+            break
+        parts.append(token)
+        used += len(token)
+        open_tags = tags
+        position = match.end()
+    else:
+        room = limit - used - _closing_length(open_tags) - 1
+        parts.append(text[position:position + max(room, 0)])
+    return "".join(parts) + "…" + "".join(f"</{name}>" for name in reversed(open_tags))